@@ -0,0 +1,78 @@
+"""Пропускная способность проверки элементов разных справочников на даты.
+
+Запуск из головной директории:
+    python -m benchmarks.bench_check_dates --refbooks 3 --versions 5 \
+        --elements 50000 --items 10000
+
+Записи (справочник, код, значение, дата) равномерно распределены по
+справочникам и годам действия версий и отправляются пакетами
+``--batch-size`` на ``POST /refbooks/check_elements``. Результат - число
+проверенных записей в секунду с незагруженным и загруженным индексом
+элементов."""
+import argparse
+import random
+from datetime import date
+
+from .common import (element_code, element_value, measure, seed,
+                     setup_django, teardown_django)
+
+
+def run(client, url, records, batch_size):
+    for start in range(0, len(records), batch_size):
+        response = client.post(url, records[start:start + batch_size],
+                               content_type='application/json')
+        if response.status_code != 200:
+            raise RuntimeError(f'POST {url}: {response.status_code}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--refbooks', type=int, default=3)
+    parser.add_argument('--versions', type=int, default=5)
+    parser.add_argument('--elements', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    database_name = setup_django()
+    try:
+        from django.test import Client
+        from django.urls import reverse
+        from med_refbook.index import element_index
+
+        versions = seed(refbooks=args.refbooks, versions=args.versions,
+                        elements=args.elements)
+        codes = sorted({version.refbook.code for version in versions})
+        rng = random.Random(0)
+        records = []
+        for _ in range(args.items):
+            number = rng.randrange(args.elements * 2)
+            revision = rng.randrange(args.versions)
+            records.append({
+                'refbook': rng.choice(codes), 'code': element_code(number),
+                'value': element_value(number, revision),
+                'date': date(2000 + revision, rng.randint(1, 12),
+                             rng.randint(1, 28)).isoformat()})
+        client = Client()
+        url = reverse('check-elements-on-dates')
+
+        results = {}
+        element_index.clear()
+        results['индекс не загружен'] = measure(
+            run, client, url, records, args.batch_size)[0]
+        for version in versions:
+            element_index.get(version)
+        results['индекс загружен'] = measure(
+            run, client, url, records, args.batch_size)[0]
+
+        print(f'Справочников: {args.refbooks}, версий: {args.versions}, '
+              f'элементов в версии: {args.elements}, записей: {args.items}, '
+              f'размер пакета: {args.batch_size}')
+        for name, elapsed in results.items():
+            print(f'{name:<24} {args.items / elapsed:>12.0f} записей/с')
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
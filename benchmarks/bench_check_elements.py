@@ -0,0 +1,66 @@
+"""Сравнение пропускной способности check_element и check_elements.
+
+Запуск из головной директории:
+    python -m benchmarks.bench_check_elements --elements 100000 --items 500
+
+Запросы выполняются тестовым клиентом Django внутри процесса, поэтому
+сетевые издержки одиночного эндпоинта в результатах занижены."""
+import argparse
+import random
+
+from .common import (element_code, element_value, measure, seed,
+                     setup_django, teardown_django)
+
+
+def run_single(client, url, items):
+    for item in items:
+        client.get(url, item)
+
+
+def run_batch(client, url, items, batch_size):
+    for start in range(0, len(items), batch_size):
+        client.post(url, items[start:start + batch_size],
+                    content_type='application/json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--elements', type=int, default=50000)
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    database_name = setup_django()
+    try:
+        from django.test import Client
+        from django.urls import reverse
+        from med_refbook.index import element_index
+
+        version, = seed(elements=args.elements)
+        client = Client()
+        numbers = random.Random(0).sample(range(args.elements * 2), args.items)
+        items = [{'code': element_code(number), 'value': element_value(number),
+                  'version': version.version} for number in numbers]
+        single_url = reverse('check-element', kwargs={'id': version.refbook_id})
+        batch_url = reverse('check-elements', kwargs={'id': version.refbook_id})
+
+        results = {}
+        element_index.clear()
+        results['check_elements, индекс не загружен'] = measure(
+            run_batch, client, batch_url, items, args.batch_size)[0]
+        client.get(single_url, items[0])  # загрузка версии в индекс
+        results['check_element, индекс загружен'] = measure(
+            run_single, client, single_url, items)[0]
+        results['check_elements, индекс загружен'] = measure(
+            run_batch, client, batch_url, items, args.batch_size)[0]
+
+        print(f'Элементов в версии: {args.elements}, проверок: {args.items}, '
+              f'размер пакета: {args.batch_size}')
+        for name, elapsed in results.items():
+            print(f'{name:<40} {args.items / elapsed:>12.0f} проверок/с')
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
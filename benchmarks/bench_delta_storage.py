@@ -0,0 +1,121 @@
+"""Хранение версий целиком и в виде изменений: объём и задержки.
+
+Запуск из головной директории:
+    python -m benchmarks.bench_delta_storage --elements 100000 --changes 0.01
+
+Создаются базовая версия и следующая версия, отличающаяся на долю
+``--changes`` элементов. Замеры выполняются до и после перевода второй
+версии в хранение изменений командой convert_refbook_versions."""
+import argparse
+import io
+import random
+from datetime import date
+
+from .common import (element_code, element_value, measure, seed,
+                     setup_django, teardown_django)
+
+
+def next_version(base, changes, seed_value=0):
+    """Копия базовой версии с изменёнными, удалёнными и добавленными
+    элементами."""
+    from med_refbook.models import Element, Version
+    version = Version.objects.create(refbook_id=base.refbook_id, version='v1',
+                                     date_start=date(2001, 1, 1))
+    rows = dict(Element.objects.filter(version=base).values_list('code',
+                                                                 'value'))
+    codes = random.Random(seed_value).sample(sorted(rows), changes)
+    third = len(codes) // 3
+    for code in codes[:third]:
+        del rows[code]
+    for code in codes[third:2 * third]:
+        rows[code] += ' (изм.)'
+    for number in range(len(rows) + changes, len(rows) + changes + third):
+        rows[element_code(number)] = element_value(number)
+    Element.objects.bulk_create(
+        (Element(version=version, code=code, value=value)
+         for code, value in rows.items()), batch_size=5000)
+    return version
+
+
+def database_size():
+    from django.db import connection
+    with connection.cursor() as cursor:
+        if connection.vendor != 'sqlite':
+            cursor.execute('SELECT pg_database_size(current_database())')
+            return cursor.fetchone()[0]
+        cursor.execute('VACUUM')
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        return pages * cursor.fetchone()[0]
+
+
+def run_checks(client, url, items):
+    from med_refbook.index import element_index
+    for item in items:
+        element_index.clear()
+        client.get(url, item)
+
+
+def run_list(client, url):
+    response = client.get(url, {'version': 'v1', 'stream': 'ndjson'})
+    return sum(chunk.count(b'\n') for chunk in response.streaming_content)
+
+
+def run_page(client, url):
+    return client.get(url, {'version': 'v1', 'limit': 1000})
+
+
+def snapshot(client, version, items):
+    from django.urls import reverse
+    from med_refbook.models import Element
+    elements_url = reverse('element-list', kwargs={'id': version.refbook_id})
+    check_url = reverse('check-element', kwargs={'id': version.refbook_id})
+    list_time, count = measure(run_list, client, elements_url)
+    return {
+        'строк Element': Element.objects.count(),
+        'размер БД, МБ': database_size() / 2 ** 20,
+        'элементов в версии': count,
+        'elements?stream, с': list_time,
+        'elements?limit=1000, мс': measure(
+            run_page, client, elements_url)[0] * 1000,
+        'check_element без индекса, мс': measure(
+            run_checks, client, check_url, items)[0] * 1000 / len(items),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--elements', type=int, default=50000)
+    parser.add_argument('--changes', type=float, default=0.01)
+    parser.add_argument('--checks', type=int, default=50)
+    args = parser.parse_args()
+
+    database_name = setup_django()
+    try:
+        from django.core.management import call_command
+        from django.test import Client
+
+        base, = seed(elements=args.elements)
+        version = next_version(base, max(3, int(args.elements * args.changes)))
+        client = Client()
+        numbers = random.Random(1).sample(range(args.elements), args.checks)
+        items = [{'code': element_code(number), 'value': element_value(number),
+                  'version': version.version} for number in numbers]
+
+        full = snapshot(client, version, items)
+        call_command('convert_refbook_versions', refbook=base.refbook.code,
+                     to='delta', stdout=io.StringIO())
+        delta = snapshot(client, version, items)
+
+        print(f'Элементов в базовой версии: {args.elements}, '
+              f'доля изменений: {args.changes}')
+        print(f'{"":<32} {"целиком":>12} {"изменения":>12}')
+        for name in full:
+            print(f'{name:<32} {full[name]:>12.2f} {delta[name]:>12.2f}')
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Сравнение точной и нормализованной проверки check_element.
+
+Запуск из головной директории:
+    python -m benchmarks.bench_normalized_match --elements 100000 --items 500
+
+Точная проверка отвечает из внутрипроцессного индекса элементов,
+нормализованная (``match=normalized``) - запросом к БД по индексу
+``element_normalized_value_idx``; для неё выводится и план запроса.
+Значения запросов нормализованной проверки записаны в верхнем регистре
+с лишними пробелами."""
+import argparse
+import random
+
+from .common import (element_code, element_value, measure, seed,
+                     setup_django, teardown_django)
+
+
+def run(client, url, items):
+    for item in items:
+        assert client.get(url, item).json() == {'exists': True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--elements', type=int, default=50000)
+    parser.add_argument('--items', type=int, default=500)
+    args = parser.parse_args()
+
+    database_name = setup_django()
+    try:
+        from django.test import Client
+        from django.urls import reverse
+        from med_refbook.index import element_index
+        from med_refbook.models import Element
+
+        version, = seed(elements=args.elements)
+        client = Client()
+        numbers = random.Random(0).sample(range(args.elements), args.items)
+        exact = [{'code': element_code(number), 'value': element_value(number),
+                  'version': version.version} for number in numbers]
+        normalized = [{**item, 'value': f" {item['value'].upper()}  ",
+                       'match': 'normalized'} for item in exact]
+        url = reverse('check-element', kwargs={'id': version.refbook_id})
+
+        results = {}
+        element_index.clear()
+        results['exact, индекс не загружен'] = measure(
+            run, client, url, exact)[0]
+        results['exact, индекс загружен'] = measure(run, client, url, exact)[0]
+        results['normalized'] = measure(run, client, url, normalized)[0]
+
+        print(f'Элементов в версии: {args.elements}, проверок: {args.items}')
+        for name, elapsed in results.items():
+            print(f'{name:<32} {args.items / elapsed:>12.0f} проверок/с')
+        query = Element.objects.normalized_match(
+            version, exact[0]['code'], normalized[0]['value'])
+        print(query.explain())
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
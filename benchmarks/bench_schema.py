@@ -0,0 +1,79 @@
+"""Стоимость drf-spectacular при запуске процесса и построения схемы api.
+
+Запуск из головной директории:
+    python -m benchmarks.bench_schema --runs 5
+
+Запуск процесса измеряется в отдельных интерпретаторах: настройка Django и
+загрузка URLconf (как при первом запросе к процессу) с
+``MED_REFBOOK_LAZY_API_DOCS`` и без него; выводится медиана времени и число
+загруженных модулей drf-spectacular. Затем в текущем процессе измеряются
+первый запрос ``/schema/`` (построение схемы) и повторные (ответ из
+памяти)."""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+STARTUP = '''
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+elapsed = time.perf_counter() - started
+print(json.dumps([elapsed, sum(
+    name.startswith('drf_spectacular') for name in sys.modules)]))
+'''
+
+
+def startup(lazy, runs):
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'core.settings',
+           'MED_REFBOOK_LAZY_API_DOCS': str(lazy)}
+    env.setdefault('SECRET_KEY', 'benchmark')
+    env.setdefault('ALLOWED_HOSTS', 'testserver')
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP], env=env, check=True,
+            capture_output=True, text=True).stdout
+        elapsed, modules = json.loads(output)
+        timings.append(elapsed)
+    return statistics.median(timings), modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=100)
+    args = parser.parse_args()
+
+    for lazy in (False, True):
+        elapsed, modules = startup(lazy, args.runs)
+        print(f'MED_REFBOOK_LAZY_API_DOCS={lazy!s:<6} запуск '
+              f'{elapsed * 1000:>8.1f} мс, модулей drf_spectacular: '
+              f'{modules}')
+
+    from .common import setup_django, teardown_django
+    database_name = setup_django()
+    try:
+        from django.test import Client
+        client = Client()
+        started = time.perf_counter()
+        client.get('/schema/')
+        first = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            client.get('/schema/')
+        cached = (time.perf_counter() - started) / args.requests
+        print(f'{"первый запрос /schema/":<32} {first * 1000:>8.1f} мс')
+        print(f'{"повторный запрос /schema/":<32} {cached * 1000:>8.2f} мс')
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
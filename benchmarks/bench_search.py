@@ -0,0 +1,110 @@
+"""Поиск элементов: построение индекса версии и задержки запросов.
+
+Запуск из головной директории:
+    python -m benchmarks.bench_search --elements 500000
+
+Значения элементов составляются из случайных «слов» на кириллице, коды -
+как в остальных бенчмарках. Задержки измеряются и для поиска по индексу,
+и для запроса к эндпоинту search тестовым клиентом Django."""
+import argparse
+import random
+import time
+
+from .common import (element_code, measure, percentile, setup_django,
+                     teardown_django)
+
+SYLLABLES = ('ба', 'ве', 'гри', 'до', 'же', 'зо', 'ки', 'ла', 'мо', 'не',
+             'оп', 'пра', 'ре', 'си', 'ту', 'фе', 'хо', 'це', 'ча', 'шу')
+
+
+def vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 5))))
+    return sorted(words)
+
+
+def seed_version(elements, words, rng, batch_size=5000):
+    from datetime import date
+    from med_refbook.models import Element, Refbook, Version
+    refbook = Refbook.objects.create(code='SEARCH', name='Поиск')
+    version = Version.objects.create(refbook=refbook, version='v1',
+                                     date_start=date(2000, 1, 1))
+    batch = []
+    for number in range(elements):
+        value = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 6)))
+        batch.append(Element(version=version, code=element_code(number),
+                             value=value.capitalize()))
+        if len(batch) == batch_size:
+            Element.objects.bulk_create(batch)
+            batch = []
+    Element.objects.bulk_create(batch)
+    return version
+
+
+def queries(rng, words, elements, count):
+    result = []
+    for _ in range(count):
+        kind = rng.randrange(4)
+        word = rng.choice(words)
+        if kind == 0:
+            result.append(element_code(rng.randrange(elements))[:5])
+        elif kind == 1:
+            result.append(word[:2])
+        elif kind == 2:
+            result.append(word[:4].upper())
+        else:
+            result.append(f'{word} {rng.choice(words)[:3]}')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--elements', type=int, default=500000)
+    parser.add_argument('--words', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    database_name = setup_django()
+    try:
+        from django.test import Client
+        from django.urls import reverse
+        from med_refbook.search import search_index
+
+        rng = random.Random(0)
+        words = vocabulary(rng, args.words)
+        version = seed_version(args.elements, words, rng)
+        build_time, _ = measure(search_index.get, version)
+        samples = queries(rng, words, args.elements, args.queries)
+
+        index_latencies = []
+        for query in samples:
+            started = time.perf_counter()
+            search_index.search(version, query, args.limit)
+            index_latencies.append(time.perf_counter() - started)
+
+        client = Client()
+        url = reverse('element-search', kwargs={'id': version.refbook_id})
+        request_latencies = []
+        for query in samples:
+            started = time.perf_counter()
+            response = client.get(url, {'q': query, 'limit': args.limit,
+                                        'version': version.version})
+            request_latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.content
+
+        print(f'Элементов: {args.elements}, слов: {args.words}, '
+              f'запросов: {args.queries}, limit: {args.limit}')
+        print(f'построение индекса версии: {build_time:.2f} с')
+        for name, latencies in (('поиск по индексу', index_latencies),
+                                ('запрос к эндпоинту', request_latencies)):
+            print(f'{name:<20} p50 {percentile(latencies, 50) * 1000:.2f} мс, '
+                  f'p99 {percentile(latencies, 99) * 1000:.2f} мс')
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Стоимость формирования ответа со списком элементов в пересчёте на строку.
+
+Запуск из головной директории:
+    python -m benchmarks.bench_serialization --elements 100000
+
+Сравниваются прежний путь (модели, ElementSerializer, JSONRenderer DRF) и
+быстрый (кортежи values_list, FastJSONRenderer) по этапам: чтение из БД,
+построение данных ответа и кодирование в JSON."""
+import argparse
+
+from .common import measure, seed, setup_django, teardown_django
+
+
+def best(repeat, func, *args):
+    """Лучшее время из ``repeat`` запусков и результат вызова."""
+    elapsed, result = measure(func, *args)
+    for _ in range(repeat - 1):
+        elapsed = min(elapsed, measure(func, *args)[0])
+    return elapsed, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--elements', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    database_name = setup_django()
+    try:
+        from rest_framework.renderers import JSONRenderer
+        from med_refbook.models import Element
+        from med_refbook.renderers import FastJSONRenderer, orjson
+        from med_refbook.serializers import ElementSerializer
+
+        version, = seed(elements=args.elements)
+        queryset = Element.objects.materialized(version)
+
+        def rows_to_dicts(rows):
+            return {'elements': [{'code': code, 'value': value}
+                                 for code, value in rows]}
+
+        def serialize(objects):
+            return {'elements': ElementSerializer(objects, many=True).data}
+
+        fetch_models, objects = best(args.repeat, lambda: list(queryset.all()))
+        build_models, data = best(args.repeat, serialize, objects)
+        render_drf, content = best(args.repeat, JSONRenderer().render, data)
+        fetch_rows, rows = best(args.repeat, lambda: list(
+            queryset.values_list('code', 'value')))
+        build_rows, fast_data = best(args.repeat, rows_to_dicts, rows)
+        render_fast, fast_content = best(args.repeat, FastJSONRenderer().render,
+                                         fast_data)
+        assert content == fast_content
+
+        stages = {
+            'чтение из БД': (fetch_models, fetch_rows),
+            'данные ответа': (build_models, build_rows),
+            'кодирование JSON': (render_drf, render_fast),
+        }
+        stages['всего'] = tuple(map(sum, zip(*stages.values())))
+        print(f'Элементов: {args.elements}, '
+              f'orjson: {"да" if orjson else "нет"}')
+        print(f'{"мкс на строку":<20} {"сериализатор":>14} '
+              f'{"быстрый путь":>14}')
+        for name, (before, after) in stages.items():
+            print(f'{name:<20} {before / args.elements * 1e6:>14.2f} '
+                  f'{after / args.elements * 1e6:>14.2f}')
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Снимок версии против JSON: размер, время получения и поиск кода.
+
+Запуск из головной директории:
+    python -m benchmarks.bench_snapshot --elements 200000
+
+Сравниваются ответ ElementList (JSON) и двоичный снимок версии: время
+формирования, размер, время разбора клиентом, а также поиск кода в снимке
+через SnapshotReader и в разобранном JSON."""
+import argparse
+import json
+import random
+import tempfile
+
+from .common import (element_code, measure, seed, setup_django,
+                     teardown_django)
+
+
+def lookups(reader, codes):
+    for code in codes:
+        reader.get(code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--elements', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+
+    database_name = setup_django()
+    try:
+        from django.test import Client, override_settings
+        from django.urls import reverse
+        from med_refbook.snapshots import SnapshotReader, snapshot_path
+
+        version, = seed(elements=args.elements)
+        client = Client()
+        rng = random.Random(0)
+        codes = [element_code(rng.randrange(args.elements * 2))
+                 for _ in range(args.lookups)]
+
+        url = reverse('element-list', kwargs={'id': version.refbook_id})
+        json_time, response = measure(client.get, url)
+        parse_time, document = measure(json.loads, response.content)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+                MED_REFBOOK_SNAPSHOT_DIR=directory):
+            url = reverse('version-snapshot', kwargs={'id': version.refbook_id})
+            snapshot_time, snapshot = measure(
+                lambda: b''.join(client.get(url).streaming_content))
+            cached_time, _ = measure(
+                lambda: b''.join(client.get(url).streaming_content))
+            open_time, reader = measure(SnapshotReader, snapshot_path(version))
+            with reader:
+                lookup_time, _ = measure(lookups, reader, codes)
+            values = {element['code']: element['value']
+                      for element in document['elements']}
+            dict_time, _ = measure(lambda: [values.get(code) for code in codes])
+
+        print(f'Элементов: {args.elements}')
+        print(f'{"":<34} {"JSON":>10} {"снимок":>10}')
+        print(f'{"размер, МБ":<34} {len(response.content) / 2 ** 20:>10.2f} '
+              f'{len(snapshot) / 2 ** 20:>10.2f}')
+        print(f'{"ответ, мс (снимок - первый запрос)":<34} '
+              f'{json_time * 1000:>10.1f} {snapshot_time * 1000:>10.1f}')
+        print(f'{"ответ из кэша снимков, мс":<34} {"":>10} '
+              f'{cached_time * 1000:>10.1f}')
+        print(f'{"разбор / открытие, мс":<34} {parse_time * 1000:>10.1f} '
+              f'{open_time * 1000:>10.1f}')
+        print(f'{"поиск кода, мкс":<34} '
+              f'{dict_time / args.lookups * 1e6:>10.2f} '
+              f'{lookup_time / args.lookups * 1e6:>10.2f}')
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Общие средства бенчмарков: настройка Django, тестовая БД и данные."""
+import math
+import os
+import time
+from datetime import date
+
+CHANGE_EVERY = 100
+
+
+def setup_django(database_url=None):
+    """Инициализация Django и создание отдельной тестовой БД.
+
+    ``database_url`` заменяет БД из настроек проекта; тестовая БД создаётся
+    рядом с ней и удаляется функцией ``teardown_django``."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('ALLOWED_HOSTS', 'testserver')
+    import django
+    from django.conf import settings
+    from core.settings import database_settings
+    if database_url:
+        settings.DATABASES['default'] = database_settings(database_url)
+    django.setup()
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    return name
+
+
+def seed(refbooks=1, versions=1, elements=10000, batch_size=5000):
+    """Наполнение БД справочниками; возвращает список созданных версий.
+
+    Каждая следующая версия справочника меняет значения каждого
+    ``CHANGE_EVERY``-го элемента (см. ``element_value``)."""
+    from med_refbook.models import Element, Refbook, Version
+    created = []
+    for refbook_number in range(refbooks):
+        refbook = Refbook.objects.create(code=f'R{refbook_number}',
+                                         name=f'Справочник {refbook_number}')
+        for version_number in range(versions):
+            version = Version.objects.create(
+                refbook=refbook, version=f'v{version_number}',
+                date_start=date(2000 + version_number, 1, 1))
+            batch = []
+            for number in range(elements):
+                batch.append(Element(
+                    version=version, code=element_code(number),
+                    value=element_value(number, version_number)))
+                if len(batch) == batch_size or number == elements - 1:
+                    Element.objects.bulk_create(batch)
+                    batch = []
+            version.refresh_from_db()
+            created.append(version)
+    return created
+
+
+def teardown_django(name):
+    """Удаление тестовой БД; ``name`` - результат ``setup_django``."""
+    from django.db import connection
+    connection.creation.destroy_test_db(name, verbosity=0)
+
+
+def element_code(number):
+    return f'C{number:07d}'
+
+
+def element_value(number, revision=0):
+    if revision and number % CHANGE_EVERY == 0:
+        return f'Значение элемента {number} (ред. {revision})'
+    return f'Значение элемента {number}'
+
+
+def measure(func, *args, **kwargs):
+    """Время выполнения вызова в секундах и его результат."""
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+def percentile(samples, percent):
+    """Процентиль выборки методом ближайшего ранга."""
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
@@ -0,0 +1,133 @@
+"""Нагрузочный тест check_element: синхронный и асинхронный эндпоинты под ASGI.
+
+Запуск из головной директории:
+    python -m benchmarks.load_check_element --requests 20000 \
+        --concurrency 1 --concurrency 100 --concurrency 5000
+
+Запросы передаются ASGI-обработчикам проекта (``core.asgi``) напрямую, без
+сетевого сервера, в одном процессе и одном цикле событий, то есть в пределах
+одного ASGI-воркера. Оба эндпоинта проверяются с одними и теми же
+промежуточными слоями: всеми слоями ``MIDDLEWARE`` (обработчик синхронных
+эндпоинтов) и подмножеством асинхронных эндпоинтов (``api_middleware()``).
+Для каждого уровня параллельности запускаются ``--concurrency``
+сопрограмм-клиентов, которые вместе выполняют ``--requests`` запросов.
+``--cold`` очищает индекс элементов, кэш текущих версий и ревизии
+справочников перед каждым запросом, чтобы проверки шли в БД."""
+import argparse
+import asyncio
+import random
+import time
+from urllib.parse import urlencode
+
+from .common import (element_code, element_value, percentile, seed,
+                     setup_django, teardown_django)
+
+
+async def call(application, path, query):
+    """Один GET-запрос к ASGI-приложению; возвращает код ответа."""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'server': ('testserver', 80),
+        'client': ('127.0.0.1', 0), 'root_path': '',
+        'path': path, 'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'headers': [(b'host', b'testserver')],
+    }
+    request = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    disconnected = asyncio.Event()
+    status = None
+
+    async def receive():
+        if request:
+            return request.pop()
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await application(scope, receive, send)
+    disconnected.set()
+    return status
+
+
+async def load(application, path, queries, concurrency, cold):
+    """Выполнение запросов ``concurrency`` клиентами; задержки в секундах."""
+    from med_refbook.index import element_index
+    from med_refbook.resolvers import current_version_resolver
+    from med_refbook.revisions import refbook_revisions
+    pending = iter(queries)
+    latencies = []
+
+    async def client():
+        for query in pending:
+            if cold:
+                element_index.clear()
+                current_version_resolver.clear()
+                refbook_revisions.clear()
+            started = time.perf_counter()
+            status = await call(application, path, query)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                raise RuntimeError(f'{path}?{query}: {status}')
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--elements', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, action='append',
+                        help='Число одновременных клиентов (можно указать '
+                             'несколько раз)')
+    parser.add_argument('--cold', action='store_true')
+    args = parser.parse_args()
+
+    database_name = setup_django()
+    try:
+        from django.urls import reverse
+        from core.asgi import async_api_application, django_application
+
+        version, = seed(elements=args.elements)
+        rng = random.Random(0)
+        queries = []
+        for _ in range(args.requests):
+            number = rng.randrange(args.elements * 2)
+            queries.append(urlencode({'code': element_code(number),
+                                      'value': element_value(number)}))
+        paths = {
+            'sync': reverse('check-element', kwargs={'id': version.refbook_id}),
+            'async': reverse('async-check-element',
+                             kwargs={'id': version.refbook_id}),
+        }
+
+        print(f'Элементов: {args.elements}, запросов: {args.requests}, '
+              f'{"холодные" if args.cold else "прогретые"} кэши')
+        handlers = {
+            'все': django_application,
+            'api': async_api_application,
+        }
+        print(f'{"клиентов":>9} {"слои":>5} {"путь":>6} {"запросов/с":>11} '
+              f'{"p50, мс":>9} {"p99, мс":>9}')
+        for concurrency in args.concurrency or [1, 100, 1000]:
+            for middleware, application in handlers.items():
+                for name, path in paths.items():
+                    asyncio.run(call(application, path, queries[0]))  # прогрев
+                    elapsed, latencies = asyncio.run(load(
+                        application, path, queries, concurrency, args.cold))
+                    print(f'{concurrency:>9} {middleware:>5} {name:>6} '
+                          f'{len(latencies) / elapsed:>11.0f} '
+                          f'{percentile(latencies, 50) * 1000:>9.2f} '
+                          f'{percentile(latencies, 99) * 1000:>9.2f}')
+    finally:
+        teardown_django(database_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,87 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.exception import convert_exception_to_response
+from django.utils.module_loading import import_string
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Префикс асинхронных эндпоинтов чтения (см. med_refbook/urls.py)
+ASYNC_API_PREFIX = '/async/'
+
+# Промежуточные слои, которые не подключаются к асинхронным эндпоинтам:
+# они нужны только запросам с сессией пользователя, а эндпоинты принимают
+# лишь анонимные GET, HEAD и OPTIONS
+SESSION_MIDDLEWARE = {
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+}
+
+
+def api_middleware():
+    """Промежуточные слои асинхронных эндпоинтов: ``MIDDLEWARE`` проекта
+    без ``SESSION_MIDDLEWARE``, в том же порядке."""
+    return [path for path in settings.MIDDLEWARE
+            if path not in SESSION_MIDDLEWARE]
+
+
+class AsyncAPIHandler(ASGIHandler):
+    """Обработчик асинхронных эндпоинтов с промежуточными слоями
+    ``api_middleware()``.
+
+    Промежуточные слои проекта (безопасность, CommonMiddleware, локаль,
+    измерение запросов и добавленные при развёртывании) работают так же, как
+    у синхронных эндпоинтов. Не подключаются только слои сессий, CSRF,
+    аутентификации и сообщений: каждый синхронный слой под ASGI переключает
+    запрос в поток, а этим эндпоинтам они не нужны."""
+
+    def load_middleware(self, is_async=False):
+        # Повторяет BaseHandler.load_middleware для асинхронной цепочки из
+        # другого списка слоёв
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._exception_middleware = []
+        handler = convert_exception_to_response(self._get_response_async)
+        handler_is_async = True
+        for middleware_path in reversed(api_middleware()):
+            middleware = import_string(middleware_path)
+            middleware_is_async = getattr(middleware, 'async_capable', False)
+            try:
+                adapted_handler = self.adapt_method_mode(
+                    middleware_is_async, handler, handler_is_async,
+                    debug=settings.DEBUG,
+                    name=f'middleware {middleware_path}')
+                instance = middleware(adapted_handler)
+            except MiddlewareNotUsed:
+                continue
+            if hasattr(instance, 'process_view'):
+                self._view_middleware.insert(
+                    0, self.adapt_method_mode(True, instance.process_view))
+            if hasattr(instance, 'process_template_response'):
+                self._template_response_middleware.append(
+                    self.adapt_method_mode(
+                        True, instance.process_template_response))
+            if hasattr(instance, 'process_exception'):
+                self._exception_middleware.append(
+                    self.adapt_method_mode(False, instance.process_exception))
+            handler = convert_exception_to_response(instance)
+            handler_is_async = middleware_is_async
+        self._middleware_chain = self.adapt_method_mode(
+            True, handler, handler_is_async)
+
+
+async_api_application = AsyncAPIHandler()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'].startswith(ASYNC_API_PREFIX):
+        return await async_api_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -1,18 +1,43 @@
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
-from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
+from django.utils.module_loading import import_string
+from django.views.decorators.csrf import csrf_exempt
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('med_refbook.urls')),
 ]
 
+
+def lazy_view(view_class, **initkwargs):
+    """Представление, класс которого импортируется при первом запросе:
+    процессы, не получающие таких запросов, не загружают его модули."""
+    view = None
+
+    @csrf_exempt
+    def dispatch(request, *args, **kwargs):
+        nonlocal view
+        if view is None:
+            view = import_string(view_class).as_view(**initkwargs)
+        return view(request, *args, **kwargs)
+    return dispatch
+
+
+def api_docs_view(view_class, **initkwargs):
+    if getattr(settings, 'MED_REFBOOK_LAZY_API_DOCS', False):
+        return lazy_view(view_class, **initkwargs)
+    return import_string(view_class).as_view(**initkwargs)
+
+
 """add Swagger"""
 urlpatterns += [
-    path('schema/', SpectacularAPIView.as_view(), name='api-schema'),
+    path('schema/', api_docs_view('med_refbook.schema.CachedSchemaView'),
+         name='api-schema'),
     path(
         'docs/',
-        SpectacularSwaggerView.as_view(url_name='api-schema'),
+        api_docs_view('drf_spectacular.views.SpectacularSwaggerView',
+                      url_name='api-schema'),
         name='api-docs',
     ),
 ]
@@ -1,46 +1,162 @@
+import math
+
 from django.contrib import admin
+from django.forms.models import BaseInlineFormSet
+from django.utils.html import format_html, format_html_join
+from django.utils.http import urlencode
+from django.utils.timezone import now
+
 from .models import Element, Refbook, Version
 
+ELEMENTS_PAGE_PARAM = 'elements_page'
+
 
 class VersionInline(admin.TabularInline):
     model = Version
     extra = 1
 
 
+def element_page_number(request):
+    try:
+        return max(1, int(request.GET.get(ELEMENTS_PAGE_PARAM, 1)))
+    except ValueError:
+        return 1
+
+
+def element_page_count(version):
+    return max(1, math.ceil(Element.objects.filter(version=version).count()
+                            / ElementPageFormSet.page_size))
+
+
+class ElementPageFormSet(BaseInlineFormSet):
+    """Формы только для одной страницы элементов версии: в версии могут быть
+    сотни тысяч элементов. Номер страницы задаётся в ``get_formset``.
+
+    Отправленные формы сопоставляются с элементами по переданным
+    идентификаторам, а не по номеру страницы: пока страница была открыта,
+    в версию могли добавить или удалить элементы, и страница сдвинулась."""
+
+    page_number = 1
+    page_size = 50
+
+    def get_queryset(self):
+        if not hasattr(self, '_page_queryset'):
+            queryset = super().get_queryset()
+            if self.is_bound:
+                self._page_queryset = queryset.filter(
+                    pk__in=self._submitted_ids())
+            else:
+                start = (self.page_number - 1) * self.page_size
+                self._page_queryset = queryset[start:start + self.page_size]
+        return self._page_queryset
+
+    def _submitted_ids(self):
+        name = self.model._meta.pk.name
+        ids = (self.data.get(f'{self.add_prefix(number)}-{name}', '')
+               for number in range(self.initial_form_count()))
+        return [int(pk) for pk in ids if pk.isdigit()]
+
+
 class HandbookElementInline(admin.TabularInline):
     model = Element
+    formset = ElementPageFormSet
+    fields = ['code', 'value', 'parent_code', 'removed']
+    ordering = ['code']
     extra = 1
 
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.page_number = getattr(obj, 'elements_page', 1)
+        return formset
+
 
 @admin.register(Refbook)
 class RefbookAdmin(admin.ModelAdmin):
     fields = ['code', 'name', 'description']
     list_display = ['id', 'code', 'name', 'current_version',
                     'current_version_start_date']
+    search_fields = ['code', 'name']
     inlines = [VersionInline]
 
     def get_queryset(self, request):
-        return super().get_queryset(request).prefetch_related('versions')
+        # Текущая версия вычисляется в запросе списка, без запроса на строку
+        return super().get_queryset(request).with_version_on(now().date())
 
     def current_version(self, obj):
-        latest_version = obj.versions.order_by('-date_start').first()
-        return latest_version.version if latest_version else '-'
+        return obj.current_version or '-'
     current_version.short_description = 'Текущая версия'
+    current_version.admin_order_field = 'current_version'
 
     def current_version_start_date(self, obj):
-        latest_version = obj.versions.order_by('-date_start').first()
-        return latest_version.date_start if latest_version else '-'
+        return obj.current_version_date_start or '-'
     current_version_start_date.short_description = 'Дата начала действия версии'
+    current_version_start_date.admin_order_field = 'current_version_date_start'
 
 
 @admin.register(Version)
 class VersionAdmin(admin.ModelAdmin):
-    fields = ['refbook', 'version', 'date_start']
-    list_display = ['refbook_code', 'refbook_name', 'version', 'date_start']
+    fields = ['refbook', 'version', 'date_start', 'base',
+              'materialized_elements', 'element_pages']
+    readonly_fields = ['base', 'materialized_elements', 'element_pages']
+    list_display = ['refbook_code', 'refbook_name', 'version', 'date_start',
+                    'storage']
+    list_select_related = ['refbook', 'base']
+    search_fields = ['version', 'refbook__code', 'refbook__name']
+    autocomplete_fields = ['refbook']
+    show_full_result_count = False
     inlines = [HandbookElementInline]
+    materialized_preview_size = 20
 
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('refbook')
+        return super().get_queryset(request).select_related('refbook',
+                                                            'base')
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None:
+            # Номер страницы за последней страницей - последняя страница
+            obj.elements_pages = element_page_count(obj)
+            obj.elements_page = min(element_page_number(request),
+                                    obj.elements_pages)
+        return obj
+
+    def storage(self, obj):
+        if obj.base_id is None:
+            return 'все элементы'
+        return f'изменения относительно {obj.base.version}'
+    storage.short_description = 'Хранение'
+
+    def materialized_elements(self, obj):
+        """Содержимое версии с учётом базовой: для версий, хранящих только
+        изменения, оно отличается от элементов ниже."""
+        if obj.pk is None:
+            return '-'
+        elements = Element.objects.materialized(obj).order_by('code')
+        rows = format_html_join(
+            '', '<tr><td>{}</td><td>{}</td></tr>',
+            elements.values_list('code', 'value')[
+                :self.materialized_preview_size])
+        return format_html(
+            'Всего: {}<table><tr><th>Код</th><th>Значение</th></tr>{}'
+            '</table>', elements.count(), rows)
+    materialized_elements.short_description = 'Элементы версии'
+
+    def element_pages(self, obj):
+        """Переход между страницами элементов, редактируемых ниже."""
+        if obj.pk is None:
+            return '-'
+        pages = getattr(obj, 'elements_pages', None) or element_page_count(
+            obj)
+        current = getattr(obj, 'elements_page', 1)
+        links = format_html_join(
+            ' ', '<a href="?{}">{}</a>',
+            ((urlencode({ELEMENTS_PAGE_PARAM: number}), label)
+             for number, label in (
+                (1, '« первая'), (current - 1, '‹ предыдущая'),
+                (current + 1, 'следующая ›'), (pages, 'последняя »'))
+             if 1 <= number <= pages and number != current))
+        return format_html('Страница {} из {} {}', current, pages, links)
+    element_pages.short_description = 'Страницы элементов'
 
     def refbook_code(self, obj):
         return obj.refbook.code
@@ -53,9 +169,11 @@ class VersionAdmin(admin.ModelAdmin):
 
 @admin.register(Element)
 class ElementAdmin(admin.ModelAdmin):
-    fields = ['version', 'code', 'value']
+    fields = ['version', 'code', 'value', 'parent_code', 'removed']
     list_display = ['get_refbook_code', 'get_refbook_name',
                     'get_refbook_version', 'code', 'value']
+    autocomplete_fields = ['version']
+    show_full_result_count = False
 
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('version__refbook')
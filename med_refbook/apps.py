@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MedRefbookConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'med_refbook'
+
+    def ready(self):
+        from . import instrumentation, signals  # noqa: F401
@@ -0,0 +1,182 @@
+"""Асинхронные варианты эндпоинтов чтения для запуска под ASGI.
+
+Синхронные ``APIView`` под ASGI выполняются в пуле потоков, что ограничивает
+число одновременно обрабатываемых запросов. Эти представления выполняются
+в цикле событий: ответы из внутрипроцессных кэшей (индекс элементов, текущие
+версии) не требуют переключения потоков, а обращения к БД идут через
+асинхронный ORM. Ответы совпадают с ответами синхронных эндпоинтов."""
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views import View
+from rest_framework.exceptions import APIException, NotFound
+
+from .caching import aget_or_load
+from .http_cache import (is_historical, make_etag, not_modified,
+                         set_cache_headers, version_etag)
+from .index import element_index
+from .models import Element, Refbook, Version
+from .precompressed import compressed_response, requested_encoding
+from .renderers import FastJSONRenderer
+from .resolvers import current_version_resolver
+from .revisions import refbook_revisions
+from .routers import primary_reads, replica_reads
+from .streaming import streaming_response
+from .views import (BAD_MATCH, MATCH_EXACT, MATCH_MODES, MATCH_NORMALIZED,
+                    NO_ELEMENTS, REFBOOKS_CACHE_TIMEOUT, arequested_version,
+                    decode_cursor, page_document, page_limit,
+                    parse_filter_date, parse_flag, refbooks_cache_key,
+                    refbooks_on, validate_stream_format)
+
+# Формат рендерера, входящий в ETag синхронных эндпоинтов
+RENDERER_FORMAT = FastJSONRenderer.format
+
+
+def json_response(data, status=200):
+    return HttpResponse(FastJSONRenderer().render(data), status=status,
+                        content_type=FastJSONRenderer.media_type)
+
+
+class AsyncAPIView(View):
+    """Асинхронное представление с ответами об ошибках в формате DRF;
+    чтение идёт из реплики БД, если она настроена."""
+    http_method_names = ['get', 'head', 'options']
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            with replica_reads():
+                return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            data = exc.detail if isinstance(exc.detail, (list, dict)) else {
+                'detail': exc.detail}
+            return json_response(data, status=exc.status_code)
+
+
+class AsyncRefbookList(AsyncAPIView):
+    """Асинхронный вариант ``RefbookList``."""
+
+    async def get(self, request, *args, **kwargs):
+        filter_date = parse_filter_date(request.GET.get('date'))
+        include_current = parse_flag(request.GET, 'include_current')
+        revision, last_modified = await refbook_revisions.acatalog()
+        etag = make_etag(revision, filter_date, include_current,
+                         RENDERER_FORMAT)
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            async def load():
+                with primary_reads():
+                    return {'refbooks': [
+                        refbook async for refbook in refbooks_on(
+                            filter_date, include_current)]}
+
+            response = json_response(await aget_or_load(
+                refbooks_cache_key(revision, filter_date, include_current),
+                load, REFBOOKS_CACHE_TIMEOUT))
+        return set_cache_headers(response, etag, last_modified)
+
+
+class AsyncElementList(AsyncAPIView):
+    """Асинхронный вариант ``ElementList``."""
+
+    async def get(self, request, id, *args, **kwargs):
+        version_param = request.GET.get('version')
+        version = await arequested_version(id, version_param)
+        encoding = requested_encoding(request, version, RENDERER_FORMAT)
+        etag = version_etag(version, RENDERER_FORMAT,
+                            *filter(None, [encoding]))
+        last_modified = version.updated_at.timestamp()
+        historical = bool(version_param) and is_historical(
+            version, await current_version_resolver.aresolve(id))
+        response = not_modified(request, etag, last_modified)
+        if response is None and encoding:
+            # Чтение файла (и его создание при первом запросе) - в потоке
+            response = await sync_to_async(compressed_response)(version,
+                                                                encoding)
+        if response is None:
+            response = await self._elements(request, version)
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return set_cache_headers(response, etag, last_modified, historical)
+
+    @staticmethod
+    async def _elements(request, version):
+        elements = Element.objects.materialized(version)
+        stream_format = request.GET.get('stream')
+        if stream_format:
+            validate_stream_format(stream_format)
+            if not await elements.aexists():
+                raise NotFound(NO_ELEMENTS)
+            # Тело читается после выхода из dispatch: БД выбирается сейчас
+            return streaming_response(stream_format, 'elements',
+                                      _ordered_elements(version,
+                                                        Element.objects.db))
+        if 'limit' in request.GET or 'cursor' in request.GET:
+            limit = page_limit(request.GET)
+            cursor = request.GET.get('cursor')
+            page = Element.objects.ordered_pairs(
+                version, decode_cursor(cursor) if cursor else None)
+            rows = [row async for row in page[:limit + 1]]
+            return json_response(page_document(rows, limit, cursor))
+        rows = [row async for row in elements.values_list('code', 'value')]
+        if not rows:
+            raise NotFound(NO_ELEMENTS)
+        return json_response({'elements': [{'code': code, 'value': value}
+                                           for code, value in rows]})
+
+
+async def _ordered_elements(version, using, page_size=2000):
+    """Элементы версии в порядке кодов, читаемые из БД ``using`` страницами
+    по курсору.
+
+    ``aiterator()`` в Django 4.2 выполняет запрос ``values_list`` синхронно,
+    поэтому каждая страница читается отдельным асинхронным запросом."""
+    after = None
+    while True:
+        page = Element.objects.using(using).ordered_pairs(
+            version, after)[:page_size]
+        rows = [row async for row in page]
+        for code, value in rows:
+            yield {'code': code, 'value': value}
+        if len(rows) < page_size:
+            return
+        after = rows[-1][0]
+
+
+class AsyncCheckElement(AsyncAPIView):
+    """Асинхронный вариант ``CheckElement``."""
+
+    async def get(self, request, id, *args, **kwargs):
+        code = request.GET.get('code')
+        value = request.GET.get('value')
+        version_name = request.GET.get('version')
+        match = request.GET.get('match', MATCH_EXACT)
+        if not code or not value:
+            return json_response(
+                {"detail": "Параметры 'code' и 'value' обязательны."},
+                status=400)
+        if match not in MATCH_MODES:
+            return json_response(BAD_MATCH, status=400)
+        if version_name:
+            elements = await element_index.alookup(id, version_name) if (
+                match == MATCH_EXACT) else None
+            if elements is not None:
+                return json_response({"exists": (code, value) in elements})
+            latest_version = None
+        else:
+            latest_version = await current_version_resolver.aresolve(id)
+        if not latest_version:
+            refbook = await Refbook.objects.filter(pk=id).afirst()
+            if not refbook:
+                raise NotFound({"detail": "Справочник не найден."})
+            if version_name:
+                latest_version = await Version.objects.filter(
+                    refbook=refbook, version=version_name).afirst()
+        if not latest_version:
+            raise NotFound(
+                {"detail": "Не найдено валидной версии справочника."})
+        if match == MATCH_NORMALIZED:
+            element_exists = await Element.objects.normalized_match(
+                latest_version, code, value).aexists()
+        else:
+            element_exists = await element_index.acontains(latest_version,
+                                                           code, value)
+        return json_response({"exists": element_exists})
@@ -0,0 +1,98 @@
+"""Общий для процессов кэш: ключи версий и объединение одновременных
+промахов.
+
+Бэкенд кэша задаётся ``MED_REFBOOK_CACHE_URL`` (см. ``core/settings.py``).
+Ключи данных версии включают её идентификатор и отпечаток содержимого, поэтому
+после изменения версии старые записи просто перестают читаться и истекают.
+
+Одновременные промахи по одному ключу (в том числе в разных процессах)
+объединяются блокировкой в самом кэше: ``cache.add`` ключа блокировки
+успешен только у одного загрузчика, остальные ждут появления значения, но не
+дольше ``LOCK_TIMEOUT``, после чего загружают его сами.
+
+Объединение надёжно только у бэкендов с атомарным ``add`` (locmem, memcached,
+redis). У файлового кэша (``file://``) ``add`` проверяет и записывает файл
+раздельно: одновременные промахи нескольких процессов могут загрузить
+значение каждый сам. Результат от этого не меняется, но при многих процессах
+с одним файловым кэшем нагрузка на БД при промахах выше - для них следует
+использовать memcached или redis.
+
+Бэкенд может не сохранить значение без ошибки (memcached не хранит записи
+больше 1 МБ): тогда каждый промах загружает значение заново. Команда
+``warm_refbook_cache`` проверяет сохранение чтением и сообщает о таких
+записях."""
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+LOCK_TIMEOUT = getattr(settings, 'MED_REFBOOK_CACHE_LOCK_TIMEOUT', 30)
+POLL_INTERVAL = 0.05
+
+# Время хранения в общем кэше элементов версий для индексов процессов;
+# 0 - не хранить (единственный процесс с локальным кэшем)
+ELEMENTS_CACHE_TIMEOUT = getattr(settings,
+                                 'MED_REFBOOK_ELEMENTS_CACHE_TIMEOUT', 0)
+
+
+def version_key(version, *parts):
+    """Ключ кэша данных версии справочника."""
+    return ':'.join(map(str, ('med_refbook:version', version.pk,
+                              version.fingerprint, *parts)))
+
+
+def elements_key(version):
+    return version_key(version, 'elements')
+
+
+def get_or_load(key, load, timeout):
+    """Значение из кэша или, при промахе, результат ``load()`` (не
+    ``None``), сохранённый в кэш на ``timeout`` секунд."""
+    value = cache.get(key)
+    if value is not None:
+        return value
+    lock_key = f'{key}:lock'
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while not (locked := cache.add(lock_key, True, LOCK_TIMEOUT)):
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(POLL_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    try:
+        # Значение могли сохранить между первой проверкой и блокировкой
+        value = cache.get(key)
+        if value is None:
+            value = load()
+            cache.set(key, value, timeout)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
+
+
+async def aget_or_load(key, load, timeout):
+    """Асинхронный ``get_or_load``; ``load`` - асинхронная функция."""
+    value = await cache.aget(key)
+    if value is not None:
+        return value
+    lock_key = f'{key}:lock'
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while not (locked := await cache.aadd(lock_key, True, LOCK_TIMEOUT)):
+        if time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(POLL_INTERVAL)
+        value = await cache.aget(key)
+        if value is not None:
+            return value
+    try:
+        value = await cache.aget(key)
+        if value is None:
+            value = await load()
+            await cache.aset(key, value, timeout)
+    finally:
+        if locked:
+            await cache.adelete(lock_key)
+    return value
@@ -0,0 +1,74 @@
+"""Журнал изменений справочников для инкрементальной синхронизации.
+
+События пишутся в той же транзакции, что и изменение (сигналы моделей,
+пакетные изменения элементов и пакетный импорт). Чтобы номера событий
+возрастали в порядке фиксации транзакций и клиент, прочитавший ленту до
+номера N, не пропустил событие с меньшим номером, запись событий в
+PostgreSQL сериализуется транзакционной advisory-блокировкой; SQLite
+сериализует запись сам."""
+from django.db import connection, transaction
+
+from .models import ChangeEvent
+
+# Ключ advisory-блокировки записи журнала
+LOCK_KEY = 0x6d65645f7265  # 'med_re'
+
+
+def record(events):
+    """Запись событий в журнал в транзакции изменения: сохранение моделей и
+    пакетные изменения элементов выполняются вместе с сигналами в одной
+    транзакции, поэтому событие фиксируется или откатывается вместе с
+    изменением. Вне транзакции события пишутся в новой."""
+    events = list(events)
+    if not events:
+        return
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                               [LOCK_KEY])
+        ChangeEvent.objects.bulk_create(events)
+
+
+def refbook_event(refbook, action):
+    return ChangeEvent(
+        entity=ChangeEvent.REFBOOK, action=action, refbook_id=refbook.pk,
+        code=refbook.code,
+        data={'code': refbook.code, 'name': refbook.name,
+              'description': refbook.description})
+
+
+def version_event(version, action):
+    return ChangeEvent(
+        entity=ChangeEvent.VERSION, action=action,
+        refbook_id=version.refbook_id, version_id=version.pk,
+        data={'version': version.version,
+              'date_start': version.date_start.isoformat()})
+
+
+def element_event(refbook_id, version_id, code, value, action):
+    return ChangeEvent(
+        entity=ChangeEvent.ELEMENT, action=action, refbook_id=refbook_id,
+        version_id=version_id, code=code, data={'value': value})
+
+
+def content_change_event(refbook_id, version_id, before, after):
+    """Событие изменения элемента в содержимом версии по парам (код,
+    значение) до и после изменения (``None`` - элемента нет)."""
+    if before is None:
+        return element_event(refbook_id, version_id, *after,
+                             ChangeEvent.CREATED)
+    if after is None:
+        return element_event(refbook_id, version_id, *before,
+                             ChangeEvent.DELETED)
+    return element_event(refbook_id, version_id, *after, ChangeEvent.UPDATED)
+
+
+def changes_since(since, limit, refbook_id=None):
+    """События с номером больше ``since`` по возрастанию номеров."""
+    events = ChangeEvent.objects.filter(id__gt=since)
+    if refbook_id is not None:
+        events = events.filter(refbook_id=refbook_id)
+    return events.order_by('id').values(
+        'id', 'created_at', 'entity', 'action', 'refbook_id', 'version_id',
+        'code', 'data')[:limit]
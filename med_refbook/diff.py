@@ -0,0 +1,52 @@
+from django.db.models import CharField, Exists, F, OuterRef, Q, Subquery, Value
+
+from .models import Element
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+def version_changes(old_version, new_version):
+    """Отличия версии ``new_version`` от ``old_version`` одним запросом.
+
+    Возвращает queryset кортежей (код, прежнее значение, новое значение),
+    упорядоченных по коду: у добавленных элементов прежнее значение
+    ``None``, у удалённых - новое. Обе части запроса - поиск по индексу
+    (версия, код), поэтому его можно читать потоково через ``iterator()``.
+    Версии, хранящие изменения, сравниваются по их полному содержимому."""
+    old = Element.objects.materialized(old_version)
+    new = Element.objects.materialized(new_version)
+    added_or_changed = new.annotate(
+        previous_value=Subquery(
+            old.filter(code=OuterRef('code')).values('value')[:1]),
+        current_value=F('value'),
+    ).filter(
+        Q(previous_value__isnull=True) | ~Q(previous_value=F('value'))
+    ).values_list('code', 'previous_value', 'current_value')
+    removed = old.filter(
+        ~Exists(new.filter(code=OuterRef('code')))
+    ).annotate(
+        previous_value=F('value'),
+        current_value=Value(None, output_field=CharField()),
+    ).values_list('code', 'previous_value', 'current_value')
+    return added_or_changed.union(removed, all=True).order_by('code')
+
+
+def change_record(code, previous_value, current_value):
+    """Описание одного изменения для потоковой выдачи."""
+    if previous_value is None:
+        return {'change': ADDED, 'code': code, 'value': current_value}
+    if current_value is None:
+        return {'change': REMOVED, 'code': code, 'value': previous_value}
+    return {'change': CHANGED, 'code': code, 'value': current_value,
+            'previous_value': previous_value}
+
+
+def diff_document(changes):
+    """Изменения, сгруппированные по виду: added, removed, changed."""
+    document = {ADDED: [], REMOVED: [], CHANGED: []}
+    for code, previous_value, current_value in changes:
+        record = change_record(code, previous_value, current_value)
+        document[record.pop('change')].append(record)
+    return document
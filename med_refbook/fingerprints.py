@@ -0,0 +1,30 @@
+"""Отпечатки содержимого версий справочников.
+
+Отпечаток версии - сумма по модулю 2**128 хэшей пар (код, значение) её
+элементов. Он не зависит от порядка элементов и пересчитывается при записи
+за O(1): добавление элемента прибавляет его хэш, удаление - вычитает."""
+import hashlib
+
+MODULUS = 1 << 128
+
+EMPTY = '0' * 32
+
+
+def element_hash(code, value):
+    digest = hashlib.blake2b(f'{code}\0{value}'.encode(), digest_size=16)
+    return int.from_bytes(digest.digest(), 'big')
+
+
+def update(fingerprint, added=(), removed=()):
+    """Отпечаток после добавления и удаления пар (код, значение)."""
+    total = int(fingerprint, 16)
+    for code, value in added:
+        total += element_hash(code, value)
+    for code, value in removed:
+        total -= element_hash(code, value)
+    return f'{total % MODULUS:032x}'
+
+
+def compute(pairs):
+    """Отпечаток набора пар (код, значение)."""
+    return update(EMPTY, added=pairs)
@@ -0,0 +1,203 @@
+"""Иерархия элементов справочника: таблица замыкания и запросы к ней.
+
+Родитель элемента задаётся кодом (``Element.parent_code``) в содержимом той
+же версии, поэтому иерархия версии, хранящей изменения, учитывает элементы
+базовой версии. Таблица замыкания (``ElementClosure``) строится для версии
+целиком: при импорте, командой ``build_refbook_hierarchy`` и после
+фиксации пакетных изменений элементов, затрагивающих иерархию (см.
+``signals.py``). Изменение одного элемента версии, хранящей все элементы,
+обновляет таблицу на месте (``relink``): перестраиваются только связи его
+поддерева с предками. Ссылки на отсутствующие в версии коды и циклы
+обрываются: такой элемент считается элементом верхнего уровня."""
+import threading
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+
+from .models import Element, ElementClosure, Version, batches
+
+BATCH_SIZE = 5000
+
+_pending = threading.local()
+
+
+class RebuildBatch:
+    """Версии, перестраиваемые после фиксации одной транзакции."""
+
+    def __init__(self, version_ids=()):
+        self.versions = set(version_ids)
+        self.done = False
+        # Позиция в ``run_on_commit`` соединения: откат снимает обработчики,
+        # зарегистрированные в нём, и все следующие за ними
+        self.position = None
+
+    def run(self):
+        self.done = True
+        for version in Version.objects.filter(pk__in=list(self.versions)):
+            build_closure(version)
+
+    def registered(self, connection):
+        callbacks = connection.run_on_commit
+        return not self.done and self.position < len(callbacks) and (
+            callbacks[self.position][1] == self.run)
+
+
+def closure_rows(pairs):
+    """Строки таблицы замыкания (предок, потомок, глубина) по парам
+    (код, код родителя)."""
+    parents = dict(pairs)
+    for code in parents:
+        seen = {code}
+        parent = parents[code]
+        depth = 1
+        while parent in parents and parent not in seen:
+            yield parent, code, depth
+            seen.add(parent)
+            parent = parents[parent]
+            depth += 1
+
+
+def build_closure(version):
+    """Перестроение таблицы замыкания версии по её содержимому; возвращает
+    число строк."""
+    pairs = Element.objects.materialized(version).values_list(
+        'code', 'parent_code')
+    rows = closure_rows(pairs)
+    count = 0
+    # Отложенное перестроение версии в этой транзакции больше не нужно
+    scheduled = getattr(_pending, 'batch', None)
+    if scheduled is not None:
+        scheduled.versions.discard(version.pk)
+    with transaction.atomic():
+        ElementClosure.objects.filter(version=version).delete()
+        while batch := list(islice(rows, BATCH_SIZE)):
+            ElementClosure.objects.bulk_create(
+                ElementClosure(version=version, ancestor=ancestor,
+                               descendant=descendant, depth=depth)
+                for ancestor, descendant, depth in batch)
+            count += len(batch)
+    return count
+
+
+def schedule_rebuild(version_ids):
+    """Перестроение иерархии версий после фиксации транзакции, по одному
+    разу для версии, сколько бы её элементов ни изменилось.
+
+    Версии копятся в пакете текущей транзакции. После её отката пакет
+    снимается с ``on_commit`` вместе с остальными обработчиками, и
+    следующая транзакция начинает новый пакет, а не перестраивает версии
+    отменённых изменений. Версия, добавленная в пакет из отменённой точки
+    сохранения, перестраивается при фиксации внешней транзакции: лишнее, но
+    безвредное перестроение."""
+    batch = current_batch()
+    if batch is not None:
+        batch.versions.update(version_ids)
+        return
+    batch = _pending.batch = RebuildBatch(version_ids)
+    connection = transaction.get_connection()
+    batch.position = len(connection.run_on_commit)
+    # Вне транзакции пакет выполняется сразу при регистрации
+    transaction.on_commit(batch.run)
+
+
+def current_batch():
+    """Пакет перестроения текущей транзакции или ``None``: пакет уже
+    выполнен или снят с ``on_commit`` откатом."""
+    batch = getattr(_pending, 'batch', None)
+    if batch is None or not batch.registered(transaction.get_connection()):
+        return None
+    return batch
+
+
+def pending(version_id):
+    """Ожидает ли версия перестроения после фиксации текущей транзакции."""
+    batch = current_batch()
+    return batch is not None and version_id in batch.versions
+
+
+def relink(version_id, code):
+    """Обновление таблицы замыкания версии на месте после вставки, удаления
+    или смены родителя одного элемента с кодом ``code``: связи его поддерева
+    (включая элементы, ссылавшиеся на отсутствовавший код) с прежними
+    предками удаляются, с новыми - создаются.
+
+    Возвращает ``False``, если обновить на месте нельзя и версию нужно
+    перестроить целиком: версия связана с другими хранением изменений,
+    иерархия ещё не построена или ожидает перестроения, изменение образует
+    цикл."""
+    if pending(version_id) or Version.objects.filter(
+            Q(pk=version_id, base__isnull=False) | Q(base_id=version_id)
+    ).exists() or not ElementClosure.objects.filter(
+            version_id=version_id).exists():
+        return False
+    closure = ElementClosure.objects.filter(version_id=version_id)
+    elements = Element.objects.filter(version_id=version_id)
+    # Поддерево: дети по коду родителя и их потомки с глубиной от ``code``
+    children = list(elements.filter(parent_code=code).exclude(
+        code=code).values_list('code', flat=True))
+    subtree = dict.fromkeys(children, 1)
+    for batch in batches(children):
+        for descendant, depth in closure.filter(
+                ancestor__in=batch).values_list('descendant', 'depth'):
+            subtree[descendant] = min(subtree.get(descendant, depth + 1),
+                                      depth + 1)
+    parent = elements.filter(code=code).values_list(
+        'parent_code', flat=True).first()
+    ancestors = {}
+    if parent and parent != code and elements.filter(code=parent).exists():
+        ancestors = {parent: 1, **{
+            ancestor: depth + 1 for ancestor, depth in closure.filter(
+                descendant=parent).values_list('ancestor', 'depth')}}
+    if code in subtree or ancestors.keys() & {code, *subtree}:
+        return False
+    previous = {code, *closure.filter(descendant=code).values_list(
+        'ancestor', flat=True)}
+    with transaction.atomic():
+        for batch in batches([code, *subtree]):
+            closure.filter(descendant__in=batch,
+                           ancestor__in=previous).delete()
+        # Удалённый элемент связей не получает: его поддерево остаётся без
+        # прежних предков
+        links = [] if parent is None else [
+            (ancestor, descendant, depth + below)
+            for ancestor, depth in [(code, 0), *ancestors.items()]
+            for descendant, below in [(code, 0), *subtree.items()]
+            if ancestor != descendant]
+        ElementClosure.objects.bulk_create(
+            [ElementClosure(version_id=version_id, ancestor=ancestor,
+                            descendant=descendant, depth=depth)
+             for ancestor, descendant, depth in links],
+            batch_size=BATCH_SIZE)
+    return True
+
+
+def ancestors(version, code):
+    """Предки элемента от верхнего уровня до родителя: кортежи (код,
+    значение, код родителя)."""
+    links = ElementClosure.objects.filter(version_id=version.pk,
+                                          descendant=code)
+    return Element.objects.materialized(version).filter(
+        code__in=links.values('ancestor')
+    ).annotate(
+        depth=Subquery(links.filter(ancestor=OuterRef('code')).values(
+            'depth')[:1])
+    ).order_by('-depth').values_list('code', 'value', 'parent_code')
+
+
+def descendants(version, code, after=None):
+    """Все потомки элемента в порядке кодов, начиная с кода, следующего за
+    ``after``: кортежи (код, значение, код родителя)."""
+    links = ElementClosure.objects.filter(version_id=version.pk,
+                                          ancestor=code)
+    if after is not None:
+        links = links.filter(descendant__gt=after)
+    return Element.objects.materialized(version).filter(
+        code__in=links.values('descendant')
+    ).order_by('code').values_list('code', 'value', 'parent_code')
+
+
+def is_descendant(version, code, ancestor):
+    """Входит ли элемент ``code`` в поддерево элемента ``ancestor``."""
+    return ElementClosure.objects.filter(
+        version_id=version.pk, ancestor=ancestor, descendant=code).exists()
@@ -0,0 +1,115 @@
+"""Условные запросы (ETag, Last-Modified), заголовки Cache-Control и
+выдача файлов по частям (Range)."""
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date
+
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+FILE_CHUNK_SIZE = 64 * 1024
+
+CURRENT_MAX_AGE = getattr(settings, 'MED_REFBOOK_CURRENT_MAX_AGE', 300)
+HISTORICAL_MAX_AGE = getattr(settings, 'MED_REFBOOK_HISTORICAL_MAX_AGE',
+                             31536000)
+
+
+def make_etag(*parts):
+    """Сильный ETag из составляющих представления ресурса."""
+    digest = hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def version_etag(version, *variant):
+    """ETag представления элементов версии по отпечатку её содержимого."""
+    return make_etag(version.pk, version.fingerprint, *variant)
+
+
+def is_historical(version, current):
+    """Версия устарела: начала действовать раньше текущей версии."""
+    return current is not None and version.date_start < current.date_start
+
+
+def not_modified(request, etag, last_modified):
+    """Ответ 304 (или 412), если у клиента актуальное представление."""
+    return get_conditional_response(request, etag=etag,
+                                    last_modified=int(last_modified))
+
+
+def set_cache_headers(response, etag, last_modified, historical=False):
+    """Валидаторы и Cache-Control: устаревшие версии не меняются и
+    кэшируются надолго, текущие - на ``MED_REFBOOK_CURRENT_MAX_AGE``."""
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(int(last_modified))
+    if historical:
+        patch_cache_control(response, public=True,
+                            max_age=HISTORICAL_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=CURRENT_MAX_AGE)
+    return response
+
+
+def byte_range(request, size, etag):
+    """Запрошенный диапазон байт ``(начало, конец)`` включительно.
+
+    ``None`` - отдать файл целиком: заголовка Range нет, он не подходит под
+    формат одного диапазона или If-Range не совпадает с ``etag``. Для
+    недостижимого диапазона возвращается ``False``."""
+    header = request.META.get('HTTP_RANGE', '').strip()
+    if_range = request.META.get('HTTP_IF_RANGE')
+    match = BYTE_RANGE.match(header)
+    if not match or not any(match.groups()) or (
+            if_range is not None and if_range != etag):
+        return None
+    start, end = match.groups()
+    if not start:
+        length = int(end)
+        if not length or not size:
+            return False
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def file_response(request, path, content_type, filename, etag):
+    """Ответ с файлом целиком (200) или его частью (206) по заголовку
+    Range; ``FileNotFoundError`` - файл удалён до открытия.
+
+    Размер берётся у открытого файла: файл могут удалить или заменить
+    (``os.replace``) в любой момент, а открытый остаётся прежним."""
+    file = open(path, 'rb')
+    size = os.fstat(file.fileno()).st_size
+    requested = byte_range(request, size, etag)
+    if requested is False:
+        file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    start, end = requested or (0, size - 1)
+    file.seek(start)
+    response = StreamingHttpResponse(
+        _file_chunks(file, end - start + 1), content_type=content_type,
+        status=206 if requested else 200)
+    if requested:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(end - start + 1)
+    response['Content-Disposition'] = content_disposition_header(
+        as_attachment=True, filename=filename)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _file_chunks(file, length):
+    with file:
+        while length > 0:
+            chunk = file.read(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
@@ -0,0 +1,167 @@
+"""Потоковое чтение элементов справочника из файлов CSV, JSON и XML.
+
+Каждый читатель возвращает итератор словарей с ключами ``code``, ``value``
+и ``parent`` (код родительского элемента иерархического справочника или
+``None``) и никогда не держит в памяти весь файл."""
+import csv
+import json
+import re
+from xml.etree import ElementTree
+
+FORMATS = ('csv', 'json', 'xml')
+
+CHUNK_SIZE = 1 << 16
+
+# Предельный размер одного элемента JSON-массива в символах
+MAX_ELEMENT_SIZE = 1 << 20
+
+_ELEMENTS_OBJECT = re.compile(r'\{\s*"elements"\s*:\s*\[')
+
+
+class ImportFormatError(ValueError):
+    """Файл не соответствует ожидаемому формату."""
+
+
+def detect_format(path):
+    """Формат файла по расширению (``.ndjson``/``.jsonl`` - это JSON)."""
+    extension = str(path).rsplit('.', 1)[-1].lower()
+    if extension in ('ndjson', 'jsonl'):
+        return 'json'
+    return extension if extension in FORMATS else None
+
+
+def read_elements(file, file_format, delimiter=','):
+    """Итератор элементов из открытого файла заданного формата."""
+    if file_format == 'csv':
+        return read_csv(file, delimiter=delimiter)
+    if file_format == 'json':
+        return read_json(file)
+    return read_xml(file)
+
+
+def read_csv(file, delimiter=','):
+    """CSV с заголовком, содержащим столбцы ``code`` и ``value`` и,
+    необязательно, ``parent``."""
+    reader = csv.DictReader(file, delimiter=delimiter)
+    if reader.fieldnames is None or not {'code', 'value'} <= set(
+            reader.fieldnames):
+        raise ImportFormatError(
+            "В заголовке CSV нет столбцов 'code' и 'value'.")
+    for row in reader:
+        yield {'code': row['code'], 'value': row['value'],
+               'parent': row.get('parent')}
+
+
+def read_json(file):
+    """JSON-массив объектов, документ ``{"elements": [...]}`` в формате
+    ответа API или JSON Lines (по объекту на строку)."""
+    buffer = file.read(CHUNK_SIZE)
+    # Начало документа должно целиком попасть в буфер
+    while len(buffer.lstrip()) < 64:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+    start = len(buffer) - len(buffer.lstrip())
+    if buffer[start:start + 1] == '[':
+        yield from _read_json_array(file, buffer, start + 1)
+        return
+    match = _ELEMENTS_OBJECT.match(buffer, start)
+    if match:
+        yield from _read_json_array(file, buffer, match.end())
+        return
+    yield from _read_json_lines(file, buffer)
+
+
+def _read_json_array(file, buffer, pos):
+    decoder = json.JSONDecoder()
+    expect_value = True
+    first = True
+    while True:
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos == len(buffer):
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                raise ImportFormatError('Неожиданный конец JSON-массива.')
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        if buffer[pos] == ']' and (not expect_value or first):
+            return
+        if not expect_value:
+            if buffer[pos] != ',':
+                raise ImportFormatError(
+                    f'Ожидалась запятая в JSON-массиве: {buffer[pos]!r}.')
+            pos += 1
+            expect_value = True
+            continue
+        try:
+            obj, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Объект мог не поместиться в буфер целиком: дочитываем файл,
+            # но не дальше разумного размера одного элемента
+            chunk = file.read(CHUNK_SIZE) if len(
+                buffer) - pos < MAX_ELEMENT_SIZE else ''
+            if not chunk:
+                raise ImportFormatError('Некорректный элемент JSON-массива.')
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield _json_element(obj)
+        pos = end
+        expect_value = first = False
+
+
+def _read_json_lines(file, buffer):
+    lines = iter(file)
+    tail = buffer.split('\n')
+    rest = tail.pop()
+    for line in tail:
+        if line.strip():
+            yield _json_element(_loads(line))
+    for line in lines:
+        rest += line
+        if rest.endswith('\n'):
+            if rest.strip():
+                yield _json_element(_loads(rest))
+            rest = ''
+    if rest.strip():
+        yield _json_element(_loads(rest))
+
+
+def _loads(line):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as error:
+        raise ImportFormatError(f'Некорректная строка JSON Lines: {error}.')
+
+
+def _json_element(obj):
+    if not isinstance(obj, dict):
+        raise ImportFormatError('Элемент должен быть JSON-объектом.')
+    return {'code': obj.get('code'), 'value': obj.get('value'),
+            'parent': obj.get('parent')}
+
+
+def read_xml(file):
+    """XML, в котором каждый элемент - тег ``<element>`` с атрибутами или
+    дочерними тегами ``code``, ``value`` и (необязательно) ``parent``."""
+    parents = []
+    try:
+        for event, node in ElementTree.iterparse(file,
+                                                 events=('start', 'end')):
+            if event == 'start':
+                parents.append(node)
+                continue
+            parents.pop()
+            if node.tag != 'element':
+                continue
+            yield {
+                'code': node.get('code', node.findtext('code')),
+                'value': node.get('value', node.findtext('value')),
+                'parent': node.get('parent', node.findtext('parent')),
+            }
+            # Прочитанный элемент больше не нужен
+            if parents:
+                parents[-1].remove(node)
+    except ElementTree.ParseError as error:
+        raise ImportFormatError(f'Некорректный XML: {error}.')
@@ -0,0 +1,216 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import caching
+from .models import Element
+from .revisions import find_version, refbook_revisions
+from .routers import primary_reads
+
+
+class ElementIndex:
+    """Внутрипроцессный индекс элементов справочников.
+
+    Для каждой версии справочника хранит множество пар (код, значение), что
+    позволяет отвечать на проверку наличия элемента без обращения к БД.
+    Версии загружаются лениво при первом обращении. Суммарное число пар в
+    индексе ограничено бюджетом ``max_elements``: при его превышении
+    вытесняются версии, к которым дольше всего не обращались (LRU).
+
+    Вместе с данными версии хранится её отпечаток: перед выдачей он
+    сверяется с ревизией справочника (см. ``revisions``), поэтому изменения,
+    сделанные другими процессами или в обход сигналов, не остаются в индексе
+    дольше ``MED_REFBOOK_REVALIDATE_INTERVAL`` секунд.
+
+    Одновременные промахи по одной версии в потоках процесса загружают её
+    один раз. При ``MED_REFBOOK_ELEMENTS_CACHE_TIMEOUT`` больше 0 пары версии
+    берутся из общего кэша, так что процессы читают версию из БД однократно
+    (см. ``caching``)."""
+
+    def __init__(self, max_elements):
+        self.max_elements = max_elements
+        self._entries = OrderedDict()  # version_id -> результат build()
+        self._keys = {}  # (refbook_id, version) -> version_id
+        self._names = {}  # version_id -> (refbook_id, version)
+        self._fingerprints = {}  # version_id -> отпечаток загруженных данных
+        self._loading = {}  # version_id -> блокировка загрузки версии
+        self._size = 0
+        self._epoch = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """Число пар (код, значение) во всех загруженных версиях."""
+        return self._size
+
+    def lookup(self, refbook_id, version):
+        """Элементы версии по идентификатору справочника и имени версии.
+
+        Обращается только к уже загруженным данным: если версия не
+        загружена или её отпечаток разошёлся с ревизией справочника (см.
+        ``revisions``), возвращает ``None``. Запрос к БД выполняется, только
+        если ревизию пора перепроверить."""
+        with self._lock:
+            version_id = self._keys.get((refbook_id, version))
+        if version_id is None:
+            return None
+        return self._valid(version_id, find_version(
+            refbook_revisions.get(refbook_id), version_id), version)
+
+    async def alookup(self, refbook_id, version):
+        """Асинхронный ``lookup``."""
+        with self._lock:
+            version_id = self._keys.get((refbook_id, version))
+        if version_id is None:
+            return None
+        return self._valid(version_id, find_version(
+            await refbook_revisions.aget(refbook_id), version_id),
+            version)
+
+    def peek(self, version):
+        """Элементы версии, если она уже загружена и не изменилась, иначе
+        ``None``."""
+        with self._lock:
+            if version.pk not in self._entries:
+                return None
+        return self._valid(version.pk, refbook_revisions.current(version))
+
+    def get(self, version):
+        """Элементы версии; при отсутствии в индексе загружаются из БД."""
+        version = refbook_revisions.current(version) or version
+        elements = self._valid(version.pk, version)
+        if elements is not None:
+            return elements
+        with self._lock:
+            loading = self._loading.setdefault(version.pk, threading.Lock())
+        try:
+            with loading:
+                elements = self._valid(version.pk, version)
+                if elements is not None:
+                    return elements
+                with self._lock:
+                    epoch = self._epoch
+                elements = self.build(self._load(version))
+                self._put(version, elements, epoch)
+                return elements
+        finally:
+            with self._lock:
+                if self._loading.get(version.pk) is loading:
+                    del self._loading[version.pk]
+
+    async def aget(self, version):
+        """Асинхронный ``get``: загрузка через асинхронный ORM."""
+        version = await refbook_revisions.acurrent(version) or version
+        elements = self._valid(version.pk, version)
+        if elements is not None:
+            return elements
+        with self._lock:
+            epoch = self._epoch
+        elements = self.build(await self._aload(version))
+        self._put(version, elements, epoch)
+        return elements
+
+    def contains(self, version, code, value):
+        """Проверка наличия элемента с кодом и значением в версии."""
+        return (code, value) in self.get(version)
+
+    async def acontains(self, version, code, value):
+        return (code, value) in await self.aget(version)
+
+    def invalidate(self, version_id):
+        """Удаление версии из индекса (при изменении версии или элементов)."""
+        with self._lock:
+            self._epoch += 1
+            self._discard(version_id)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._keys.clear()
+            self._names.clear()
+            self._fingerprints.clear()
+            self._size = 0
+
+    @staticmethod
+    def build(pairs):
+        """Данные версии в индексе по её парам (код, значение); размер
+        данных для бюджета индекса - ``len()`` результата."""
+        return frozenset(pairs)
+
+    @staticmethod
+    def _pairs(version):
+        return Element.objects.materialized(version).values_list('code',
+                                                                 'value')
+
+    def _load(self, version):
+        # Отпечаток версии прочитан из основной БД (см. revisions), данные
+        # читаются оттуда же: отстающая реплика могла бы отдать под новым
+        # отпечатком прежнее содержимое
+        with primary_reads():
+            if not caching.ELEMENTS_CACHE_TIMEOUT:
+                return list(self._pairs(version))
+            return caching.get_or_load(caching.elements_key(version),
+                                       lambda: list(self._pairs(version)),
+                                       caching.ELEMENTS_CACHE_TIMEOUT)
+
+    async def _aload(self, version):
+        async def load():
+            return [pair async for pair in self._pairs(version)]
+
+        with primary_reads():
+            if not caching.ELEMENTS_CACHE_TIMEOUT:
+                return await load()
+            return await caching.aget_or_load(
+                caching.elements_key(version), load,
+                caching.ELEMENTS_CACHE_TIMEOUT)
+
+    def _valid(self, version_id, current, name=None):
+        """Загруженные данные версии, если они соответствуют её текущему
+        состоянию ``current``; устаревшие данные удаляются из индекса."""
+        with self._lock:
+            elements = self._entries.get(version_id)
+            if elements is None:
+                return None
+            if (current is None
+                    or name is not None and current.version != name
+                    or self._fingerprints[version_id] != current.fingerprint):
+                self._discard(version_id)
+                return None
+            self._entries.move_to_end(version_id)
+            return elements
+
+    def _put(self, version, elements, epoch):
+        with self._lock:
+            # Пока шла загрузка, данные могли измениться: такой результат
+            # отдаём вызывающему, но в индекс не кладём.
+            if epoch == self._epoch and len(elements) <= self.max_elements:
+                self._store(version, elements)
+
+    def _store(self, version, elements):
+        self._discard(version.pk)
+        key = (version.refbook_id, version.version)
+        self._entries[version.pk] = elements
+        self._keys[key] = version.pk
+        self._names[version.pk] = key
+        self._fingerprints[version.pk] = version.fingerprint
+        self._size += len(elements)
+        while self._size > self.max_elements:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, version_id):
+        elements = self._entries.pop(version_id, None)
+        if elements is not None:
+            self._size -= len(elements)
+        self._fingerprints.pop(version_id, None)
+        key = self._names.pop(version_id, None)
+        if key is not None:
+            self._keys.pop(key, None)
+
+
+element_index = ElementIndex(
+    max_elements=getattr(settings, 'MED_REFBOOK_INDEX_MAX_ELEMENTS', 1000000))
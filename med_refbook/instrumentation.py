@@ -0,0 +1,356 @@
+"""Измерение запросов к api: число и время запросов к БД, время
+сериализации, размер ответа и полное время обработки по эндпоинтам.
+
+Измеряется выборка запросов с долей ``MED_REFBOOK_METRICS_SAMPLE_RATE``
+(по умолчанию 0 - измерение выключено и промежуточный слой сразу передаёт
+запрос дальше). Для измеренных запросов добавляется заголовок
+``Server-Timing`` (если не выключен ``MED_REFBOOK_SERVER_TIMING``), а
+накопленные в процессе значения отдаются эндпоинтом ``/metrics`` в
+текстовом формате Prometheus - только адресам из
+``MED_REFBOOK_METRICS_ALLOWED_IPS`` или по токену
+``MED_REFBOOK_METRICS_TOKEN``. Счётчики относятся только к выборке: оценка
+полного числа запросов - значение счётчика, делённое на долю выборки
+(метрика ``med_refbook_metrics_sample_rate``)."""
+import ipaddress
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+SAMPLE_RATE = getattr(settings, 'MED_REFBOOK_METRICS_SAMPLE_RATE', 0.0)
+SERVER_TIMING = getattr(settings, 'MED_REFBOOK_SERVER_TIMING', True)
+
+# Адреса и сети, которым доступен /metrics, и токен доступа с любого адреса
+# (заголовок ``Authorization: Bearer <токен>``; пусто - доступ только по
+# адресу)
+METRICS_ALLOWED_NETWORKS = [ipaddress.ip_network(network) for network in
+                            getattr(settings, 'MED_REFBOOK_METRICS_ALLOWED_IPS',
+                                    ['127.0.0.1', '::1'])]
+METRICS_TOKEN = getattr(settings, 'MED_REFBOOK_METRICS_TOKEN', '')
+
+METRICS_VIEW_NAME = 'metrics'
+UNMATCHED = 'unmatched'
+
+# Верхние границы корзин гистограммы времени обработки запроса, в секундах
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_current_sample = ContextVar('med_refbook_request_sample', default=None)
+
+
+def sampled():
+    """Измерять ли очередной запрос."""
+    return SAMPLE_RATE > 0 and (SAMPLE_RATE >= 1
+                                or random.random() < SAMPLE_RATE)
+
+
+class RequestSample:
+    """Измерения одного запроса.
+
+    Пока выборка установлена текущей (``measuring``), запросы ко всем БД
+    учитываются обёрткой ``count_query``."""
+
+    __slots__ = ('started', 'queries', 'db_time', 'serialization_time',
+                 'response_bytes')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.response_bytes = 0
+
+    def count(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Значение заголовка ``Server-Timing`` (длительности в мс)."""
+        return (f'db;dur={self.db_time * 1000:.2f};'
+                f'desc="{self.queries} queries", '
+                f'serialize;dur={self.serialization_time * 1000:.2f}, '
+                f'total;dur={self.elapsed() * 1000:.2f}')
+
+
+def count_query(execute, sql, params, many, context):
+    """Обёртка выполнения запросов каждого соединения с БД: учитывает
+    запрос в текущей выборке.
+
+    Выборка передаётся через контекстную переменную, поэтому учитываются и
+    запросы асинхронных представлений, выполняемые ``sync_to_async`` в
+    других потоках со своими соединениями, и запросы к реплике."""
+    sample = _current_sample.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    return sample.count(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+@contextmanager
+def measuring(sample):
+    """Выборка ``sample`` - текущая в этом контексте."""
+    token = _current_sample.set(sample)
+    try:
+        yield
+    finally:
+        _current_sample.reset(token)
+
+
+@contextmanager
+def timed_serialization():
+    """Учёт времени сериализации ответа в измеряемом запросе."""
+    sample = _current_sample.get()
+    if sample is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        sample.serialization_time += time.perf_counter() - started
+
+
+class EndpointStats:
+    __slots__ = ('requests', 'queries', 'db_time', 'serialization_time',
+                 'response_bytes', 'duration', 'buckets')
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.response_bytes = 0
+        self.duration = 0.0
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+
+
+class MetricsRegistry:
+    """Накопленные измерения по эндпоинтам в пределах процесса.
+
+    Ключ - имя маршрута, HTTP-метод и код ответа."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, method, status, sample, duration):
+        with self._lock:
+            stats = self._stats.get((endpoint, method, status))
+            if stats is None:
+                stats = self._stats[endpoint, method, status] = \
+                    EndpointStats()
+            stats.requests += 1
+            stats.queries += sample.queries
+            stats.db_time += sample.db_time
+            stats.serialization_time += sample.serialization_time
+            stats.response_bytes += sample.response_bytes
+            stats.duration += duration
+            stats.buckets[bisect_left(DURATION_BUCKETS, duration)] += 1
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus."""
+        with self._lock:
+            stats = sorted((key, _copy(value))
+                           for key, value in self._stats.items())
+        lines = [
+            '# HELP med_refbook_metrics_sample_rate Доля измеряемых '
+            'запросов.',
+            '# TYPE med_refbook_metrics_sample_rate gauge',
+            f'med_refbook_metrics_sample_rate {_number(SAMPLE_RATE)}',
+        ]
+        counters = (
+            ('requests_total', 'Измеренные запросы.', 'requests'),
+            ('db_queries_total', 'Запросы к БД.', 'queries'),
+            ('db_duration_seconds_total', 'Время запросов к БД.', 'db_time'),
+            ('serialization_duration_seconds_total',
+             'Время сериализации ответов.', 'serialization_time'),
+            ('response_bytes_total', 'Размер тел ответов.',
+             'response_bytes'),
+        )
+        for name, description, field in counters:
+            lines += [f'# HELP med_refbook_{name} {description}',
+                      f'# TYPE med_refbook_{name} counter']
+            lines += [f'med_refbook_{name}{{{_labels(*key)}}} '
+                      f'{_number(getattr(value, field))}'
+                      for key, value in stats]
+        name = 'med_refbook_request_duration_seconds'
+        lines += [f'# HELP {name} Время обработки запросов.',
+                  f'# TYPE {name} histogram']
+        for key, value in stats:
+            labels = _labels(*key)
+            total = 0
+            for bound, count in zip(DURATION_BUCKETS + ('+Inf',),
+                                    value.buckets):
+                total += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} '
+                             f'{total}')
+            lines += [f'{name}_sum{{{labels}}} {_number(value.duration)}',
+                      f'{name}_count{{{labels}}} {value.requests}']
+        return '\n'.join(lines) + '\n'
+
+
+def _copy(stats):
+    copy = EndpointStats()
+    for field in EndpointStats.__slots__:
+        setattr(copy, field, getattr(stats, field))
+    copy.buckets = list(stats.buckets)
+    return copy
+
+
+def _labels(endpoint, method, status):
+    endpoint = endpoint.replace('\\', '\\\\').replace('"', '\\"')
+    return f'endpoint="{endpoint}",method="{method}",status="{status}"'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = MetricsRegistry()
+
+
+def endpoint_name(request):
+    match = request.resolver_match
+    return match.view_name if match and match.view_name else UNMATCHED
+
+
+class InstrumentationMiddleware:
+    """Промежуточный слой измерения запросов; подключается первым в
+    ``MIDDLEWARE``, чтобы учитывать запросы к БД всех слоёв."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not sampled():
+            return self.get_response(request)
+        sample = RequestSample()
+        with measuring(sample):
+            response = self.get_response(request)
+        return self._finish(request, response, sample)
+
+    async def __acall__(self, request):
+        if not sampled():
+            return await self.get_response(request)
+        sample = RequestSample()
+        with measuring(sample):
+            response = await self.get_response(request)
+        return self._finish(request, response, sample)
+
+    @staticmethod
+    def _finish(request, response, sample):
+        endpoint = endpoint_name(request)
+        if endpoint == METRICS_VIEW_NAME:
+            return response
+        if SERVER_TIMING:
+            response['Server-Timing'] = sample.server_timing()
+
+        def record():
+            metrics.record(endpoint, request.method, response.status_code,
+                           sample, sample.elapsed())
+
+        if response.streaming:
+            # Тело потокового ответа формируется после выхода из
+            # промежуточного слоя: измерение завершается с концом потока
+            response.streaming_content = _measured_stream(
+                response, sample, record)
+        else:
+            sample.response_bytes = len(response.content)
+            record()
+        return response
+
+
+def _measured_stream(response, sample, record):
+    # Выборка текущая только на время получения очередной части тела: между
+    # частями контекст принадлежит серверу
+    content = response.streaming_content
+    if response.is_async:
+        async def measured():
+            chunks = aiter(content)
+            try:
+                while True:
+                    with measuring(sample):
+                        try:
+                            chunk = await anext(chunks)
+                        except StopAsyncIteration:
+                            return
+                    sample.response_bytes += len(chunk)
+                    yield chunk
+            finally:
+                record()
+    else:
+        def measured():
+            chunks = iter(content)
+            try:
+                while True:
+                    with measuring(sample):
+                        try:
+                            chunk = next(chunks)
+                        except StopIteration:
+                            return
+                    sample.response_bytes += len(chunk)
+                    yield chunk
+            finally:
+                record()
+    return measured()
+
+
+def metrics_allowed(request):
+    """Доступен ли ``/metrics``: по токену или по адресу клиента.
+
+    Адрес берётся из ``REMOTE_ADDR``: за обратным прокси в список
+    разрешённых попадает адрес прокси, поэтому метрики следует закрывать
+    на нём или использовать токен."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(
+        ' ')
+    if METRICS_TOKEN and scheme.lower() == 'bearer' and constant_time_compare(
+            token.strip(), METRICS_TOKEN):
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    """Накопленные метрики процесса в формате Prometheus."""
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(),
+                        content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,39 @@
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from med_refbook.schema import (SCHEMA_DIR, generate_schema,
+                                render_schema_json, schema_path,
+                                supported_language)
+
+
+class Command(BaseCommand):
+    help = ('Сборка схемы OpenAPI в файлы schema.<язык>.json при сборке '
+            'образа: процессы сервиса читают их из MED_REFBOOK_SCHEMA_DIR '
+            'вместо построения схемы.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', default=SCHEMA_DIR,
+                            help='Каталог схем (по умолчанию '
+                                 'MED_REFBOOK_SCHEMA_DIR)')
+        parser.add_argument('--lang', action='append',
+                            help='Язык схемы (можно указать несколько раз; '
+                                 'по умолчанию LANGUAGE_CODE)')
+
+    def handle(self, *args, **options):
+        if not options['output_dir']:
+            raise CommandError('Укажите --output-dir или '
+                               'MED_REFBOOK_SCHEMA_DIR.')
+        directory = Path(options['output_dir'])
+        directory.mkdir(parents=True, exist_ok=True)
+        for lang in options['lang'] or [settings.LANGUAGE_CODE]:
+            if supported_language(lang) != lang:
+                raise CommandError(f'Язык {lang} не поддерживается.')
+            started = time.perf_counter()
+            path = schema_path(directory, lang)
+            path.write_bytes(render_schema_json(generate_schema(lang)))
+            self.stdout.write(self.style.SUCCESS(
+                f'{path}: {path.stat().st_size} байт '
+                f'({time.perf_counter() - started:.1f} с)'))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from med_refbook.hierarchy import build_closure
+from med_refbook.models import Refbook
+
+
+class Command(BaseCommand):
+    help = ('Перестроение таблицы замыкания иерархии элементов версий '
+            'справочника по кодам родителей. Импорт и изменения элементов '
+            'перестраивают иерархию сами; команда нужна после загрузки '
+            'данных в обход них (например, SQL).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--refbook', required=True,
+                            help='Код справочника')
+        parser.add_argument('--refbook-version',
+                            help='Версия справочника (по умолчанию все '
+                                 'версии)')
+
+    def handle(self, *args, **options):
+        refbook = Refbook.objects.filter(code=options['refbook']).first()
+        if refbook is None:
+            raise CommandError(f"Справочник {options['refbook']} не найден.")
+        versions = refbook.versions.order_by('date_start')
+        if options['refbook_version']:
+            versions = versions.filter(version=options['refbook_version'])
+            if not versions:
+                raise CommandError(
+                    f"Версия {options['refbook_version']} не найдена.")
+        for version in versions:
+            started = time.perf_counter()
+            count = build_closure(version)
+            self.stdout.write(self.style.SUCCESS(
+                f'Версия {version.version}: {count} связей иерархии '
+                f'({time.perf_counter() - started:.1f} с)'))
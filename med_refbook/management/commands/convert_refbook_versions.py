@@ -0,0 +1,158 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from med_refbook.diff import version_changes
+from med_refbook.models import Element, Refbook, Version
+
+DELTA = 'delta'
+FULL = 'full'
+
+
+class Command(BaseCommand):
+    help = ('Перевод версий справочника между полным хранением элементов и '
+            'хранением только изменений относительно базовой версии. '
+            'Содержимое версий и их отпечатки при этом не меняются.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--refbook', required=True,
+                            help='Код справочника')
+        parser.add_argument('--refbook-version',
+                            help='Версия справочника (по умолчанию все '
+                                 'версии в порядке дат начала)')
+        parser.add_argument('--to', choices=(DELTA, FULL), required=True,
+                            help='Способ хранения: delta - только изменения, '
+                                 'full - все элементы')
+        parser.add_argument('--base',
+                            help='Базовая версия для хранения изменений (по '
+                                 'умолчанию ближайшая более ранняя версия, '
+                                 'хранящая все элементы)')
+        parser.add_argument('--max-change-ratio', type=float, default=0.1,
+                            help='Не переводить версию, если изменений больше '
+                                 'этой доли элементов базовой версии')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только показать результат перевода')
+
+    def handle(self, *args, **options):
+        self.options = options
+        refbook = Refbook.objects.filter(code=options['refbook']).first()
+        if refbook is None:
+            raise CommandError(f"Справочник {options['refbook']} не найден.")
+        versions = refbook.versions.order_by('date_start')
+        if options['refbook_version']:
+            versions = versions.filter(version=options['refbook_version'])
+            if not versions:
+                raise CommandError(
+                    f"Версия {options['refbook_version']} не найдена.")
+        for version in versions:
+            if options['to'] == DELTA:
+                self._to_delta(version)
+            else:
+                self._to_full(version)
+
+    def _to_delta(self, version):
+        if version.base_id is not None:
+            return
+        if version.deltas.exists():
+            self._report(version, 'пропущена: служит базовой версией')
+            return
+        base = self._base(version)
+        if base is None:
+            self._report(version, 'пропущена: нет базовой версии')
+            return
+        # Отличия версий считаются по значениям, без кодов родителей
+        if Element.objects.filter(version_id__in=[version.pk, base.pk]).exclude(
+                parent_code='').exists():
+            self._report(version, 'пропущена: иерархический справочник')
+            return
+        base_size = Element.objects.filter(version=base).count()
+        limit = int(base_size * self.options['max_change_ratio'])
+        changes = []
+        for code, previous_value, current_value in version_changes(
+                base, version).iterator(chunk_size=self.options['batch_size']):
+            if len(changes) == limit:
+                self._report(version, 'пропущена: изменений больше '
+                                      f'{limit} элементов')
+                return
+            changes.append(Element(
+                version=version, code=code,
+                value=previous_value if current_value is None
+                else current_value,
+                removed=current_value is None))
+        size = Element.objects.filter(version=version).count()
+        self._report(version, f'{size} -> {len(changes)} элементов, '
+                              f'базовая версия {base.version}')
+        if self.options['dry_run']:
+            return
+        with transaction.atomic():
+            self._delete(version)
+            Element.objects.untracked().bulk_create(
+                changes, batch_size=self.options['batch_size'])
+            version.base = base
+            version.save(update_fields=['base', 'updated_at'])
+
+    def _to_full(self, version):
+        if version.base_id is None:
+            return
+        own = Element.objects.filter(version=version)
+        base_rows = Element.objects.filter(version_id=version.base_id).exclude(
+            code__in=own.values('code')).order_by('code')
+        self._report(version, f'{own.count()} -> '
+                              f'{Element.objects.materialized(version).count()}'
+                              ' элементов')
+        if self.options['dry_run']:
+            return
+        batch_size = self.options['batch_size']
+        with transaction.atomic():
+            # Постранично по коду: скопированные элементы получают коды не
+            # больше последнего прочитанного и не влияют на следующие страницы
+            last_code = None
+            while True:
+                page = base_rows if last_code is None else base_rows.filter(
+                    code__gt=last_code)
+                rows = list(page.values_list('code', 'value', 'parent_code')[
+                    :batch_size])
+                if not rows:
+                    break
+                Element.objects.untracked().bulk_create(
+                    Element(version=version, code=code, value=value,
+                            parent_code=parent_code)
+                    for code, value, parent_code in rows)
+                last_code = rows[-1][0]
+            self._delete(version, removed_only=True)
+            version.base = None
+            version.save(update_fields=['base', 'updated_at'])
+
+    def _base(self, version):
+        if self.options['base']:
+            base = Version.objects.filter(
+                refbook_id=version.refbook_id,
+                version=self.options['base']).first()
+            if base is None:
+                raise CommandError(
+                    f"Базовая версия {self.options['base']} не найдена.")
+            if base.base_id is not None or base.pk == version.pk:
+                raise CommandError('Базовая версия должна хранить все '
+                                   'элементы и отличаться от переводимой.')
+            return base
+        return Version.objects.filter(
+            refbook_id=version.refbook_id, base__isnull=True,
+            date_start__lt=version.date_start).order_by('-date_start').first()
+
+    @staticmethod
+    def _delete(version, removed_only=False):
+        """Удаление элементов версии одним запросом, без сигналов: содержимое
+        версии после перевода не меняется."""
+        quote = connection.ops.quote_name
+        meta = Element._meta
+        sql = (f'DELETE FROM {quote(meta.db_table)} '
+               f"WHERE {quote(meta.get_field('version').column)} = %s")
+        params = [version.pk]
+        if removed_only:
+            sql += f" AND {quote(meta.get_field('removed').column)} = %s"
+            params.append(True)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _report(self, version, message):
+        self.stdout.write(f'{version.version}: {message}')
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from med_refbook.models import Refbook, Version
+from med_refbook.resolvers import current_version_resolver
+from med_refbook.snapshots import ensure_snapshot, write_snapshot
+
+
+class Command(BaseCommand):
+    help = ('Выгрузка версии справочника в двоичный снимок. Без --output '
+            'снимок сохраняется в кэш снимков (MED_REFBOOK_SNAPSHOT_DIR), '
+            'откуда его отдаёт эндпоинт /refbooks/<id>/snapshot.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--refbook', required=True,
+                            help='Код справочника')
+        parser.add_argument('--refbook-version',
+                            help='Версия справочника (по умолчанию текущая)')
+        parser.add_argument('--output', help='Путь к файлу снимка')
+
+    def handle(self, *args, **options):
+        refbook = Refbook.objects.filter(code=options['refbook']).first()
+        if refbook is None:
+            raise CommandError(f"Справочник {options['refbook']} не найден.")
+        if options['refbook_version']:
+            version = Version.objects.filter(
+                refbook=refbook, version=options['refbook_version']).first()
+            if version is None:
+                raise CommandError(
+                    f"Версия {options['refbook_version']} не найдена.")
+        else:
+            version = current_version_resolver.resolve(refbook.pk)
+            if version is None:
+                raise CommandError('У справочника нет текущей версии.')
+        started = time.perf_counter()
+        if options['output']:
+            path = write_snapshot(version, options['output'])
+        else:
+            path = ensure_snapshot(version)
+        self.stdout.write(self.style.SUCCESS(
+            f'Версия {version.version}: {path} '
+            f'({path.stat().st_size} байт, '
+            f'{time.perf_counter() - started:.1f} с)'))
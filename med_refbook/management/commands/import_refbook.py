@@ -0,0 +1,170 @@
+import sys
+import time
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_date
+
+from med_refbook import hierarchy
+from med_refbook.importers import (FORMATS, ImportFormatError, detect_format,
+                                   read_elements)
+from med_refbook.models import Element, Refbook, Version
+
+
+class DryRunRollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Импорт новой версии справочника из файла CSV, JSON или XML. '
+            'Файл читается потоково, элементы добавляются пакетами в одной '
+            'транзакции. Для иерархических справочников у элементов '
+            'указывается код родителя (parent), иерархия версии строится '
+            'после импорта.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Путь к файлу или '-' для stdin")
+        parser.add_argument('--refbook', required=True,
+                            help='Код справочника')
+        parser.add_argument('--name',
+                            help='Наименование справочника: если указано, '
+                                 'отсутствующий справочник будет создан')
+        parser.add_argument('--refbook-version', required=True,
+                            help='Версия справочника')
+        parser.add_argument('--date-start', required=True,
+                            help='Дата начала действия версии, ГГГГ-ММ-ДД')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='Формат файла (по умолчанию по расширению)')
+        parser.add_argument('--delimiter', default=',',
+                            help='Разделитель CSV')
+        parser.add_argument('--encoding', default='utf-8')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Размер пакета bulk_create')
+        parser.add_argument('--progress-every', type=int, default=50000,
+                            help='Печатать прогресс каждые N строк '
+                                 '(0 - не печатать)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только проверить файл, ничего не сохраняя')
+
+    def handle(self, *args, **options):
+        date_start = parse_date(options['date_start'] or '')
+        if not date_start:
+            raise CommandError('Неверный формат даты. Ожидается ГГГГ-ММ-ДД.')
+        if options['batch_size'] < 1:
+            raise CommandError('Размер пакета должен быть положительным.')
+        file_format = options['format'] or detect_format(options['path'])
+        if not file_format:
+            raise CommandError('Не удалось определить формат файла, '
+                               'укажите --format.')
+        self.options = options
+        self.dry_run = options['dry_run']
+        started = time.perf_counter()
+        with self._open(options['path'], file_format) as file:
+            rows = read_elements(file, file_format,
+                                 delimiter=options['delimiter'])
+            try:
+                with transaction.atomic():
+                    version = self._create_version(date_start)
+                    count = self._import(version, rows, started)
+                    if self.dry_run:
+                        raise DryRunRollback
+            except DryRunRollback:
+                pass
+            except ImportFormatError as error:
+                raise CommandError(str(error))
+        elapsed = time.perf_counter() - started
+        action = 'Проверено' if self.dry_run else 'Импортировано'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} элементов: {count} за {elapsed:.1f} с '
+            f'({count / elapsed if elapsed else 0:.0f} строк/с)'))
+
+    def _open(self, path, file_format):
+        # XML читается в двоичном режиме, чтобы учитывать объявленную
+        # в документе кодировку
+        mode = 'rb' if file_format == 'xml' else 'r'
+        if path == '-':
+            # Стандартный ввод не закрываем: он принадлежит процессу
+            return nullcontext(
+                sys.stdin.buffer if mode == 'rb' else sys.stdin)
+        try:
+            if mode == 'rb':
+                return open(path, mode)
+            return open(path, mode, encoding=self.options['encoding'],
+                        newline='')
+        except OSError as error:
+            raise CommandError(f'Не удалось открыть файл: {error}')
+
+    def _create_version(self, date_start):
+        options = self.options
+        refbook = Refbook.objects.filter(code=options['refbook']).first()
+        if refbook is None:
+            if not options['name']:
+                raise CommandError(
+                    f"Справочник {options['refbook']} не найден; для его "
+                    'создания укажите --name.')
+            refbook = Refbook.objects.create(code=options['refbook'],
+                                             name=options['name'])
+        name = options['refbook_version']
+        versions = Version.objects.filter(refbook=refbook)
+        if versions.filter(version=name).exists():
+            raise CommandError(f'Версия {name} уже существует.')
+        if versions.filter(date_start=date_start).exists():
+            raise CommandError(
+                f'Версия с датой начала {date_start} уже существует.')
+        return Version.objects.create(refbook=refbook, version=name,
+                                      date_start=date_start)
+
+    def _import(self, version, rows, started):
+        """Проверка и пакетная вставка элементов; возвращает их число."""
+        code_length = Element._meta.get_field('code').max_length
+        value_length = Element._meta.get_field('value').max_length
+        batch_size = self.options['batch_size']
+        progress_every = self.options['progress_every']
+        codes = set()
+        hierarchical = False
+        batch = []
+        count = 0
+        for number, row in enumerate(rows, start=1):
+            code, value = row['code'], row['value']
+            parent = row.get('parent') or ''
+            if not isinstance(code, str) or not code:
+                raise CommandError(f'Строка {number}: не указан код.')
+            if not isinstance(value, str) or not value:
+                raise CommandError(f'Строка {number}: не указано значение.')
+            if not isinstance(parent, str) or parent == code:
+                raise CommandError(
+                    f'Строка {number}: некорректный код родителя.')
+            if (len(code) > code_length or len(value) > value_length
+                    or len(parent) > code_length):
+                raise CommandError(
+                    f'Строка {number}: код или значение длиннее '
+                    f'{code_length}/{value_length} символов.')
+            if code in codes:
+                raise CommandError(
+                    f'Строка {number}: код {code} повторяется в версии.')
+            codes.add(code)
+            count = number
+            if not self.dry_run:
+                batch.append(Element(version=version, code=code, value=value,
+                                     parent_code=parent))
+                hierarchical = hierarchical or bool(parent)
+                if len(batch) >= batch_size:
+                    self._insert(version, batch)
+                    batch = []
+            if progress_every and number % progress_every == 0:
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'{number} строк, {number / elapsed:.0f} строк/с')
+        if batch:
+            self._insert(version, batch)
+        if hierarchical:
+            closure_size = hierarchy.build_closure(version)
+            self.stdout.write(f'Связей иерархии: {closure_size}')
+        return count
+
+    @staticmethod
+    def _insert(version, batch):
+        # Отпечаток версии и журнал изменений обновляет bulk_create
+        # (см. ElementQuerySet)
+        Element.objects.bulk_create(batch)
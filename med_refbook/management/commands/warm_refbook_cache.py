@@ -0,0 +1,96 @@
+import pickle
+import time
+
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from med_refbook import caching
+from med_refbook.models import Element, Refbook, Version
+from med_refbook.resolvers import versions_on_dates
+from med_refbook.revisions import refbook_revisions
+from med_refbook.views import refbook_list_document, refbooks_cache_key
+
+
+class Command(BaseCommand):
+    help = ('Прогрев общего кэша при развёртывании: список справочников на '
+            'сегодня и элементы текущих версий, чтобы процессы сервиса '
+            'загружали их из кэша, а не из БД.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--refbook', action='append',
+                            help='Код справочника (можно указать несколько '
+                                 'раз; по умолчанию все справочники)')
+        parser.add_argument('--all-versions', action='store_true',
+                            help='Прогреть все версии, а не только текущие')
+
+    def handle(self, *args, **options):
+        if isinstance(cache, LocMemCache):
+            self.stderr.write(self.style.WARNING(
+                'Кэш в памяти процесса (locmem://): прогрев не виден '
+                'процессам сервиса, задайте MED_REFBOOK_CACHE_URL.'))
+        elif isinstance(cache, FileBasedCache):
+            self.stderr.write(self.style.WARNING(
+                'Файловый кэш (file://): одновременные промахи разных '
+                'процессов не объединяются, каждый из них читает БД.'))
+        refbooks = Refbook.objects.order_by('code')
+        if options['refbook']:
+            refbooks = refbooks.filter(code__in=options['refbook'])
+            missing = set(options['refbook']) - {
+                refbook.code for refbook in refbooks}
+            if missing:
+                raise CommandError(
+                    f"Справочники не найдены: {', '.join(sorted(missing))}.")
+        today = now().date()
+        revision, _ = refbook_revisions.catalog()
+        not_stored = []
+        for include_current in (False, True):
+            document = refbook_list_document(revision, today, include_current)
+            if not cache.has_key(refbooks_cache_key(revision, today,
+                                                    include_current)):
+                not_stored.append((f'Список справочников на {today}',
+                                   document))
+        if not not_stored:
+            self.stdout.write(
+                f'Список справочников на {today} загружен в кэш.')
+        if not caching.ELEMENTS_CACHE_TIMEOUT:
+            self.stdout.write('Элементы версий не хранятся в общем кэше '
+                              '(MED_REFBOOK_ELEMENTS_CACHE_TIMEOUT=0).')
+            versions = []
+        elif options['all_versions']:
+            versions = Version.objects.filter(
+                refbook__in=refbooks).order_by('refbook__code', 'date_start')
+        else:
+            resolved = versions_on_dates(
+                (refbook.pk, today) for refbook in refbooks)
+            versions = sorted(
+                (version for version in resolved.values() if version),
+                key=lambda version: version.refbook_id)
+        for version in versions:
+            started = time.perf_counter()
+            key = caching.elements_key(version)
+            pairs = caching.get_or_load(
+                key, lambda: list(Element.objects.materialized(
+                    version).values_list('code', 'value')),
+                caching.ELEMENTS_CACHE_TIMEOUT)
+            name = (f'Справочник {version.refbook_id}, версия '
+                    f'{version.version}')
+            # Бэкенд может не сохранить запись без ошибки (memcached - записи
+            # больше 1 МБ), поэтому сохранение проверяется чтением
+            if not cache.has_key(key):
+                not_stored.append((name, pairs))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'{name}: {len(pairs)} элементов '
+                f'({time.perf_counter() - started:.1f} с)'))
+        for name, value in not_stored:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            self.stderr.write(self.style.WARNING(
+                f'{name}: не сохранено в кэше ({size / 2 ** 20:.1f} МБ), '
+                'вероятно, запись больше предельного размера бэкенда '
+                '(у memcached - 1 МБ, параметр -I).'))
+        if not_stored:
+            raise CommandError(
+                f'Не сохранено в кэше записей: {len(not_stored)}.')
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-17 15:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('med_refbook', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='element',
+            name='version',
+            field=models.ForeignKey(db_index=False, help_text='Идентификатор версии справочника', on_delete=django.db.models.deletion.CASCADE, related_name='elements', to='med_refbook.version', verbose_name='Версия справочника'),
+        ),
+        migrations.AlterField(
+            model_name='version',
+            name='refbook',
+            field=models.ForeignKey(db_index=False, help_text='Идентификатор справочника', on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='med_refbook.refbook', verbose_name='Справочник'),
+        ),
+        migrations.AddIndex(
+            model_name='element',
+            index=models.Index(fields=['version', 'code', 'value'], name='element_version_code_value_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='version',
+            index=models.Index(fields=['refbook', '-date_start', 'version'], name='version_current_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.7 on 2026-10-17 15:54
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def compute_fingerprints(apps, schema_editor):
+    # Копия med_refbook.fingerprints.compute на момент миграции: миграция
+    # не должна зависеть от текущего кода приложения
+    Version = apps.get_model('med_refbook', 'Version')
+    Element = apps.get_model('med_refbook', 'Element')
+    for version in Version.objects.only('pk').iterator():
+        total = 0
+        for code, value in Element.objects.filter(
+                version_id=version.pk).values_list('code', 'value').iterator():
+            digest = hashlib.blake2b(f'{code}\0{value}'.encode(),
+                                     digest_size=16)
+            total += int.from_bytes(digest.digest(), 'big')
+        version.fingerprint = f'{total % (1 << 128):032x}'
+        version.save(update_fields=['fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('med_refbook', '0002_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refbook',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, help_text='Дата и время последнего изменения справочника', verbose_name='Изменён'),
+        ),
+        migrations.AddField(
+            model_name='version',
+            name='fingerprint',
+            field=models.CharField(default='00000000000000000000000000000000', editable=False, help_text='Отпечаток содержимого версии, обновляется при изменении элементов', max_length=32, verbose_name='Отпечаток'),
+        ),
+        migrations.AddField(
+            model_name='version',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, help_text='Дата и время последнего изменения версии или её элементов', verbose_name='Изменена'),
+        ),
+        migrations.RunPython(compute_fingerprints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.7 on 2026-10-17 15:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('med_refbook', '0003_version_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='element',
+            name='removed',
+            field=models.BooleanField(default=False, help_text='Элемент базовой версии удалён в этой версии (только для версий, хранящих изменения)', verbose_name='Удалён'),
+        ),
+        migrations.AddField(
+            model_name='version',
+            name='base',
+            field=models.ForeignKey(blank=True, editable=False, help_text='Версия, относительно которой хранятся только изменения; пусто - версия хранит все элементы', null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='deltas', to='med_refbook.version', verbose_name='Базовая версия'),
+        ),
+    ]
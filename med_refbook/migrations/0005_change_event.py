@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-17 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('med_refbook', '0004_delta_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeEvent',
+            fields=[
+                ('id', models.BigAutoField(help_text='Номер события, возрастает в порядке фиксации изменений', primary_key=True, serialize=False, verbose_name='Номер события')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='Время записи события', verbose_name='Время')),
+                ('entity', models.CharField(choices=[('refbook', 'Справочник'), ('version', 'Версия'), ('element', 'Элемент')], help_text='Тип изменённого объекта', max_length=10, verbose_name='Объект')),
+                ('action', models.CharField(choices=[('created', 'Создание'), ('updated', 'Изменение'), ('deleted', 'Удаление')], help_text='Вид изменения', max_length=10, verbose_name='Действие')),
+                ('refbook_id', models.IntegerField(help_text='Идентификатор справочника', verbose_name='Справочник')),
+                ('version_id', models.IntegerField(blank=True, help_text='Идентификатор версии справочника (для версий и элементов)', null=True, verbose_name='Версия')),
+                ('code', models.CharField(blank=True, help_text='Код справочника или элемента', max_length=100, verbose_name='Код')),
+                ('data', models.JSONField(default=dict, help_text='Состояние объекта после изменения (для удаления - до него)', verbose_name='Данные')),
+            ],
+            options={
+                'verbose_name': 'Событие журнала изменений',
+                'verbose_name_plural': 'Журнал изменений',
+                'indexes': [models.Index(fields=['refbook_id', 'id'], name='change_event_refbook_idx')],
+            },
+        ),
+    ]
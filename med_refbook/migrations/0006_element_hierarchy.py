@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-17 17:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('med_refbook', '0005_change_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='element',
+            name='parent_code',
+            field=models.CharField(blank=True, help_text='Код родительского элемента в иерархическом справочнике; пусто - элемент верхнего уровня', max_length=100, verbose_name='Код родителя'),
+        ),
+        migrations.CreateModel(
+            name='ElementClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ancestor', models.CharField(help_text='Код элемента-предка', max_length=100, verbose_name='Предок')),
+                ('descendant', models.CharField(help_text='Код элемента-потомка', max_length=100, verbose_name='Потомок')),
+                ('depth', models.PositiveIntegerField(help_text='Расстояние от предка до потомка (1 - родитель)', verbose_name='Глубина')),
+                ('version', models.ForeignKey(db_index=False, help_text='Идентификатор версии справочника', on_delete=django.db.models.deletion.CASCADE, related_name='closure', to='med_refbook.version', verbose_name='Версия справочника')),
+            ],
+            options={
+                'verbose_name': 'Связь иерархии элементов',
+                'verbose_name_plural': 'Иерархия элементов',
+                'indexes': [models.Index(fields=['version', 'descendant', 'depth'], name='closure_descendant_idx')],
+                'unique_together': {('version', 'ancestor', 'descendant')},
+            },
+        ),
+    ]
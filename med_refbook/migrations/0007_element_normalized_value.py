@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-17 17:38
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+def normalize_value(value):
+    # Копия med_refbook.normalization.normalize_value на момент миграции:
+    # миграция не должна зависеть от текущего кода приложения
+    value = unicodedata.normalize('NFKC', value).lower().replace('ё', 'е')
+    return ' '.join(value.split())[:300]
+
+
+def fill_normalized_values(apps, schema_editor, batch_size=5000):
+    Element = apps.get_model('med_refbook', 'Element')
+    batch = []
+    for element in Element.objects.only('pk', 'value').iterator(
+            chunk_size=batch_size):
+        element.normalized_value = normalize_value(element.value)
+        batch.append(element)
+        if len(batch) == batch_size:
+            Element.objects.bulk_update(batch, ['normalized_value'])
+            batch = []
+    Element.objects.bulk_update(batch, ['normalized_value'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('med_refbook', '0006_element_hierarchy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='element',
+            name='normalized_value',
+            field=models.CharField(blank=True, editable=False, help_text='Значение без различий в регистре, пробелах и «ё»/«е»; заполняется при сохранении элемента', max_length=300, verbose_name='Нормализованное значение'),
+        ),
+        migrations.RunPython(fill_normalized_values,
+                             migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='element',
+            index=models.Index(fields=['version', 'code', 'normalized_value'], name='element_normalized_value_idx'),
+        ),
+    ]
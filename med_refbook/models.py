@@ -1,8 +1,72 @@
-from django.db import models
+from contextlib import contextmanager
+
+from django.core.exceptions import ValidationError
+from django.db import NotSupportedError, models, router, transaction
+from django.dispatch import Signal
 from django.utils.translation import gettext_lazy as _
 
+from .fingerprints import EMPTY
+from .normalization import MAX_LENGTH, normalize_value
+
+
+# Пакетные изменения элементов (bulk_create, update, bulk_update, delete) не
+# отправляют сигналов модели (delete отправляет, но их обработчики его
+# пропускают). Вместо них в той же транзакции отправляются
+# сигналы с затронутыми парами (версия, код) - до изменения и после него, с
+# общим словарём ``state``; обработчики пересчитывают отпечатки версий,
+# пишут журнал изменений и сбрасывают кэши (см. signals.py)
+elements_changing = Signal()
+elements_changed = Signal()
+
+# Поля элемента, от которых зависит содержимое версий
+CONTENT_FIELDS = frozenset({'version', 'version_id', 'code', 'value',
+                            'parent_code', 'removed'})
+
+# Поля, определяющие пару (версия, код) элемента, и поля, изменение которых
+# может затронуть состав версий или иерархию
+KEY_FIELDS = frozenset({'version', 'version_id', 'code'})
+STRUCTURE_FIELDS = CONTENT_FIELDS - {'value'}
+
+# Размер пакета для условий ``__in`` по кодам и идентификаторам
+IN_BATCH_SIZE = 500
+
+
+def batches(items, size=IN_BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class AtomicSaveMixin:
+    """Сохранение вместе с обработчиками сигналов в одной транзакции.
+
+    Обработчики ``post_save`` пишут журнал изменений и пересчитывают
+    отпечатки: без общей транзакции в режиме автофиксации запись и событие
+    фиксировались бы отдельно, и сбой между ними терял бы событие. Удаление
+    уже выполняется с сигналами в транзакции (``Collector.delete``)."""
+
+    def save(self, *args, using=None, **kwargs):
+        using = using or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, using=using, **kwargs)
+
 
-class Refbook(models.Model):
+class RefbookQuerySet(models.QuerySet):
+    def with_version_on(self, day):
+        """Справочники с версией, действующей на дату ``day``, и датой её
+        начала (``current_version``, ``current_version_date_start``; ``None``
+        - такой версии нет), вычисленными в том же запросе."""
+        versions = Version.objects.filter(
+            refbook=models.OuterRef('pk'), date_start__lte=day
+        ).order_by('-date_start')
+        return self.annotate(
+            current_version=models.Subquery(versions.values('version')[:1]),
+            current_version_date_start=models.Subquery(
+                versions.values('date_start')[:1]),
+        )
+
+
+class Refbook(AtomicSaveMixin, models.Model):
     """Справочник"""
     id = models.AutoField(
         primary_key=True,
@@ -27,6 +91,13 @@ class Refbook(models.Model):
         verbose_name='Описание',
         help_text='Описание справочника'
     )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Изменён',
+        help_text='Дата и время последнего изменения справочника'
+    )
+
+    objects = RefbookQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.name} ({self.code})'
@@ -36,7 +107,7 @@ class Refbook(models.Model):
         verbose_name_plural = _('Справочники')
 
 
-class Version(models.Model):
+class Version(AtomicSaveMixin, models.Model):
     """Версия справочника"""
     id = models.AutoField(
         primary_key=True,
@@ -47,6 +118,7 @@ class Version(models.Model):
         Refbook,
         on_delete=models.CASCADE,
         related_name='versions',
+        db_index=False,
         verbose_name='Справочник',
         help_text='Идентификатор справочника'
     )
@@ -60,6 +132,30 @@ class Version(models.Model):
         verbose_name='Дата начала версии',
         help_text='Дата начала действия версии'
     )
+    base = models.ForeignKey(
+        'self',
+        on_delete=models.RESTRICT,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='deltas',
+        verbose_name='Базовая версия',
+        help_text='Версия, относительно которой хранятся только изменения; '
+                  'пусто - версия хранит все элементы'
+    )
+    fingerprint = models.CharField(
+        max_length=32,
+        default=EMPTY,
+        editable=False,
+        verbose_name='Отпечаток',
+        help_text='Отпечаток содержимого версии, обновляется при изменении '
+                  'элементов'
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Изменена',
+        help_text='Дата и время последнего изменения версии или её элементов'
+    )
 
     def __str__(self):
         return f'{self.refbook.name} - Версия {self.version}'
@@ -71,9 +167,214 @@ class Version(models.Model):
             ('refbook', 'version'),
             ('refbook', 'date_start')
         )
+        # Покрывающий индекс для поиска текущей версии справочника;
+        # отдельный индекс внешнего ключа не нужен - его заменяют
+        # составные индексы, начинающиеся с refbook
+        indexes = [
+            models.Index(fields=['refbook', '-date_start', 'version'],
+                         name='version_current_idx'),
+        ]
 
 
-class Element(models.Model):
+class ElementQuerySet(models.QuerySet):
+    def materialized(self, version):
+        """Элементы версии с учётом способа её хранения.
+
+        Версия с базовой версией хранит только изменения: добавленные и
+        изменённые элементы, а также отметки об удалении. Её содержимое -
+        собственные элементы без отметок плюс элементы базовой версии с
+        кодами, которых нет среди собственных."""
+        if version.base_id is None:
+            return self.filter(version_id=version.pk)
+        own = Element.objects.filter(version_id=version.pk,
+                                     code=models.OuterRef('code'))
+        # Условие на обе версии сразу позволяет выбирать строки по индексу
+        return self.filter(
+            version_id__in=[version.pk, version.base_id]
+        ).filter(
+            models.Q(version_id=version.pk, removed=False)
+            | models.Q(version_id=version.base_id)
+            & ~models.Exists(own)
+        )
+
+    def ordered_pairs(self, version, after=None):
+        """Пары (код, значение) содержимого версии в порядке кодов, начиная
+        с кода, следующего за ``after``.
+
+        Для версии, хранящей изменения, собственные и базовые элементы
+        читаются двумя упорядоченными по индексу частями UNION ALL, которые
+        СУБД сливает без сортировки всего содержимого версии."""
+        after = {'code__gt': after} if after is not None else {}
+        if version.base_id is None:
+            return self.filter(version_id=version.pk, **after).order_by(
+                'code').values_list('code', 'value')
+        own = self.filter(version_id=version.pk, removed=False, **after)
+        base = self.filter(version_id=version.base_id, **after).exclude(
+            models.Exists(Element.objects.filter(
+                version_id=version.pk, code=models.OuterRef('code'))))
+        return own.values_list('code', 'value').union(
+            base.values_list('code', 'value'), all=True).order_by('code')
+
+    def normalized_match(self, version, code, value):
+        """Элементы содержимого версии с кодом ``code`` и значением, равным
+        ``value`` после нормализации (см. ``normalization``)."""
+        return self.materialized(version).filter(
+            code=code, normalized_value=normalize_value(value))
+
+    # Отключается ``untracked()``
+    _track_content = True
+
+    def untracked(self):
+        """Пакетные изменения без пересчёта отпечатков и сброса кэшей: для
+        перестроения хранения, не меняющего содержимое версий."""
+        clone = self._chain()
+        clone._track_content = False
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._track_content = self._track_content
+        return clone
+
+    @contextmanager
+    def _content_change(self, keys, structure=True, parents=False,
+                        created=()):
+        """Пакетное изменение элементов с парами (версия, код) ``keys`` до
+        и после изменения; ``structure`` - изменение может затронуть состав
+        версий или иерархию, а не только значения, ``parents`` - элементы
+        получают коды родителей, ``created`` - вставляемые элементы."""
+        with transaction.atomic(using=self.db):
+            state = {}
+            elements_changing.send(sender=Element, keys=keys, state=state,
+                                   created=created)
+            yield
+            elements_changed.send(sender=Element, keys=keys, state=state,
+                                  structure=structure, parents=parents)
+
+    @staticmethod
+    def _keys(pks):
+        keys = set()
+        for batch in batches(pks):
+            keys.update(Element.objects.filter(pk__in=batch).values_list(
+                'version_id', 'code'))
+        return keys
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create не вызывает save(): нормализованные значения
+        # заполняются здесь
+        objs = list(objs)
+        for obj in objs:
+            obj.normalized_value = normalize_value(obj.value)
+        if not self._track_content or not objs:
+            return super().bulk_create(objs, *args, **kwargs)
+        # При обработке конфликтов часть строк может не вставиться
+        conflicts = args[1:] or kwargs.get('ignore_conflicts') or kwargs.get(
+            'update_conflicts')
+        with self._content_change(
+                {(obj.version_id, obj.code) for obj in objs},
+                parents=any(obj.parent_code for obj in objs),
+                created=() if conflicts else objs):
+            return super().bulk_create(objs, *args, **kwargs)
+
+    def update(self, **kwargs):
+        # update() не вызывает save(): нормализованные значения заполняются
+        # здесь, если вызывающий код не передал их сам (как bulk_update)
+        value = kwargs.get('value')
+        if 'value' in kwargs and 'normalized_value' not in kwargs:
+            if not hasattr(value, 'resolve_expression'):
+                kwargs['normalized_value'] = normalize_value(value)
+            else:
+                # Значение вычисляет СУБД: нормализуем записанное
+                with transaction.atomic(using=self.db):
+                    pks = list(self.values_list('pk', flat=True))
+                    count = self._update_content(kwargs)
+                    self._normalize(pks)
+                    return count
+        return self._update_content(kwargs)
+
+    update.alters_data = True
+
+    def _update_content(self, kwargs):
+        if not self._track_content or not CONTENT_FIELDS & kwargs.keys():
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            rows = list(self.values_list('pk', 'version_id', 'code'))
+            keys = {row[1:] for row in rows}
+            if KEY_FIELDS & kwargs.keys():
+                keys |= {self._moved_key(key, kwargs) for key in keys}
+            with self._content_change(
+                    keys, structure=bool(STRUCTURE_FIELDS & kwargs.keys()),
+                    parents=bool(kwargs.get('parent_code'))):
+                return super().update(**kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        computed = []
+        if 'value' in fields and 'normalized_value' not in fields:
+            fields = [*fields, 'normalized_value']
+            for obj in objs:
+                if hasattr(obj.value, 'resolve_expression'):
+                    computed.append(obj.pk)
+                else:
+                    obj.normalized_value = normalize_value(obj.value)
+        with transaction.atomic(using=self.db):
+            count = self._bulk_update_content(objs, fields, *args, **kwargs)
+            self._normalize(computed)
+            return count
+
+    def _bulk_update_content(self, objs, fields, *args, **kwargs):
+        if not self._track_content or not CONTENT_FIELDS & set(fields):
+            return super().bulk_update(objs, fields, *args, **kwargs)
+        keys = self._keys([obj.pk for obj in objs]) | {
+            (obj.version_id, obj.code) for obj in objs}
+        with self._content_change(
+                keys, structure=bool(STRUCTURE_FIELDS & set(fields)),
+                parents='parent_code' in fields and any(
+                    obj.parent_code for obj in objs)):
+            # bulk_update выполняет update() по пакетам: пересчёт - здесь
+            return super(ElementQuerySet, self.untracked()).bulk_update(
+                objs, fields, *args, **kwargs)
+
+    def _normalize(self, pks):
+        """Пересчёт нормализованных значений элементов ``pks`` по значениям,
+        записанным в БД."""
+        elements = Element.objects.using(self.db)
+        for batch in batches(pks):
+            elements.bulk_update(
+                [Element(pk=pk, normalized_value=normalize_value(value))
+                 for pk, value in elements.filter(pk__in=batch).values_list(
+                     'pk', 'value')],
+                ['normalized_value'])
+
+    def delete(self):
+        # Обработчики сигналов удаления пропускают удаление через QuerySet
+        # (см. signals.py): пересчёт выполняется один раз для всего пакета
+        if not self._track_content:
+            return super().delete()
+        with transaction.atomic(using=self.db):
+            keys = set(self.values_list('version_id', 'code'))
+            with self._content_change(keys):
+                return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    @staticmethod
+    def _moved_key(key, kwargs):
+        """Пара (версия, код) элемента после ``update(**kwargs)``."""
+        version_id, code = key
+        version = kwargs.get('version', kwargs.get('version_id', version_id))
+        code = kwargs.get('code', code)
+        if hasattr(version, 'resolve_expression') or hasattr(
+                code, 'resolve_expression'):
+            raise NotSupportedError(
+                'Перенос элементов в другую версию или смена их кодов '
+                'выражением не поддерживается: изменение содержимого '
+                'версий нельзя вычислить заранее.')
+        return getattr(version, 'pk', version), code
+
+
+class Element(AtomicSaveMixin, models.Model):
     """Элемент справочника"""
     id = models.AutoField(
         primary_key=True,
@@ -84,6 +385,7 @@ class Element(models.Model):
         Version,
         on_delete=models.CASCADE,
         related_name='elements',
+        db_index=False,
         verbose_name='Версия справочника',
         help_text='Идентификатор версии справочника'
     )
@@ -99,11 +401,177 @@ class Element(models.Model):
         verbose_name='Значение',
         help_text='Значение элемента'
     )
+    normalized_value = models.CharField(
+        max_length=MAX_LENGTH,
+        blank=True,
+        editable=False,
+        verbose_name='Нормализованное значение',
+        help_text='Значение без различий в регистре, пробелах и «ё»/«е»; '
+                  'заполняется при сохранении элемента'
+    )
+    parent_code = models.CharField(
+        max_length=100,
+        blank=True,
+        verbose_name='Код родителя',
+        help_text='Код родительского элемента в иерархическом справочнике; '
+                  'пусто - элемент верхнего уровня'
+    )
+    removed = models.BooleanField(
+        default=False,
+        verbose_name='Удалён',
+        help_text='Элемент базовой версии удалён в этой версии (только для '
+                  'версий, хранящих изменения)'
+    )
+
+    objects = ElementQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.code}: {self.value}'
 
+    def save(self, *args, update_fields=None, **kwargs):
+        self.normalized_value = normalize_value(self.value)
+        if update_fields is not None and 'value' in update_fields:
+            update_fields = {*update_fields, 'normalized_value'}
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+    def clean(self):
+        if self.removed and self.version.base_id is None:
+            raise ValidationError({'removed': _(
+                'Отметка об удалении допустима только в версии, '
+                'хранящей изменения относительно базовой.')})
+
     class Meta:
         verbose_name = _('Элемент справочника')
         verbose_name_plural = _('Элементы справочника')
         unique_together = ('version', 'code')
+        # Покрывающий индекс для проверки наличия элемента и выдачи
+        # элементов версии по порядку кодов
+        indexes = [
+            models.Index(fields=['version', 'code', 'value'],
+                         name='element_version_code_value_idx'),
+            # Покрывающий индекс для проверки с ?match=normalized
+            models.Index(fields=['version', 'code', 'normalized_value'],
+                         name='element_normalized_value_idx'),
+        ]
+
+
+class ElementClosure(models.Model):
+    """Таблица замыкания иерархии элементов версии справочника.
+
+    Для каждого элемента хранит всех его предков (по ``Element.parent_code``
+    в содержимом версии) с расстоянием до них, поэтому предки, потомки и
+    проверка вхождения в поддерево выбираются одним запросом по индексу при
+    любой глубине дерева. Строится из содержимого версии модулем
+    ``med_refbook.hierarchy``; плоские справочники строк не имеют."""
+    version = models.ForeignKey(
+        Version,
+        on_delete=models.CASCADE,
+        related_name='closure',
+        db_index=False,
+        verbose_name='Версия справочника',
+        help_text='Идентификатор версии справочника'
+    )
+    ancestor = models.CharField(
+        max_length=100,
+        verbose_name='Предок',
+        help_text='Код элемента-предка'
+    )
+    descendant = models.CharField(
+        max_length=100,
+        verbose_name='Потомок',
+        help_text='Код элемента-потомка'
+    )
+    depth = models.PositiveIntegerField(
+        verbose_name='Глубина',
+        help_text='Расстояние от предка до потомка (1 - родитель)'
+    )
+
+    def __str__(self):
+        return f'{self.ancestor} > {self.descendant} ({self.depth})'
+
+    class Meta:
+        verbose_name = _('Связь иерархии элементов')
+        verbose_name_plural = _('Иерархия элементов')
+        # Потомки предка по порядку кодов и проверка вхождения в поддерево;
+        # предки потомка по удалённости
+        unique_together = ('version', 'ancestor', 'descendant')
+        indexes = [
+            models.Index(fields=['version', 'descendant', 'depth'],
+                         name='closure_descendant_idx'),
+        ]
+
+
+class ChangeEvent(models.Model):
+    """Событие журнала изменений справочников (только добавление).
+
+    Для элементов журнал описывает изменения содержимого версии (как его
+    отдаёт api), а не строк таблицы элементов: перевод версии между способами
+    хранения событий не создаёт. Номер события - курсор ленты изменений."""
+    REFBOOK = 'refbook'
+    VERSION = 'version'
+    ELEMENT = 'element'
+    ENTITIES = [(REFBOOK, 'Справочник'), (VERSION, 'Версия'),
+                (ELEMENT, 'Элемент')]
+
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    ACTIONS = [(CREATED, 'Создание'), (UPDATED, 'Изменение'),
+               (DELETED, 'Удаление')]
+
+    id = models.BigAutoField(
+        primary_key=True,
+        verbose_name='Номер события',
+        help_text='Номер события, возрастает в порядке фиксации изменений'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Время',
+        help_text='Время записи события'
+    )
+    entity = models.CharField(
+        max_length=10,
+        choices=ENTITIES,
+        verbose_name='Объект',
+        help_text='Тип изменённого объекта'
+    )
+    action = models.CharField(
+        max_length=10,
+        choices=ACTIONS,
+        verbose_name='Действие',
+        help_text='Вид изменения'
+    )
+    refbook_id = models.IntegerField(
+        verbose_name='Справочник',
+        help_text='Идентификатор справочника'
+    )
+    version_id = models.IntegerField(
+        null=True,
+        blank=True,
+        verbose_name='Версия',
+        help_text='Идентификатор версии справочника (для версий и элементов)'
+    )
+    code = models.CharField(
+        max_length=100,
+        blank=True,
+        verbose_name='Код',
+        help_text='Код справочника или элемента'
+    )
+    data = models.JSONField(
+        default=dict,
+        verbose_name='Данные',
+        help_text='Состояние объекта после изменения (для удаления - до '
+                  'него)'
+    )
+
+    def __str__(self):
+        return f'{self.id}: {self.entity} {self.action}'
+
+    class Meta:
+        verbose_name = _('Событие журнала изменений')
+        verbose_name_plural = _('Журнал изменений')
+        # Лента изменений одного справочника
+        indexes = [
+            models.Index(fields=['refbook_id', 'id'],
+                         name='change_event_refbook_idx'),
+        ]
@@ -0,0 +1,19 @@
+"""Нормализация значений элементов для нестрогой проверки наличия.
+
+Смежные системы передают значения с лишними или нестандартными пробелами,
+в другом регистре и с «ё», записанной как «е» (или наоборот). Нормализованное
+значение хранится в ``Element.normalized_value`` и заполняется при записи
+элемента, так что проверка ``?match=normalized`` - поиск по индексу, а не
+перебор значений с ``LOWER()``."""
+import unicodedata
+
+# Длина Element.normalized_value: нормализация может удлинить значение
+# (совместимые символы, некоторые заглавные буквы)
+MAX_LENGTH = 300
+
+
+def normalize_value(value):
+    """Значение без различий в регистре, пробелах, «ё»/«е» и способе записи
+    символов Unicode (NFKC)."""
+    value = unicodedata.normalize('NFKC', value).lower().replace('ё', 'е')
+    return ' '.join(value.split())[:MAX_LENGTH]
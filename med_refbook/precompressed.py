@@ -0,0 +1,164 @@
+"""Заранее сжатые ответы со всеми элементами версии справочника.
+
+Ответ ``ElementList`` в JSON без постраничной и потоковой выдачи зависит
+только от содержимого версии. Для версий, которые уже начали действовать,
+его тело сжимается gzip и brotli (если установлен пакет ``brotli``) один
+раз и хранится на диске в ``MED_REFBOOK_COMPRESSED_DIR`` под именем
+``<id версии>-<отпечаток>.json.<gz|br>``. Клиенты, принимающие одно из
+кодирований (``Accept-Encoding``), получают тело из файла без запросов
+элементов, сериализации и сжатия. Изменение содержимого версии меняет
+отпечаток и, следовательно, файлы; файлы прежнего содержимого удаляются
+при создании новых.
+
+Файл выбирается по отпечатку версии из ревизии её справочника (см.
+``revisions``), а не по отпечатку переданного объекта версии: объект могли
+прочитать до изменения содержимого. Поэтому процесс, у которого на руках
+прежняя версия, не отдаёт прежнее тело дольше интервала сверки ревизий и не
+удаляет файлы, созданные другим процессом для нового содержимого."""
+import gzip
+import os
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.timezone import now
+
+from . import fingerprints
+from .models import Element
+from .renderers import FastJSONRenderer
+from .revisions import refbook_revisions
+from .routers import primary_reads
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli не обязателен
+    brotli = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+# В порядке предпочтения при равных весах в Accept-Encoding
+ENCODINGS = (BROTLI, GZIP) if brotli else (GZIP,)
+SUFFIXES = {GZIP: '.json.gz', BROTLI: '.json.br'}
+# Параметры постраничной и потоковой выдачи: такие ответы не сжимаются
+PARTIAL_PARAMS = ('stream', 'limit', 'cursor')
+
+
+def compressed_dir():
+    return Path(getattr(settings, 'MED_REFBOOK_COMPRESSED_DIR', None)
+                or Path(settings.BASE_DIR) / 'compressed')
+
+
+def compressed_path(version, encoding, fingerprint=None):
+    return compressed_dir() / (f'{version.pk}-'
+                               f'{fingerprint or version.fingerprint}'
+                               f'{SUFFIXES[encoding]}')
+
+
+def path_fingerprint(path):
+    """Отпечаток содержимого, по которому назван файл."""
+    return path.name.partition('-')[2].partition('.')[0]
+
+
+def negotiate_encoding(accept_encoding):
+    """Лучшее из ``ENCODINGS`` кодирование по заголовку Accept-Encoding или
+    ``None``, если клиент не принимает ни одного."""
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    default = weights.get('*', 0.0)
+    best = max(ENCODINGS, key=lambda encoding: weights.get(encoding, default))
+    return best if weights.get(best, default) > 0 else None
+
+
+def requested_encoding(request, version, renderer_format):
+    """Кодирование заранее сжатого ответа со всеми элементами версии или
+    ``None``: такой ответ отдаётся только в JSON и только для версий, которые
+    уже начали действовать (будущие версии ещё наполняются)."""
+    if (renderer_format != FastJSONRenderer.format
+            or any(name in request.GET for name in PARTIAL_PARAMS)
+            or version.date_start > now().date()):
+        return None
+    return negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+
+
+def compressed_response(version, encoding):
+    """Ответ с заранее сжатым телом; ``None`` - в версии нет элементов или
+    файл удалили после создания (тогда ответ строится обычным образом)."""
+    path = ensure_compressed(version, encoding)
+    try:
+        content = path.read_bytes() if path else None
+    except FileNotFoundError:
+        content = None
+    if content is None:
+        return None
+    response = HttpResponse(content, content_type=FastJSONRenderer.media_type)
+    response['Content-Encoding'] = encoding
+    return response
+
+
+def elements_body(pairs):
+    """Тело ответа ``ElementList`` в JSON."""
+    return FastJSONRenderer().render({'elements': [
+        {'code': code, 'value': value} for code, value in pairs]})
+
+
+def compress(body, encoding):
+    if encoding == BROTLI:
+        return brotli.compress(body, mode=brotli.MODE_TEXT)
+    # Без времени в заголовке: одинаковое содержимое - одинаковые байты
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+def ensure_compressed(version, encoding):
+    """Путь к сжатому телу ответа версии; файлы всех кодирований создаются,
+    если их ещё нет. ``None`` - в версии нет элементов или она удалена.
+
+    Если содержимое версии изменилось после чтения отпечатка, файлы
+    получают имена по отпечатку прочитанного содержимого; возвращается
+    фактический путь. Удаляются файлы версии с отпечатками, отличными и от
+    отпечатка в БД, и от прочитанного содержимого."""
+    current = refbook_revisions.current(version)
+    if current is None:
+        return None
+    path = compressed_path(version, encoding, current.fingerprint)
+    if path.exists():
+        return path
+    with primary_reads():
+        pairs = list(Element.objects.materialized(current).values_list(
+            'code', 'value'))
+    if not pairs:
+        return None
+    fingerprint = fingerprints.compute(pairs)
+    body = elements_body(pairs)
+    del pairs
+    path.parent.mkdir(parents=True, exist_ok=True)
+    written = {}
+    for each in ENCODINGS:
+        written[each] = compressed_path(version, each, fingerprint)
+        _write(written[each], compress(body, each))
+    kept = {current.fingerprint, fingerprint}
+    for stale in path.parent.glob(f'{version.pk}-*.json.*'):
+        if path_fingerprint(stale) not in kept:
+            stale.unlink(missing_ok=True)
+    return written[encoding]
+
+
+def _write(path, content):
+    """Атомарная запись файла через временный файл."""
+    descriptor, temporary = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(content)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
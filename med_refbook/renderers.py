@@ -0,0 +1,45 @@
+"""Быстрый JSON-рендерер api.
+
+Если установлен ``orjson``, ответы кодируются им, иначе - рендерером DRF.
+Результат побайтово совпадает с ``rest_framework.renderers.
+JSONRenderer`` с настройками по умолчанию (компактный вывод, UTF-8 без
+экранирования, экранированные U+2028 и U+2029)."""
+from rest_framework.renderers import JSONRenderer
+
+from .instrumentation import timed_serialization
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson не обязателен
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSON-рендерер на ``orjson`` с запасным путём через ``json``.
+
+    Типы, которые ``orjson`` кодирует иначе, чем кодировщик DRF (даты,
+    dataclass), передаются кодировщику DRF. Запросы с отступами
+    (``indent`` в Accept) и данные, которые ``orjson`` не кодирует (например,
+    целые больше 64 бит), обрабатываются рендерером DRF."""
+
+    options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+               | orjson.OPT_PASSTHROUGH_DATACLASS) if orjson else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timed_serialization():
+            return self._render(data, accepted_media_type, renderer_context)
+
+    def _render(self, data, accepted_media_type, renderer_context):
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if (orjson is None or data is None or indent is not None
+                or self.ensure_ascii or not self.compact):
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        try:
+            content = orjson.dumps(data, default=self.encoder_class().default,
+                                   option=self.options)
+        except TypeError:  # в том числе orjson.JSONEncodeError
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        return content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(
+            b'\xe2\x80\xa9', b'\\u2029')
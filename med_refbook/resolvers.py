@@ -0,0 +1,123 @@
+import threading
+from bisect import bisect_right
+from collections import namedtuple
+
+from django.utils.timezone import now
+
+from .models import Version
+from .revisions import refbook_revisions
+
+CurrentVersion = namedtuple('CurrentVersion',
+                            ['version', 'valid_from', 'expires_on', 'token'],
+                            defaults=[None])
+
+
+class CurrentVersionResolver:
+    """Кэш текущих версий справочников.
+
+    Текущая версия справочника - версия с наибольшей датой начала, не
+    превышающей сегодняшнюю. Ответ меняется только с наступлением даты начала
+    следующей версии или при изменении версий, поэтому запись кэша действует
+    до ближайшей будущей даты начала (``expires_on``), пока не изменится
+    ревизия справочника (см. ``revisions``): изменения версий другими
+    процессами видны не позже ``MED_REFBOOK_REVALIDATE_INTERVAL`` секунд, а
+    возвращаемая версия несёт актуальный отпечаток."""
+
+    def __init__(self):
+        self._entries = {}  # refbook_id -> CurrentVersion
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, refbook_id, today=None):
+        """Текущая версия справочника или ``None``."""
+        return self._resolve(refbook_id, refbook_revisions.get(refbook_id),
+                             today or now().date())
+
+    async def aresolve(self, refbook_id, today=None):
+        """Асинхронный ``resolve``: ревизия читается через асинхронный
+        ORM."""
+        return self._resolve(refbook_id,
+                             await refbook_revisions.aget(refbook_id),
+                             today or now().date())
+
+    def _resolve(self, refbook_id, revision, today):
+        entry = self._cached(refbook_id, revision.token, today)
+        if entry is not None:
+            return entry.version
+        with self._lock:
+            epoch = self._epoch
+        entry = self.compute(revision.versions, today)
+        return self._put(refbook_id, entry and entry._replace(
+            token=revision.token), epoch)
+
+    @staticmethod
+    def compute(versions, today):
+        """Текущая версия и срок её действия по списку версий справочника;
+        ``None``, если у справочника нет версий."""
+        current = upcoming = None
+        found = False
+        for version in versions:
+            found = True
+            if version.date_start <= today:
+                if current is None or version.date_start > current.date_start:
+                    current = version
+            elif upcoming is None or version.date_start < upcoming.date_start:
+                upcoming = version
+        if not found:
+            return None
+        return CurrentVersion(
+            version=current,
+            valid_from=current.date_start if current else today,
+            expires_on=upcoming.date_start if upcoming else None)
+
+    def _cached(self, refbook_id, token, today):
+        entry = self._entries.get(refbook_id)
+        if (entry is not None and entry.token == token
+                and entry.valid_from <= today
+                and (entry.expires_on is None or today < entry.expires_on)):
+            return entry
+        return None
+
+    def _put(self, refbook_id, entry, epoch):
+        if entry is None:
+            return None
+        with self._lock:
+            if epoch == self._epoch:
+                self._entries[refbook_id] = entry
+        return entry.version
+
+    def invalidate(self, refbook_id):
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(refbook_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+
+current_version_resolver = CurrentVersionResolver()
+
+
+def versions_on_dates(pairs):
+    """Версии, действующие на даты, для пар (справочник, дата).
+
+    Версии всех справочников читаются одним запросом; для каждой пары
+    выбирается версия с наибольшей датой начала, не превышающей дату.
+    Возвращает словарь ``{(refbook_id, дата): Version или None}``."""
+    pairs = set(pairs)
+    versions = {}
+    for version in Version.objects.filter(
+            refbook_id__in={refbook_id for refbook_id, _ in pairs}
+    ).only('id', 'refbook_id', 'version', 'date_start', 'base',
+           'fingerprint', 'updated_at').order_by('refbook_id', 'date_start'):
+        versions.setdefault(version.refbook_id, []).append(version)
+    starts = {refbook_id: [version.date_start for version in refbook_versions]
+              for refbook_id, refbook_versions in versions.items()}
+    resolved = {}
+    for refbook_id, day in pairs:
+        position = bisect_right(starts.get(refbook_id, ()), day)
+        resolved[refbook_id, day] = versions[refbook_id][
+            position - 1] if position else None
+    return resolved
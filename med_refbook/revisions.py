@@ -0,0 +1,163 @@
+"""Ревизии справочников: состояние их версий, сверяемое с БД.
+
+Внутрипроцессные кэши (индекс элементов, поисковый индекс, текущие версии)
+сигналами сбрасываются только в процессе, изменившем данные. Чтобы изменения,
+сделанные другими процессами сервиса или в обход приложения, не оставались
+невидимыми, записи кэшей хранят отпечатки версий и перед выдачей сверяются с
+ревизией справочника - состоянием его версий (имя, дата начала, базовая
+версия, отпечаток содержимого) из БД.
+
+Ревизия читается из основной БД (не из реплики) одним запросом и
+запоминается в процессе не дольше ``MED_REFBOOK_REVALIDATE_INTERVAL``
+секунд; изменения в своём процессе сбрасывают её сразу. Поэтому изменение,
+сделанное другим процессом, становится видно не позже чем через этот
+интервал, а запросов к БД на проверку - не больше одного на справочник за
+интервал. Данные, проверяемые по ревизии, тоже загружаются из основной БД,
+чтобы не разойтись с ней из-за отставания реплики.
+
+Так же запоминается ревизия каталога - число и время последнего изменения
+справочников и версий: по ней строятся ETag и ключ кэша списка
+справочников."""
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import Refbook, Version
+from .routers import primary_reads
+
+# ``token`` - сравнимое состояние версий, ``versions`` - версии справочника
+# по возрастанию даты начала
+RefbookRevision = namedtuple('RefbookRevision', ['token', 'versions'])
+
+# Ревизия каталога: метка (число и время последнего изменения справочников
+# и версий) и время последнего изменения
+CatalogRevision = namedtuple('CatalogRevision', ['token', 'last_modified'])
+
+# Ключ ревизии каталога среди ревизий справочников и агрегаты для неё
+CATALOG = None
+CATALOG_STATE = {'count': Count('pk'), 'changed': Max('updated_at')}
+
+
+class RevisionCache:
+    """Запомненные ревизии справочников процесса."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._entries = {}  # refbook_id -> (срок действия, RefbookRevision)
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, refbook_id):
+        """Ревизия версий справочника (у справочника без версий - пустая)."""
+        revision, epoch = self._remembered(refbook_id)
+        if revision is None:
+            with primary_reads():
+                versions = list(_versions(refbook_id))
+            revision = self._put(refbook_id, versions, epoch)
+        return revision
+
+    async def aget(self, refbook_id):
+        """Асинхронный ``get``."""
+        revision, epoch = self._remembered(refbook_id)
+        if revision is None:
+            with primary_reads():
+                versions = [version async for version in _versions(
+                    refbook_id)]
+            revision = self._put(refbook_id, versions, epoch)
+        return revision
+
+    def catalog(self):
+        """Ревизия каталога справочников: меняется при любом изменении
+        справочников, версий и элементов (через отпечатки версий)."""
+        revision, epoch = self._remembered(CATALOG)
+        if revision is None:
+            with primary_reads():
+                states = (Refbook.objects.aggregate(**CATALOG_STATE),
+                          Version.objects.aggregate(**CATALOG_STATE))
+            revision = self._put_catalog(*states, epoch)
+        return revision
+
+    async def acatalog(self):
+        """Асинхронный ``catalog``."""
+        revision, epoch = self._remembered(CATALOG)
+        if revision is None:
+            with primary_reads():
+                states = (await Refbook.objects.aaggregate(**CATALOG_STATE),
+                          await Version.objects.aaggregate(**CATALOG_STATE))
+            revision = self._put_catalog(*states, epoch)
+        return revision
+
+    def current(self, version):
+        """Версия в состоянии из ревизии её справочника (с актуальным
+        отпечатком) или ``None``, если версия удалена."""
+        return find_version(self.get(version.refbook_id), version.pk)
+
+    async def acurrent(self, version):
+        """Асинхронный ``current``."""
+        return find_version(await self.aget(version.refbook_id), version.pk)
+
+    def invalidate(self, refbook_id):
+        """Сброс запомненных ревизий справочника и каталога после изменения
+        справочника."""
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(refbook_id, None)
+            self._entries.pop(CATALOG, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def _remembered(self, key):
+        with self._lock:
+            expires, revision = self._entries.get(key, (0, None))
+            if time.monotonic() < expires:
+                return revision, self._epoch
+            return None, self._epoch
+
+    def _put(self, refbook_id, versions, epoch):
+        return self._remember(refbook_id, RefbookRevision(
+            token=tuple((version.pk, version.version, version.date_start,
+                         version.base_id, version.fingerprint)
+                        for version in versions),
+            versions=tuple(versions)), epoch)
+
+    def _put_catalog(self, refbooks, versions, epoch):
+        states = (refbooks, versions)
+        changed = [state['changed'] for state in states if state['changed']]
+        token = ':'.join(f"{state['count']}-{state['changed']}".replace(
+            ' ', 'T') for state in states)
+        return self._remember(CATALOG, CatalogRevision(
+            token=token,
+            last_modified=int(max(changed).timestamp()) if changed else 0),
+            epoch)
+
+    def _remember(self, key, revision, epoch):
+        with self._lock:
+            # Ревизию, прочитанную до сброса, не запоминаем
+            if self.interval > 0 and epoch == self._epoch:
+                self._entries[key] = (
+                    time.monotonic() + self.interval, revision)
+        return revision
+
+
+def find_version(revision, version_id):
+    """Версия ревизии по идентификатору или ``None``."""
+    for version in revision.versions:
+        if version.pk == version_id:
+            return version
+    return None
+
+
+def _versions(refbook_id):
+    return Version.objects.filter(refbook_id=refbook_id).only(
+        'id', 'refbook_id', 'version', 'date_start', 'base',
+        'fingerprint', 'updated_at').order_by('date_start')
+
+
+refbook_revisions = RevisionCache(
+    interval=getattr(settings, 'MED_REFBOOK_REVALIDATE_INTERVAL', 2))
@@ -0,0 +1,70 @@
+"""Направление запросов чтения эндпоинтов api на реплику БД.
+
+Реплика задаётся ``DATABASE_REPLICA_URL`` (псевдоним ``replica`` в
+``DATABASES``). На неё идут только запросы чтения внутри ``replica_reads()``
+- этим блоком обёрнуты эндпоинты api, которые ничего не записывают.
+Остальные запросы (администрирование, импорт, команды) выполняются в
+основной БД, поэтому отставание реплики не влияет на чтение только что
+записанных данных.
+
+Внутрипроцессные кэши (ревизии справочников, индексы элементов) хранят
+прочитанное дольше запроса, поэтому загружаются из основной БД
+(``primary_reads()``): иначе отставшее состояние реплики закрепилось бы в
+них. Тела потоковых ответов читаются после выхода из ``replica_reads()``,
+поэтому их наборы закрепляются за выбранной БД заранее (``pinned()``)."""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA = 'replica'
+
+_replica_reads = ContextVar('med_refbook_replica_reads', default=False)
+
+
+@contextmanager
+def replica_reads():
+    """Чтение из реплики (если она настроена) внутри блока."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """Чтение из основной БД внутри блока, в том числе внутри
+    ``replica_reads()``."""
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def pinned(queryset):
+    """Набор, выполняемый в БД, выбранной для чтения сейчас, а не в момент
+    выполнения."""
+    return queryset.using(queryset.db)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and REPLICA in settings.DATABASES:
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплика содержит те же данные, что и основная БД
+        if {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS, REPLICA}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схему реплики переносит репликация основной БД
+        return db != REPLICA
@@ -0,0 +1,106 @@
+"""Схема OpenAPI, построенная один раз.
+
+``SpectacularAPIView`` строит схему, обходя все представления api, при
+каждом запросе ``/schema/``. ``CachedSchemaView`` строит её один раз на
+процесс для каждого языка (или читает файл ``schema.<язык>.json`` из
+``MED_REFBOOK_SCHEMA_DIR``, собранный при сборке командой
+``build_api_schema``), хранит в памяти готовые ответы для каждого формата и
+отдаёт их с ETag. Схема меняется только с кодом, поэтому сбрасывать её не
+нужно.
+
+Модуль импортирует основную часть drf-spectacular; при
+``MED_REFBOOK_LAZY_API_DOCS`` он загружается только при первом запросе
+схемы или документации (см. ``core/urls.py``)."""
+import hashlib
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import translation
+from django.utils.cache import get_conditional_response, patch_cache_control
+from drf_spectacular.renderers import OpenApiJsonRenderer
+from drf_spectacular.settings import spectacular_settings
+from drf_spectacular.views import SpectacularAPIView
+
+from .http_cache import make_etag
+
+SCHEMA_DIR = getattr(settings, 'MED_REFBOOK_SCHEMA_DIR', '')
+
+# Схемы по языкам и готовые ответы по (язык, тип содержимого)
+_schemas = {}
+_documents = {}
+
+
+def schema_path(directory, lang):
+    return Path(directory) / f'schema.{lang}.json'
+
+
+def generate_schema(lang):
+    """Построение схемы api на языке ``lang``."""
+    with translation.override(lang):
+        generator = spectacular_settings.DEFAULT_GENERATOR_CLASS()
+        return generator.get_schema(request=None, public=True)
+
+
+def render_schema_json(schema):
+    """Схема в JSON для файла ``build_api_schema``."""
+    return OpenApiJsonRenderer().render(schema,
+                                        renderer_context={'indent': None})
+
+
+def get_schema(lang):
+    """Схема api на языке ``lang``: из файла сборки или построенная при
+    первом обращении."""
+    schema = _schemas.get(lang)
+    if schema is None:
+        path = schema_path(SCHEMA_DIR, lang) if SCHEMA_DIR else None
+        if path is not None and path.exists():
+            schema = json.loads(path.read_bytes())
+        else:
+            schema = generate_schema(lang)
+        _schemas[lang] = schema
+    return schema
+
+
+def supported_language(lang):
+    """Язык из ``LANGUAGES`` для параметра ``lang``: число хранимых схем
+    ограничено списком языков проекта."""
+    try:
+        return translation.get_supported_language_variant(lang or '')
+    except LookupError:
+        return settings.LANGUAGE_CODE
+
+
+def clear():
+    _schemas.clear()
+    _documents.clear()
+
+
+class CachedSchemaView(SpectacularAPIView):
+    """``SpectacularAPIView`` с однократным построением схемы и ETag."""
+
+    def _get_schema_response(self, request):
+        lang = supported_language(translation.get_language())
+        renderer = request.accepted_renderer
+        key = (lang, renderer.media_type)
+        document = _documents.get(key)
+        if document is None:
+            content = renderer.render(get_schema(lang), renderer.media_type,
+                                      {'request': request})
+            document = _documents[key] = (
+                content, make_etag(hashlib.sha1(content).hexdigest()))
+        content, etag = document
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            content_type = renderer.media_type
+            if renderer.charset:
+                content_type += f'; charset={renderer.charset}'
+            response = HttpResponse(content, content_type=content_type)
+            response['Content-Disposition'] = (
+                f'inline; filename="{self._get_filename(request, None)}"')
+        response['ETag'] = etag
+        # Схема меняется только при развёртывании: клиенты проверяют её
+        # условным запросом
+        patch_cache_control(response, public=True, no_cache=True)
+        return response
@@ -0,0 +1,140 @@
+"""Поиск элементов версии по префиксу кода и словам значения.
+
+Для каждой версии строится внутрипроцессный индекс: отсортированные коды
+для поиска по префиксу и инвертированный индекс слов значений (слово ->
+номера элементов). Слова приводятся к нижнему регистру, «ё» заменяется на
+«е»; слова запроса ищутся как префиксы слов значения, что подходит для
+подсказок при вводе.
+
+Порядок результатов: совпадение кода целиком, затем префикс кода (в порядке
+кодов), затем совпадения по значению - сначала более короткие значения.
+Элементы нумеруются в этом порядке заранее, поэтому поиск по значению
+перебирает кандидатов от лучших к худшим и останавливается на ``limit``."""
+import heapq
+import re
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+
+from .index import ElementIndex
+
+WORD = re.compile(r'\w+')
+
+# Во сколько раз слово запроса может быть чаще самого редкого, чтобы
+# совпадения с ним проверялись по множеству номеров элементов: построение
+# множества дешевле разбора значения кандидата на слова примерно во столько
+# же раз
+POSITION_SET_RATIO = 20
+
+# Символ больше любого символа слов: граница диапазона слов с префиксом
+LAST_CHAR = chr(0x10ffff)
+
+
+def normalize(text):
+    return text.casefold().replace('ё', 'е')
+
+
+def tokenize(text):
+    return WORD.findall(normalize(text))
+
+
+class VersionSearch:
+    """Поисковый индекс элементов одной версии."""
+
+    def __init__(self, pairs):
+        # Номер элемента - его место среди совпадений по значению
+        self.rows = sorted(pairs, key=lambda row: (len(row[1]), row[1],
+                                                   row[0]))
+        codes = sorted((normalize(code), position)
+                       for position, (code, _) in enumerate(self.rows))
+        self.code_keys = [code for code, _ in codes]
+        self.code_rows = array('I', (position for _, position in codes))
+        postings = defaultdict(lambda: array('I'))
+        for position, (_, value) in enumerate(self.rows):
+            for token in set(tokenize(value)):
+                postings[token].append(position)
+        self.tokens = sorted(postings)
+        self.postings = [postings[token] for token in self.tokens]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, query, limit):
+        """До ``limit`` пар (код, значение), подходящих под запрос."""
+        found = self._by_code(normalize(query.strip()), limit)
+        tokens = tokenize(query)
+        if tokens and len(found) < limit:
+            seen = set(found)
+            for position in self._by_value(tokens):
+                if position not in seen:
+                    found.append(position)
+                    if len(found) == limit:
+                        break
+        return [self.rows[position] for position in found]
+
+    def _by_code(self, prefix, limit):
+        found = []
+        start = bisect_left(self.code_keys, prefix)
+        for index in range(start, min(start + limit, len(self.code_keys))):
+            if not self.code_keys[index].startswith(prefix):
+                break
+            found.append(self.code_rows[index])
+        return found
+
+    def _token_range(self, prefix):
+        """Номера слов индекса с префиксом ``prefix``."""
+        return range(bisect_left(self.tokens, prefix),
+                     bisect_left(self.tokens, prefix + LAST_CHAR))
+
+    def _by_value(self, tokens):
+        """Номера элементов, в значениях которых для каждого слова запроса
+        есть слово с таким префиксом, в порядке возрастания."""
+        ranges = [self._token_range(token) for token in tokens]
+        # Перебираем совпадения самого редкого слова и проверяем остальные
+        sizes = [sum(len(self.postings[index]) for index in token_range)
+                 for token_range in ranges]
+        rarest = sizes.index(min(sizes))
+        # Совпадения остальных слов проверяются по множеству номеров
+        # элементов, а для слов намного чаще самого редкого - по словам
+        # значения каждого кандидата
+        sets, frequent = [], []
+        for number, token_range in enumerate(ranges):
+            if number == rarest:
+                continue
+            if sizes[number] > POSITION_SET_RATIO * sizes[rarest]:
+                frequent.append(token_range)
+                continue
+            positions = set()
+            for index in token_range:
+                positions.update(self.postings[index])
+            sets.append(positions)
+        previous = None
+        for position in heapq.merge(*(self.postings[index]
+                                      for index in ranges[rarest])):
+            if position == previous:
+                continue
+            previous = position
+            if all(position in positions for positions in sets) and (
+                    not frequent or self._matches(position, frequent)):
+                yield position
+
+    def _matches(self, position, others):
+        token_indexes = {bisect_left(self.tokens, token)
+                         for token in tokenize(self.rows[position][1])}
+        return all(any(index in token_range for index in token_indexes)
+                   for token_range in others)
+
+
+class SearchIndex(ElementIndex):
+    """LRU поисковых индексов версий с бюджетом по числу элементов."""
+
+    build = VersionSearch
+
+    def search(self, version, query, limit):
+        return self.get(version).search(query, limit)
+
+
+search_index = SearchIndex(max_elements=getattr(
+    settings, 'MED_REFBOOK_SEARCH_INDEX_MAX_ELEMENTS', 1000000))
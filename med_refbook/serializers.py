@@ -1,15 +1,97 @@
 from rest_framework import serializers
 
-from .models import Element, Refbook
+from .models import ChangeEvent, Element, Refbook
 
 
 class RefbookSerializer(serializers.ModelSerializer):
+    current_version = serializers.CharField(
+        required=False,
+        help_text='Версия, действующая на дату (при include_current=true)')
+    current_version_date_start = serializers.DateField(
+        required=False,
+        help_text='Дата начала действующей версии (при include_current=true)')
+
     class Meta:
         model = Refbook
-        fields = ['id', 'code', 'name']
+        fields = ['id', 'code', 'name', 'current_version',
+                  'current_version_date_start']
 
 
 class ElementSerializer(serializers.ModelSerializer):
     class Meta:
         model = Element
         fields = ['code', 'value']
+
+
+class CheckElementItemSerializer(serializers.Serializer):
+    code = serializers.CharField(help_text='Код элемента')
+    value = serializers.CharField(help_text='Значение элемента')
+    version = serializers.CharField(required=False,
+                                    help_text='Версия справочника')
+
+
+class CheckElementResultSerializer(serializers.Serializer):
+    code = serializers.CharField()
+    value = serializers.CharField()
+    exists = serializers.BooleanField()
+    detail = serializers.CharField(required=False)
+
+
+class DatedCheckElementItemSerializer(serializers.Serializer):
+    refbook = serializers.CharField(
+        help_text='Код справочника (строка) или его идентификатор (число)')
+    code = serializers.CharField(help_text='Код элемента')
+    value = serializers.CharField(help_text='Значение элемента')
+    date = serializers.DateField(
+        required=False,
+        help_text='Дата, на которую проверяется элемент (по умолчанию '
+                  'сегодня)')
+
+
+class DatedCheckElementResultSerializer(serializers.Serializer):
+    refbook = serializers.CharField()
+    code = serializers.CharField()
+    value = serializers.CharField()
+    date = serializers.DateField()
+    version = serializers.CharField(allow_null=True)
+    exists = serializers.BooleanField()
+    detail = serializers.CharField(required=False)
+
+
+class HierarchyElementSerializer(serializers.Serializer):
+    code = serializers.CharField()
+    value = serializers.CharField()
+    parent = serializers.CharField(allow_null=True,
+                                   help_text='Код родительского элемента')
+
+
+class ElementChangeSerializer(serializers.Serializer):
+    code = serializers.CharField()
+    value = serializers.CharField()
+    previous_value = serializers.CharField(required=False)
+
+
+class VersionDiffSerializer(serializers.Serializer):
+    added = ElementSerializer(many=True)
+    removed = ElementSerializer(many=True)
+    changed = ElementChangeSerializer(many=True)
+
+
+class ChangeEventSerializer(serializers.Serializer):
+    id = serializers.IntegerField(help_text='Номер события')
+    created_at = serializers.DateTimeField()
+    entity = serializers.ChoiceField(choices=ChangeEvent.ENTITIES)
+    action = serializers.ChoiceField(choices=ChangeEvent.ACTIONS)
+    refbook_id = serializers.IntegerField()
+    version_id = serializers.IntegerField(allow_null=True)
+    code = serializers.CharField()
+    data = serializers.DictField(
+        help_text='Состояние объекта после изменения (для удаления - до '
+                  'него)')
+
+
+class ChangeFeedSerializer(serializers.Serializer):
+    changes = ChangeEventSerializer(many=True)
+    cursor = serializers.IntegerField(
+        help_text='Значение since для следующего запроса')
+    has_more = serializers.BooleanField()
@@ -0,0 +1,297 @@
+from django.db import transaction
+from django.db.models import Q, QuerySet
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
+from django.dispatch import receiver
+
+from . import changes, fingerprints, hierarchy
+from .index import element_index
+from .models import (ChangeEvent, Element, ElementClosure, ElementQuerySet,
+                     Refbook, Version, batches, elements_changed,
+                     elements_changing)
+from .resolvers import current_version_resolver
+from .revisions import refbook_revisions
+from .search import search_index
+
+
+def invalidate_version(version_id):
+    """Сброс закэшированных данных версии справочника.
+
+    Сбрасываем сразу и повторно после фиксации транзакции, чтобы параллельный
+    запрос не успел загрузить в кэш ещё не зафиксированное состояние."""
+    for index in (element_index, search_index):
+        index.invalidate(version_id)
+        transaction.on_commit(lambda index=index: index.invalidate(version_id))
+
+
+def invalidate_refbook(refbook_id):
+    """Сброс ревизии и закэшированной текущей версии справочника."""
+    for cache in (refbook_revisions, current_version_resolver):
+        cache.invalidate(refbook_id)
+        transaction.on_commit(lambda cache=cache: cache.invalidate(refbook_id))
+
+
+# Служебные поля версии: их изменение не меняет версию для потребителей
+# журнала изменений (отпечаток, способ хранения)
+VERSION_SERVICE_FIELDS = frozenset({'fingerprint', 'updated_at', 'base'})
+
+
+def saved_action(created):
+    return ChangeEvent.CREATED if created else ChangeEvent.UPDATED
+
+
+@receiver([post_save, post_delete], sender=Refbook)
+def refbook_changed(sender, instance, **kwargs):
+    invalidate_refbook(instance.pk)
+
+
+@receiver(post_save, sender=Refbook)
+def refbook_saved(sender, instance, created=False, raw=False, **kwargs):
+    if not raw:
+        changes.record([changes.refbook_event(instance,
+                                              saved_action(created))])
+
+
+@receiver(post_delete, sender=Refbook)
+def refbook_deleted(sender, instance, **kwargs):
+    changes.record([changes.refbook_event(instance, ChangeEvent.DELETED)])
+
+
+@receiver(pre_save, sender=Version)
+def version_moved(sender, instance, **kwargs):
+    """Версию могут перенести в другой справочник: сбрасываем и прежний."""
+    if instance.pk is None:
+        return
+    old_refbook_id = Version.objects.filter(pk=instance.pk).values_list(
+        'refbook_id', flat=True).first()
+    if old_refbook_id is not None and old_refbook_id != instance.refbook_id:
+        invalidate_refbook(old_refbook_id)
+
+
+@receiver([post_save, post_delete], sender=Version)
+def version_changed(sender, instance, **kwargs):
+    invalidate_version(instance.pk)
+    invalidate_refbook(instance.refbook_id)
+
+
+@receiver(post_save, sender=Version)
+def version_saved(sender, instance, created=False, raw=False,
+                  update_fields=None, **kwargs):
+    if raw or update_fields and set(update_fields) <= VERSION_SERVICE_FIELDS:
+        return
+    changes.record([changes.version_event(instance, saved_action(created))])
+
+
+@receiver(post_delete, sender=Version)
+def version_deleted(sender, instance, **kwargs):
+    # Элементы удалённой версии отдельных событий не получают
+    changes.record([changes.version_event(instance, ChangeEvent.DELETED)])
+
+
+def update_fingerprint(version_id, added=(), removed=()):
+    """Пересчёт отпечатка версии после изменения её элементов."""
+    with transaction.atomic():
+        version = Version.objects.select_for_update().filter(
+            pk=version_id).first()
+        if version is None:
+            return
+        version.fingerprint = fingerprints.update(
+            version.fingerprint, added=added, removed=removed)
+        version.save(update_fields=['fingerprint', 'updated_at'])
+
+
+def deleted_per_instance(origin):
+    """Удаление элемента обрабатывается его сигналами: оно не вызвано
+    удалением версии или справочника (элементы удалённой версии событий не
+    получают) и не выполняется пакетом через ``ElementQuerySet.delete``
+    (пакет обрабатывается сигналами ``elements_changing``/``changed``)."""
+    if isinstance(origin, ElementQuerySet):
+        return False
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return model not in (Version, Refbook)
+
+
+def affected_versions(keys):
+    """Версии, содержимое которых зависит от элементов с парами (версия,
+    код) ``keys``: сами версии и хранящие изменения относительно них.
+    Возвращает словарь ``{(версия, базовая версия): коды}``."""
+    codes = {}
+    for version_id, code in keys:
+        codes.setdefault(version_id, set()).add(code)
+    affected = {}
+    for pk, base_id in Version.objects.filter(
+            Q(pk__in=list(codes)) | Q(base_id__in=list(codes))
+    ).values_list('pk', 'base_id'):
+        affected.setdefault((pk, base_id), set()).update(
+            codes.get(pk, ()), codes.get(base_id, ()))
+    return affected
+
+
+def materialized_pairs(version_id, base_id, codes):
+    """Пары (код, значение) содержимого версии с кодами ``codes``: словарь
+    ``{код: пара или None, если такого элемента в версии нет}``."""
+    rows = {}
+    for batch in batches(sorted(codes)):
+        for row in Element.objects.filter(
+                version_id__in=[version_id, base_id], code__in=batch
+        ).values_list('version_id', 'code', 'value', 'removed'):
+            rows[row[:2]] = row[2:]
+    pairs = {}
+    for code in codes:
+        value, removed = rows.get((version_id, code)) or rows.get(
+            (base_id, code)) or (None, True)
+        pairs[code] = None if removed else (code, value)
+    return pairs
+
+
+def materialized(keys, created=()):
+    """Содержимое затронутых версий по парам (версия, код) ``keys``:
+    ``{(версия, базовая версия): {код: пара или None}}``.
+
+    ``created`` - вставляемые элементы: строк с их парами до вставки нет,
+    поэтому в версиях, хранящих все элементы, их коды не читаются из БД."""
+    inserted = created_pairs(created)
+    content = {}
+    for (version_id, base_id), codes in affected_versions(keys).items():
+        known = inserted_codes(version_id, base_id, codes, inserted)
+        content[version_id, base_id] = {
+            **materialized_pairs(version_id, base_id, codes - known),
+            **dict.fromkeys(known)}
+    return content
+
+
+def created_pairs(created):
+    """Пары содержимого вставляемых элементов по (версия, код)."""
+    return {(element.version_id, element.code): None if element.removed
+            else (element.code, element.value) for element in created}
+
+
+def inserted_codes(version_id, base_id, codes, inserted):
+    """Коды из ``codes``, содержимое которых в версии задают только
+    вставляемые элементы: версия хранит все элементы, и строк с этими кодами
+    в ней до вставки не было."""
+    if base_id is not None:
+        return set()
+    return {code for code in codes if (version_id, code) in inserted}
+
+
+def apply_hierarchy(instance):
+    """Обновление иерархии версий после изменения состава их элементов
+    или ссылок на родителей, если версии иерархические: на месте, если
+    изменился один элемент одной версии, иначе - перестроением."""
+    version_ids, parent_codes, code = getattr(instance, '_hierarchy', None) or (
+        (), (), None)
+    instance._hierarchy = None
+    if code is not None and len(version_ids) == 1 and hierarchy.relink(
+            instance.version_id, code):
+        return
+    schedule_hierarchy(version_ids, any(parent_codes))
+
+
+def schedule_hierarchy(version_ids, parents):
+    """Перестроение иерархии версий, если они иерархические: у их
+    изменённых элементов есть родители или иерархия уже построена."""
+    if version_ids and (parents or ElementClosure.objects.filter(
+            version_id__in=version_ids).exists()):
+        hierarchy.schedule_rebuild(version_ids)
+
+
+def apply_materialized(before, created=()):
+    """Пересчёт отпечатков версий, содержимое которых изменилось по
+    сравнению с ``before`` (результатом ``materialized``), запись изменений
+    их содержимого в журнал и сброс кэшей; ``created`` - вставленные
+    элементы, как в ``materialized``."""
+    inserted = created_pairs(created)
+    changed = []
+    for (version_id, base_id), pairs in before.items():
+        known = inserted_codes(version_id, base_id, pairs, inserted)
+        after = {**materialized_pairs(version_id, base_id,
+                                      pairs.keys() - known),
+                 **{code: inserted[version_id, code] for code in known}}
+        diff = [(pairs[code], after[code]) for code in sorted(pairs)
+                if pairs[code] != after[code]]
+        if diff:
+            update_fingerprint(
+                version_id,
+                added=[pair for _, pair in diff if pair],
+                removed=[pair for pair, _ in diff if pair])
+            changed += [(version_id, *change) for change in diff]
+        invalidate_version(version_id)
+    if changed:
+        refbook_ids = dict(Version.objects.filter(
+            pk__in={version_id for version_id, _, _ in changed}
+        ).values_list('pk', 'refbook_id'))
+        changes.record(
+            changes.content_change_event(refbook_ids[version_id], version_id,
+                                         before, after)
+            for version_id, before, after in changed)
+
+
+@receiver(pre_save, sender=Element)
+def element_before_save(sender, instance, raw=False, **kwargs):
+    """Запоминаем содержимое затронутых версий до изменения: элемент могут
+    изменить или перенести в другую версию."""
+    if raw:
+        return
+    keys = {(instance.version_id, instance.code)}
+    previous = None
+    if instance.pk is not None:
+        previous = Element.objects.filter(pk=instance.pk).values_list(
+            'version_id', 'code', 'parent_code', 'removed').first()
+        if previous:
+            keys.add(previous[:2])
+    instance._materialized = materialized(keys)
+    # Изменение только значения иерархию не меняет
+    instance._hierarchy = None
+    if previous != (instance.version_id, instance.code, instance.parent_code,
+                    instance.removed):
+        # На месте обновляются вставка и смена родителя; перенос в другую
+        # версию и смена кода - перестроением
+        moved = previous and previous[:2] != (instance.version_id,
+                                              instance.code)
+        instance._hierarchy = (
+            {version_id for version_id, _ in instance._materialized},
+            [instance.parent_code, previous[2] if previous else ''],
+            None if moved or instance.removed else instance.code)
+
+
+@receiver(post_save, sender=Element)
+def element_saved(sender, instance, **kwargs):
+    invalidate_version(instance.version_id)
+    apply_materialized(instance.__dict__.pop('_materialized', {}))
+    apply_hierarchy(instance)
+
+
+@receiver(pre_delete, sender=Element)
+def element_before_delete(sender, instance, origin=None, **kwargs):
+    if not deleted_per_instance(origin):
+        return
+    instance._materialized = materialized(
+        {(instance.version_id, instance.code)})
+    instance._hierarchy = (
+        {version_id for version_id, _ in instance._materialized},
+        [instance.parent_code], instance.code)
+
+
+@receiver(post_delete, sender=Element)
+def element_deleted(sender, instance, origin=None, **kwargs):
+    if not deleted_per_instance(origin):
+        return
+    invalidate_version(instance.version_id)
+    apply_materialized(instance.__dict__.pop('_materialized', {}))
+    apply_hierarchy(instance)
+
+
+@receiver(elements_changing, sender=Element)
+def elements_before_change(sender, keys, state, created=(), **kwargs):
+    state['materialized'] = materialized(keys, created)
+    state['created'] = created
+
+
+@receiver(elements_changed, sender=Element)
+def elements_after_change(sender, keys, state, structure=True,
+                          parents=False, **kwargs):
+    before = state['materialized']
+    apply_materialized(before, state['created'])
+    if structure:
+        schedule_hierarchy({version_id for version_id, _ in before}, parents)
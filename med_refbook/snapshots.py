@@ -0,0 +1,218 @@
+"""Двоичные снимки версий справочников.
+
+Снимок - неизменяемый файл с полным содержимым версии:
+
+- заголовок ``HEADER`` (магическое значение, версия формата, число
+  элементов, идентификатор версии, смещения таблицы элементов и индекса,
+  отпечаток содержимого);
+- метаданные версии - JSON в UTF-8 с длиной (uint32) перед ним;
+- таблица элементов в порядке кодов, в котором их отдаёт СУБД: длина кода
+  (uint32), код, длина значения (uint32), значение;
+- индекс - смещения (uint64) элементов таблицы, упорядоченные по байтам
+  кода в UTF-8.
+
+Все числа - little-endian. Индекс позволяет искать код двоичным поиском по
+отображённому в память файлу (``SnapshotReader``), не читая его целиком.
+Снимки кэшируются на диске в ``MED_REFBOOK_SNAPSHOT_DIR`` под именем
+``<id версии>-<отпечаток>.mrbs``: изменение содержимого версии меняет
+отпечаток и, следовательно, файл."""
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+
+from django.conf import settings
+
+from . import fingerprints
+from .models import Element
+
+MAGIC = b'MEDRBSNP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sHHIQQQ16s')
+LENGTH = struct.Struct('<I')
+OFFSET = struct.Struct('<Q')
+SUFFIX = '.mrbs'
+
+# Строк, читаемых из БД за один запрос курсора, и размер буфера записи
+CHUNK_SIZE = 2000
+WRITE_BUFFER = 1 << 20
+
+
+class SnapshotFormatError(ValueError):
+    pass
+
+
+def snapshot_dir():
+    return Path(getattr(settings, 'MED_REFBOOK_SNAPSHOT_DIR', None)
+                or Path(settings.BASE_DIR) / 'snapshots')
+
+
+def snapshot_path(version):
+    return snapshot_dir() / f'{version.pk}-{version.fingerprint}{SUFFIX}'
+
+
+def ensure_snapshot(version):
+    """Путь к снимку версии; снимок создаётся, если его ещё нет.
+
+    Снимки прежнего содержимого версии удаляются."""
+    path = snapshot_path(version)
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    written = write_snapshot(version, path)
+    for stale in path.parent.glob(f'{version.pk}-*{SUFFIX}'):
+        if stale != path and stale != written:
+            stale.unlink(missing_ok=True)
+    return written
+
+
+def write_snapshot(version, path):
+    """Запись снимка версии в файл ``path`` (атомарно, через временный файл).
+
+    Элементы читаются из БД частями по ``CHUNK_SIZE`` и сразу пишутся в
+    файл; в памяти остаются только смещения записей. Если содержимое версии
+    изменилось после чтения отпечатка, файл кэша получает имя по отпечатку
+    прочитанного содержимого; возвращается фактический путь."""
+    path = Path(path)
+    meta = json.dumps({
+        'refbook_id': version.refbook_id,
+        'version': version.version,
+        'date_start': version.date_start.isoformat(),
+    }, ensure_ascii=False).encode()
+    records_offset = HEADER.size + LENGTH.size + len(meta)
+    descriptor, temporary = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w+b', buffering=WRITE_BUFFER) as file:
+            file.write(bytes(HEADER.size))
+            file.write(LENGTH.pack(len(meta)) + meta)
+            offsets = array('Q')
+            position = records_offset
+            total = 0
+            previous = b''
+            in_byte_order = True
+            for code, value in Element.objects.ordered_pairs(
+                    version).iterator(chunk_size=CHUNK_SIZE):
+                total += fingerprints.element_hash(code, value)
+                code, value = code.encode(), value.encode()
+                in_byte_order = in_byte_order and previous <= code
+                previous = code
+                offsets.append(position)
+                record = b''.join((LENGTH.pack(len(code)), code,
+                                   LENGTH.pack(len(value)), value))
+                file.write(record)
+                position += len(record)
+            if not in_byte_order:
+                # Правило сравнения строк СУБД не совпадает с порядком байтов
+                # UTF-8: индекс упорядочивается по кодам, прочитанным из файла
+                file.flush()
+                offsets = _sorted_by_code(file, offsets)
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+            offsets.tofile(file)
+            fingerprint = f'{total % fingerprints.MODULUS:032x}'
+            file.seek(0)
+            file.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION, 0, len(offsets), version.pk,
+                records_offset, position, bytes.fromhex(fingerprint)))
+        if path == snapshot_path(version) and (
+                fingerprint != version.fingerprint):
+            path = path.with_name(f'{version.pk}-{fingerprint}{SUFFIX}')
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return path
+
+
+def _sorted_by_code(file, offsets):
+    """Смещения записей, упорядоченные по байтам кода."""
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as records:
+        def code(offset):
+            length, = LENGTH.unpack_from(records, offset)
+            start = offset + LENGTH.size
+            return records[start:start + length]
+
+        return array('Q', sorted(offsets, key=code))
+
+
+class SnapshotReader:
+    """Чтение снимка через отображение файла в память.
+
+    ``get`` ищет код двоичным поиском по индексу снимка; в память
+    подгружаются только прочитанные страницы файла."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header()
+        except (struct.error, ValueError) as error:
+            self._mmap.close()
+            raise SnapshotFormatError(f'{path}: {error}') from error
+
+    def _read_header(self):
+        (magic, format_version, _, self.count, self.version_id,
+         records_offset, self._index_offset, fingerprint) = \
+            HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError('файл не является снимком справочника')
+        if format_version != FORMAT_VERSION:
+            raise ValueError(f'неподдерживаемая версия формата '
+                             f'{format_version}')
+        if self._index_offset + self.count * OFFSET.size > len(self._mmap):
+            raise ValueError('файл снимка обрезан')
+        self.fingerprint = fingerprint.hex()
+        meta_length, = LENGTH.unpack_from(self._mmap, HEADER.size)
+        start = HEADER.size + LENGTH.size
+        self.meta = json.loads(self._mmap[start:start + meta_length])
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+
+    def _field(self, offset):
+        """Поле с длиной по смещению: (байты, смещение следующего поля)."""
+        length, = LENGTH.unpack_from(self._mmap, offset)
+        start = offset + LENGTH.size
+        return self._mmap[start:start + length], start + length
+
+    def _record(self, index):
+        offset, = OFFSET.unpack_from(self._mmap,
+                                     self._index_offset + index * OFFSET.size)
+        return offset
+
+    def get(self, code, default=None):
+        """Значение элемента с кодом ``code`` или ``default``."""
+        key = code.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            current, value_offset = self._field(self._record(middle))
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return self._field(value_offset)[0].decode()
+        return default
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+    def __iter__(self):
+        """Пары (код, значение) в порядке кодов."""
+        for index in range(self.count):
+            code, value_offset = self._field(self._record(index))
+            yield code.decode(), self._field(value_offset)[0].decode()
@@ -0,0 +1,90 @@
+import json
+
+from django.http import StreamingHttpResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson не обязателен
+    orjson = None
+
+# Сколько строк склеивается в один фрагмент потокового ответа
+CHUNK_ROWS = 1000
+
+STREAM_FORMATS = ('ndjson', 'json')
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def _chunks(lines):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == CHUNK_ROWS:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def ndjson_lines(objects):
+    """Объекты в формате NDJSON: по одному JSON-документу на строку."""
+    return _chunks(_dumps(obj) + '\n' for obj in objects)
+
+
+def json_array(key, objects):
+    """Объекты как документ ``{"<key>": [...]}``, формируемый по частям."""
+    yield '{' + _dumps(key) + ':['
+    yield from _chunks(_separated(objects))
+    yield ']}'
+
+
+def _separated(objects):
+    separator = ''
+    for obj in objects:
+        yield separator + _dumps(obj)
+        separator = ','
+
+
+async def _abatches(objects):
+    batch = []
+    async for obj in objects:
+        batch.append(obj)
+        if len(batch) == CHUNK_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _aencoded(stream_format, key, objects):
+    """Асинхронный вариант ``ndjson_lines`` и ``json_array``."""
+    if stream_format == 'ndjson':
+        async for batch in _abatches(objects):
+            yield ''.join(_dumps(obj) + '\n' for obj in batch)
+        return
+    yield '{' + _dumps(key) + ':['
+    separator = ''
+    async for batch in _abatches(objects):
+        yield separator + ','.join(map(_dumps, batch))
+        separator = ','
+    yield ']}'
+
+
+def streaming_response(stream_format, key, objects):
+    """Потоковый ответ в формате ``ndjson`` или ``json``.
+
+    Объекты читаются из итератора (или асинхронного итератора) по мере
+    отправки, поэтому потребление памяти не зависит от их числа."""
+    content_type = ('application/x-ndjson' if stream_format == 'ndjson'
+                    else 'application/json')
+    if hasattr(objects, '__aiter__'):
+        content = _aencoded(stream_format, key, objects)
+    elif stream_format == 'ndjson':
+        content = ndjson_lines(objects)
+    else:
+        content = json_array(key, objects)
+    return StreamingHttpResponse(content, content_type=content_type)
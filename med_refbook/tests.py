@@ -1,9 +1,49 @@
+import gzip
+import io
+import json
+
+import brotli
 import pytest
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import NotSupportedError, connection, transaction
+from django.db.models import Value
+from django.db.models.signals import post_save
+from django.db.models.functions import Concat
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
 from datetime import date
-from .models import Element, Refbook, Version
+from . import (caching, fingerprints, hierarchy, importers, instrumentation,
+               precompressed, renderers, schema, snapshots, views)
+from .index import ElementIndex, element_index
+from .models import Element, ElementClosure, Refbook, Version
+from .normalization import normalize_value
+from .resolvers import CurrentVersionResolver, current_version_resolver
+from .revisions import refbook_revisions
+from .routers import ReplicaRouter, replica_reads
+from .search import VersionSearch, search_index
+from .serializers import ElementSerializer
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Внутрипроцессные кэши не должны переживать тест"""
+    element_index.clear()
+    search_index.clear()
+    current_version_resolver.clear()
+    refbook_revisions.clear()
+    instrumentation.metrics.clear()
+    cache.clear()
+    yield
+    element_index.clear()
+    search_index.clear()
+    current_version_resolver.clear()
+    refbook_revisions.clear()
+    instrumentation.metrics.clear()
+    cache.clear()
 
 
 @pytest.fixture
@@ -185,3 +225,2218 @@ def test_check_element_missing_parameters(api_client, setup_refbooks):
     assert response.status_code == status.HTTP_400_BAD_REQUEST
     assert response.json() == {
         'detail': "Параметры 'code' и 'value' обязательны."}
+
+
+@pytest.mark.django_db
+def test_check_element_warm_index_without_queries(
+        api_client, setup_refbooks, django_assert_num_queries):
+    """Повторная проверка с указанием версии не обращается к БД"""
+    _, refbook2, *_ = setup_refbooks
+    url = reverse('check-element', kwargs={'id': refbook2.id})
+    params = {'code': 'J01', 'value': 'Test Value 2.0', 'version': 'v1'}
+    api_client.get(url, params)
+    with django_assert_num_queries(0):
+        response = api_client.get(url, params)
+    assert response.json() == {'exists': True}
+
+
+@pytest.mark.django_db
+def test_check_element_index_invalidated_on_element_change(api_client,
+                                                           setup_refbooks):
+    """Изменение элемента сбрасывает версию в индексе"""
+    refbook1, _, version_1_1, _, _ = setup_refbooks
+    url = reverse('check-element', kwargs={'id': refbook1.id})
+    params = {'code': 'J00', 'value': 'Test Value 1.0', 'version': 'v1'}
+    assert api_client.get(url, params).json() == {'exists': True}
+    element = Element.objects.get(version=version_1_1, code='J00')
+    element.value = 'Changed'
+    element.save()
+    assert api_client.get(url, params).json() == {'exists': False}
+    element.delete()
+    params['value'] = 'Changed'
+    assert api_client.get(url, params).json() == {'exists': False}
+
+
+@pytest.mark.django_db
+def test_check_element_sees_changes_made_past_signals(
+        api_client, setup_refbooks, monkeypatch):
+    """Изменение, сделанное другим процессом (сигналы этого процесса не
+    срабатывают), видно после сверки с БД"""
+    refbook1, _, version_1_1, _, _ = setup_refbooks
+    monkeypatch.setattr(refbook_revisions, 'interval', 0)
+    url = reverse('check-element', kwargs={'id': refbook1.id})
+    versioned = {'code': 'J00', 'value': 'Test Value 1.0', 'version': 'v1'}
+    current = {'code': 'J00', 'value': 'Test Value 1.0'}
+    assert api_client.get(url, versioned).json() == {'exists': True}
+    assert api_client.get(url, current).json() == {'exists': True}
+    Element.objects.untracked().filter(
+        version=version_1_1, code='J00').update(value='Changed')
+    Version.objects.filter(pk=version_1_1.pk).update(
+        fingerprint=fingerprints.compute([('J00', 'Changed')]))
+    assert api_client.get(url, versioned).json() == {'exists': False}
+    assert api_client.get(url, current).json() == {'exists': False}
+    assert api_client.get(url, {**current, 'value': 'Changed'}).json() == {
+        'exists': True}
+
+
+@pytest.mark.django_db
+def test_element_index_evicts_least_recently_used(setup_refbooks):
+    """При превышении бюджета вытесняется давно не использованная версия"""
+    _, _, version_1_1, version_1_2, version_2_1 = setup_refbooks
+    Element.objects.create(version=version_2_1, code="J02", value="Value")
+    index = ElementIndex(max_elements=2)
+    assert index.contains(version_1_1, 'J00', 'Test Value 1.0')
+    assert index.contains(version_1_2, 'J01', 'Test Value 2.0')
+    index.get(version_1_1)
+    index.get(version_2_1)
+    assert index.size == 2
+    assert index.lookup(version_1_2.refbook_id, 'v1') is None
+    assert index.lookup(version_1_1.refbook_id, 'v1') == {
+        ('J00', 'Test Value 1.0')}
+
+
+@pytest.mark.django_db
+def test_check_elements_batch(api_client, setup_refbooks):
+    """Пакетная проверка возвращает результаты в порядке запроса"""
+    _, refbook2, _, _, version_2_1 = setup_refbooks
+    Element.objects.create(version=version_2_1, code="J02", value="Value")
+    url = reverse('check-elements', kwargs={'id': refbook2.id})
+    response = api_client.post(url, [
+        {'code': 'J02', 'value': 'Value'},
+        {'code': 'J01', 'value': 'Test Value 2.0', 'version': 'v1'},
+        {'code': 'J01', 'value': 'Test Value 2.0'},
+        {'code': 'J01', 'value': 'Test Value 2.0', 'version': 'v3'},
+    ], format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert [item['exists'] for item in response.json()['results']] == [
+        True, True, False, False]
+    assert response.json()['results'][3]['detail'] == (
+        'Не найдено валидной версии справочника.')
+
+
+@pytest.mark.django_db
+def test_check_elements_batch_queries(api_client, setup_refbooks,
+                                      django_assert_max_num_queries):
+    """Число запросов не зависит от размера пакета"""
+    _, refbook2, *_ = setup_refbooks
+    url = reverse('check-elements', kwargs={'id': refbook2.id})
+    items = [{'code': f'J{number}', 'value': 'Value', 'version': 'v1'}
+             for number in range(100)]
+    with django_assert_max_num_queries(3):
+        response = api_client.post(url, items, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()['results']) == 100
+
+
+@pytest.mark.django_db
+def test_check_elements_batch_validation(api_client, setup_refbooks):
+    """Некорректное тело запроса и превышение размера пакета"""
+    refbook1, *_ = setup_refbooks
+    url = reverse('check-elements', kwargs={'id': refbook1.id})
+    response = api_client.post(url, {'code': 'J00'}, format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = api_client.post(url, [{'code': 'J00'}], format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = api_client.post(
+        url, [{'code': 'J00', 'value': 'V'}] * 1001, format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    url = reverse('check-elements', kwargs={'id': 999})
+    response = api_client.post(url, [], format='json')
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_check_elements_on_dates(api_client, setup_refbooks,
+                                 django_assert_max_num_queries):
+    """Версии разных справочников определяются по датам элементов, число
+    запросов не зависит от размера пакета"""
+    _, _, _, _, version_2_1 = setup_refbooks
+    Element.objects.create(version=version_2_1, code='J02', value='Value')
+    url = reverse('check-elements-on-dates')
+    items = [
+        {'refbook': 'MS1', 'code': 'J00', 'value': 'Test Value 1.0',
+         'date': '2022-09-01'},
+        {'refbook': 2, 'code': 'J01', 'value': 'Test Value 2.0',
+         'date': '2022-12-31'},
+        {'refbook': 'ICD-10', 'code': 'J01', 'value': 'Test Value 2.0',
+         'date': '2023-01-01'},
+        {'refbook': 'ICD-10', 'code': 'J02', 'value': 'Value'},
+        {'refbook': 'MS1', 'code': 'J00', 'value': 'Test Value 1.0',
+         'date': '2022-08-31'},
+        {'refbook': 'UNKNOWN', 'code': 'J00', 'value': 'Test Value 1.0'},
+    ]
+    with django_assert_max_num_queries(5):
+        response = api_client.post(url, items * 50, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    results = response.json()['results'][:len(items)]
+    assert [(result['version'], result['exists']) for result in results] == [
+        ('v1', True), ('v1', True), ('v2', False), ('v2', True),
+        (None, False), (None, False)]
+    assert results[1]['date'] == '2022-12-31'
+    assert results[4]['detail'] == 'Не найдено валидной версии справочника.'
+    assert results[5]['detail'] == 'Справочник не найден.'
+    for item in ({'refbook': True, 'code': 'J00', 'value': 'V'},
+                 {'code': 'J00', 'value': 'V'},
+                 {'refbook': 1, 'code': 'J00'},
+                 {'refbook': 1, 'code': 'J00', 'value': 'V',
+                  'date': '2022-02-30'}):
+        response = api_client.post(url, [item], format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_check_elements_on_dates_failures(api_client, two_versions,
+                                          monkeypatch):
+    """Пакет по датам видит изменения версий и элементов, в том числе
+    сделанные другим процессом, читает версии, хранящие изменения, и
+    отклоняет неверные пакеты целиком"""
+    from . import views
+    url = reverse('check-elements-on-dates')
+    items = [
+        {'refbook': 'ICD-10', 'code': 'J02', 'value': 'New',
+         'date': '2023-06-01'},
+        {'refbook': 'ICD-10', 'code': 'J03', 'value': 'Same',
+         'date': '2023-06-01'},
+        {'refbook': 'ICD-10', 'code': 'J02', 'value': 'Old',
+         'date': '2022-12-31'},
+        {'refbook': str(two_versions.id), 'code': 'J02', 'value': 'New'},
+    ]
+
+    def check():
+        response = api_client.post(url, items, format='json')
+        assert response.status_code == status.HTTP_200_OK
+        return [(result['version'], result['exists'])
+                for result in response.json()['results']]
+
+    assert check() == [('v2', True), ('v2', True), ('v1', True),
+                       (None, False)]
+    # Версия v2 загружена в индекс проверкой одного элемента
+    assert api_client.get(reverse('check-element', kwargs={
+        'id': two_versions.id}), {'code': 'J02', 'value': 'New'}).json() == {
+        'exists': True}
+    version = Version.objects.get(refbook=two_versions, version='v2')
+    element = Element.objects.get(version=version, code='J02')
+    element.value = 'Newer'
+    element.save()
+    assert check()[0] == ('v2', False)
+    # Изменение другим процессом: сигналы этого процесса не срабатывают
+    Element.objects.untracked().filter(version=version, code='J03').update(
+        value='Other')
+    Version.objects.filter(pk=version.pk).update(
+        fingerprint=fingerprints.compute(Element.objects.filter(
+            version=version).values_list('code', 'value')))
+    refbook_revisions.clear()
+    assert check()[1] == ('v2', False)
+    # Новая версия видна сразу: версии на даты читаются из БД
+    Version.objects.create(refbook=two_versions, version='v3',
+                           date_start=date(2023, 3, 1))
+    assert check()[0] == ('v3', False)
+    Version.objects.filter(version='v3').delete()
+    call_command('convert_refbook_versions', refbook=two_versions.code,
+                 to='delta', max_change_ratio=1, stdout=io.StringIO())
+    items[1]['value'] = 'Other'
+    items[3]['refbook'] = two_versions.id
+    items[3]['value'] = 'Newer'
+    assert check() == [('v2', False), ('v2', True), ('v1', True),
+                       ('v2', True)]
+    monkeypatch.setattr(views, 'CHECK_ELEMENTS_MAX_BATCH', 3)
+    for body in (items, {'items': items}, 'J02', [None],
+                 [{**items[0], 'date': 20230601}],
+                 [{**items[0], 'refbook': None}],
+                 [{**items[0], 'code': 2}]):
+        response = api_client.post(url, body, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST, body
+
+
+@pytest.mark.django_db
+def test_warm_refbook_cache(api_client, setup_refbooks, monkeypatch,
+                            django_assert_num_queries):
+    """После прогрева процессы загружают элементы текущих версий из общего
+    кэша, а после изменения версии - снова из БД"""
+    monkeypatch.setattr(caching, 'ELEMENTS_CACHE_TIMEOUT', 60)
+    refbook1, *_ = setup_refbooks
+    out = io.StringIO()
+    call_command('warm_refbook_cache', refbook=['MS1'], stdout=out,
+                 stderr=io.StringIO())
+    assert 'версия v1: 1 элементов' in out.getvalue()
+    url = reverse('check-element', kwargs={'id': refbook1.id})
+    # Только ревизия справочника, элементы - из общего кэша
+    with django_assert_num_queries(1):
+        response = api_client.get(url, {'code': 'J00',
+                                        'value': 'Test Value 1.0'})
+    assert response.json() == {'exists': True}
+    Element.objects.create(version_id=setup_refbooks[2].pk, code='J05',
+                           value='Новый')
+    response = api_client.get(url, {'code': 'J05', 'value': 'Новый'})
+    assert response.json() == {'exists': True}
+    with pytest.raises(CommandError):
+        call_command('warm_refbook_cache', refbook=['UNKNOWN'],
+                     stderr=io.StringIO())
+
+
+@pytest.mark.django_db
+def test_warm_refbook_cache_reports_items_not_stored(setup_refbooks,
+                                                     monkeypatch):
+    """Записи, которые бэкенд не сохранил без ошибки (memcached - больше
+    1 МБ), перечисляются, и команда завершается с ошибкой"""
+    import pickle
+    _, _, version_1_1, _, _ = setup_refbooks
+    Element.objects.bulk_create([
+        Element(version=version_1_1, code=f'K{number:04}', value='x' * 100)
+        for number in range(100)])
+    monkeypatch.setattr(caching, 'ELEMENTS_CACHE_TIMEOUT', 60)
+    set_value = cache.set
+
+    def limited_set(key, value, *args, **kwargs):
+        # Как memcached: слишком большая запись молча не сохраняется
+        if len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) <= 4096:
+            set_value(key, value, *args, **kwargs)
+
+    monkeypatch.setattr(cache, 'set', limited_set)
+    out, err = io.StringIO(), io.StringIO()
+    with pytest.raises(CommandError, match='записей: 1'):
+        call_command('warm_refbook_cache', stdout=out, stderr=err)
+    assert 'Справочник 1, версия v1: не сохранено в кэше' in err.getvalue()
+    assert 'Справочник 2, версия v2: 0 элементов' in out.getvalue()
+    assert 'Список справочников' in out.getvalue()
+
+
+def test_get_or_load_waits_for_concurrent_load(monkeypatch):
+    """Промах при загрузке значения другим процессом не обращается к
+    источнику, а дожидается значения в кэше"""
+    import threading
+
+    def load():
+        raise AssertionError('значение загружает другой процесс')
+
+    cache.add('test:key:lock', True, 10)
+    timer = threading.Timer(0.1, cache.set, ('test:key', 'value', 10))
+    timer.start()
+    assert caching.get_or_load('test:key', load, 10) == 'value'
+    timer.join()
+    monkeypatch.setattr(caching, 'LOCK_TIMEOUT', 0)
+    assert caching.get_or_load('test:other', lambda: 'loaded', 10) == 'loaded'
+    assert cache.get('test:other') == 'loaded'
+    assert cache.get('test:other:lock') is None
+
+
+@pytest.fixture
+def large_version(setup_refbooks):
+    """Версия с несколькими элементами для постраничной выдачи"""
+    refbook1, _, version_1_1, _, _ = setup_refbooks
+    Element.objects.bulk_create(
+        Element(version=version_1_1, code=f'K{number:02d}',
+                value=f'Значение {number}') for number in range(5))
+    return refbook1, version_1_1
+
+
+@pytest.mark.django_db
+def test_get_elements_paginated(api_client, large_version):
+    """Постраничная выдача по курсору возвращает все элементы по порядку"""
+    refbook, _ = large_version
+    url = reverse('element-list', kwargs={'id': refbook.id})
+    codes = []
+    params = {'version': 'v1', 'limit': 2}
+    while True:
+        response = api_client.get(url, params)
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        assert len(data['elements']) <= 2
+        codes += [element['code'] for element in data['elements']]
+        if data['next'] is None:
+            break
+        params['cursor'] = data['next']
+    assert codes == ['J00', 'K00', 'K01', 'K02', 'K03', 'K04']
+
+
+@pytest.mark.django_db
+def test_get_elements_paginated_invalid_params(api_client, large_version):
+    """Некорректные limit и cursor"""
+    refbook, _ = large_version
+    url = reverse('element-list', kwargs={'id': refbook.id})
+    response = api_client.get(url, {'limit': 0})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = api_client.get(url, {'limit': 'many'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = api_client.get(url, {'cursor': '%%%'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_get_elements_stream(api_client, large_version):
+    """Потоковая выдача в форматах ndjson и json"""
+    refbook, _ = large_version
+    url = reverse('element-list', kwargs={'id': refbook.id})
+    response = api_client.get(url, {'stream': 'ndjson'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response['Content-Type'] == 'application/x-ndjson'
+    lines = b''.join(response.streaming_content).decode().splitlines()
+    assert len(lines) == 6
+    assert json.loads(lines[1]) == {'code': 'K00', 'value': 'Значение 0'}
+    response = api_client.get(url, {'stream': 'json'})
+    data = json.loads(b''.join(response.streaming_content))
+    assert [element['code'] for element in data['elements']] == [
+        'J00', 'K00', 'K01', 'K02', 'K03', 'K04']
+    response = api_client.get(url, {'stream': 'xml'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_check_element_current_version_without_queries(
+        api_client, setup_refbooks, django_assert_num_queries):
+    """Повторная проверка в текущей версии не обращается к БД"""
+    refbook1, *_ = setup_refbooks
+    url = reverse('check-element', kwargs={'id': refbook1.id})
+    params = {'code': 'J00', 'value': 'Test Value 1.0'}
+    api_client.get(url, params)
+    with django_assert_num_queries(0):
+        response = api_client.get(url, params)
+    assert response.json() == {'exists': True}
+
+
+@pytest.mark.django_db
+def test_current_version_expires_at_next_date_start(
+        setup_refbooks, django_assert_num_queries):
+    """Запись кэша действует до даты начала следующей версии"""
+    _, refbook2, _, version_1_2, version_2_1 = setup_refbooks
+    resolver = CurrentVersionResolver()
+    with django_assert_num_queries(1):
+        assert resolver.resolve(refbook2.id, today=date(2022, 12, 31)) == (
+            version_1_2)
+        assert resolver.resolve(refbook2.id, today=date(2022, 12, 31)) == (
+            version_1_2)
+    # Следующая версия выбирается по той же ревизии справочника
+    with django_assert_num_queries(0):
+        assert resolver.resolve(refbook2.id, today=date(2023, 1, 1)) == (
+            version_2_1)
+    with django_assert_num_queries(0):
+        assert resolver.resolve(refbook2.id, today=date(2030, 1, 1)) == (
+            version_2_1)
+
+
+@pytest.mark.django_db
+def test_current_version_revalidated_against_db(api_client, setup_refbooks,
+                                                monkeypatch):
+    """Версии, изменённые другим процессом, и новый отпечаток текущей версии
+    видны после сверки с БД, в том числе в ETag"""
+    refbook1, _, version_1_1, _, _ = setup_refbooks
+    monkeypatch.setattr(refbook_revisions, 'interval', 0)
+    url = reverse('element-list', kwargs={'id': refbook1.id})
+    etag = api_client.get(url)['ETag']
+    assert current_version_resolver.resolve(refbook1.id) == version_1_1
+    Version.objects.filter(pk=version_1_1.pk).update(
+        fingerprint=fingerprints.compute([('J00', 'Changed')]))
+    assert current_version_resolver.resolve(refbook1.id).fingerprint == (
+        fingerprints.compute([('J00', 'Changed')]))
+    assert api_client.get(url)['ETag'] != etag
+    newer, = Version.objects.bulk_create([Version(
+        refbook=refbook1, version='v2', date_start=date(2023, 1, 1))])
+    assert current_version_resolver.resolve(refbook1.id) == newer
+
+
+@pytest.mark.django_db
+def test_current_version_invalidated_on_version_change(api_client,
+                                                       setup_refbooks):
+    """Новая версия сразу становится текущей"""
+    refbook1, *_ = setup_refbooks
+    url = reverse('element-list', kwargs={'id': refbook1.id})
+    assert api_client.get(url).data['elements'][0]['code'] == 'J00'
+    version = Version.objects.create(refbook=refbook1, version='v2',
+                                     date_start=date(2023, 1, 1))
+    Element.objects.create(version=version, code='J10', value='New')
+    assert api_client.get(url).data['elements'][0]['code'] == 'J10'
+    version.delete()
+    assert api_client.get(url).data['elements'][0]['code'] == 'J00'
+
+
+@pytest.mark.django_db
+def test_admin_refbook_current_version_in_list_query(
+        admin_client, setup_refbooks, django_assert_max_num_queries):
+    """Текущая версия в списке справочников без запроса на каждую строку"""
+    for number in range(20):
+        refbook = Refbook.objects.create(code=f'R{number}', name='Справочник')
+        Version.objects.create(refbook=refbook, version='v1',
+                               date_start=date(2020, 1, 1))
+    url = reverse('admin:med_refbook_refbook_changelist')
+    with django_assert_max_num_queries(8):
+        response = admin_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    content = response.content.decode()
+    assert '<td class="field-current_version">v2</td>' in content
+    response = admin_client.get(url, {'o': '-4'})
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+def test_admin_version_elements_paginated(admin_client, setup_refbooks):
+    """На странице версии редактируется одна страница элементов"""
+    _, _, version, _, _ = setup_refbooks
+    Element.objects.bulk_create(
+        Element(version=version, code=f'K{number:03d}', value='Значение')
+        for number in range(120))
+    url = reverse('admin:med_refbook_version_change', args=[version.pk])
+    response = admin_client.get(url)
+    formset = response.context['inline_admin_formsets'][0].formset
+    assert [form.instance.code for form in formset.initial_forms][:2] == [
+        'J00', 'K000']
+    assert len(formset.initial_forms) == 50
+    assert 'Страница 1 из 3' in response.content.decode()
+    response = admin_client.get(url, {'elements_page': 3})
+    formset = response.context['inline_admin_formsets'][0].formset
+    assert len(formset.initial_forms) == 21
+    data = {
+        'refbook': version.refbook_id, 'version': version.version,
+        'date_start': version.date_start.isoformat(),
+        'elements-TOTAL_FORMS': 21, 'elements-INITIAL_FORMS': 21,
+        'elements-MIN_NUM_FORMS': 0, 'elements-MAX_NUM_FORMS': 1000,
+    }
+    for number, form in enumerate(formset.initial_forms):
+        data.update({f'elements-{number}-id': form.instance.pk,
+                     f'elements-{number}-version': version.pk,
+                     f'elements-{number}-code': form.instance.code,
+                     f'elements-{number}-value': form.instance.value})
+    data['elements-20-value'] = 'Изменено'
+    response = admin_client.post(f'{url}?elements_page=3', data)
+    assert response.status_code == status.HTTP_302_FOUND
+    assert Element.objects.get(version=version, code='K119').value == \
+        'Изменено'
+
+
+@pytest.mark.django_db
+def test_admin_version_elements_failures(admin_client, two_versions):
+    """Номер страницы вне диапазона, сдвиг страницы между открытием и
+    сохранением и версии, хранящие изменения; число запросов страницы
+    версии не зависит от числа элементов"""
+    version = Version.objects.get(refbook=two_versions, version='v2')
+    Element.objects.bulk_create(
+        Element(version=version, code=f'K{number:03d}', value='Значение')
+        for number in range(97))
+    url = reverse('admin:med_refbook_version_change', args=[version.pk])
+    for page, expected in (('abc', 1), ('-5', 1), ('0', 1), ('999', 2)):
+        response = admin_client.get(url, {'elements_page': page})
+        assert response.status_code == status.HTTP_200_OK
+        assert f'Страница {expected} из 2' in response.content.decode()
+        formset = response.context['inline_admin_formsets'][0].formset
+        assert len(formset.initial_forms) == 50
+    response = admin_client.get(url, {'elements_page': 2})
+    formset = response.context['inline_admin_formsets'][0].formset
+    data = {
+        'refbook': version.refbook_id, 'version': version.version,
+        'date_start': version.date_start.isoformat(),
+        'elements-TOTAL_FORMS': 50, 'elements-INITIAL_FORMS': 50,
+        'elements-MIN_NUM_FORMS': 0, 'elements-MAX_NUM_FORMS': 1000,
+    }
+    for number, form in enumerate(formset.initial_forms):
+        data.update({f'elements-{number}-id': form.instance.pk,
+                     f'elements-{number}-version': version.pk,
+                     f'elements-{number}-code': form.instance.code,
+                     f'elements-{number}-value': form.instance.value})
+    data['elements-0-value'] = 'Изменено'
+    first = formset.initial_forms[0].instance
+    # Другой пользователь добавил элемент: страница 2 сдвинулась
+    Element.objects.create(version=version, code='A00', value='Новый')
+    response = admin_client.post(f'{url}?elements_page=2', data)
+    assert response.status_code == status.HTTP_302_FOUND
+    first.refresh_from_db()
+    assert first.value == 'Изменено'
+    assert Element.objects.filter(version=version).count() == 101
+    # Версия, хранящая изменения: элементы ниже - только изменения, выше -
+    # полное содержимое
+    call_command('convert_refbook_versions', refbook=two_versions.code,
+                 to='delta', max_change_ratio=1, stdout=io.StringIO())
+    content = admin_client.get(url).content.decode()
+    assert f'Всего: {Element.objects.materialized(version).count()}' in \
+        content
+    with CaptureQueriesContext(connection) as before:
+        admin_client.get(url)
+    Element.objects.bulk_create(
+        Element(version=version, code=f'M{number:04d}', value='М')
+        for number in range(500))
+    with CaptureQueriesContext(connection) as after:
+        admin_client.get(url)
+    assert len(after) == len(before)
+
+
+@pytest.mark.parametrize('name, content', [
+    ('release.csv', 'code;value\nA1;Грипп\nA2;Насморк\n'),
+    ('release.json', '[{"code": "A1", "value": "Грипп"},\n'
+                     ' {"code": "A2", "value": "Насморк"}]'),
+    ('release.json', '{"elements": [{"code": "A1", "value": "Грипп"}, '
+                     '{"code": "A2", "value": "Насморк"}]}'),
+    ('release.ndjson', '{"code": "A1", "value": "Грипп"}\n'
+                       '{"code": "A2", "value": "Насморк"}\n'),
+    ('release.xml', '<?xml version="1.0" encoding="utf-8"?><elements>'
+                    '<element code="A1" value="Грипп"/>'
+                    '<element><code>A2</code><value>Насморк</value>'
+                    '</element></elements>'),
+])
+@pytest.mark.django_db
+def test_import_refbook(tmp_path, monkeypatch, name, content):
+    """Импорт версии справочника из файлов разных форматов"""
+    monkeypatch.setattr(importers, 'CHUNK_SIZE', 8)
+    path = tmp_path / name
+    path.write_text(content, encoding='utf-8')
+    call_command('import_refbook', str(path), refbook='NEW', name='Новый',
+                 refbook_version='1.0', date_start='2024-01-01', delimiter=';',
+                 batch_size=1, stdout=io.StringIO())
+    version = Version.objects.get(refbook__code='NEW', version='1.0')
+    assert set(version.elements.values_list('code', 'value')) == {
+        ('A1', 'Грипп'), ('A2', 'Насморк')}
+
+
+@pytest.mark.django_db
+def test_import_refbook_from_stdin_keeps_it_open(monkeypatch):
+    """Импорт из стандартного ввода не закрывает его"""
+    stdin = io.StringIO('code,value\nA1,Грипп\n')
+    monkeypatch.setattr('sys.stdin', stdin)
+    call_command('import_refbook', '-', refbook='NEW', name='Новый',
+                 refbook_version='1.0', date_start='2024-01-01',
+                 format='csv', stdout=io.StringIO())
+    assert not stdin.closed
+    assert Element.objects.filter(code='A1', value='Грипп').exists()
+
+
+@pytest.mark.django_db
+def test_import_refbook_dry_run(tmp_path, setup_refbooks):
+    """Проверочный прогон ничего не сохраняет и находит повторы кодов"""
+    path = tmp_path / 'release.csv'
+    path.write_text('code,value\nA1,Грипп\nA2,Насморк\n', encoding='utf-8')
+    out = io.StringIO()
+    call_command('import_refbook', str(path), refbook='MS1',
+                 refbook_version='v2', date_start='2024-01-01', dry_run=True,
+                 stdout=out)
+    assert 'Проверено элементов: 2' in out.getvalue()
+    assert not Version.objects.filter(version='v2',
+                                      refbook__code='MS1').exists()
+    path.write_text('code,value\nA1,Грипп\nA1,Насморк\n', encoding='utf-8')
+    with pytest.raises(CommandError, match='повторяется'):
+        call_command('import_refbook', str(path), refbook='MS1',
+                     refbook_version='v2', date_start='2024-01-01',
+                     dry_run=True)
+    with pytest.raises(CommandError, match='уже существует'):
+        call_command('import_refbook', str(path), refbook='MS1',
+                     refbook_version='v1', date_start='2024-01-01')
+
+
+LARGE_TABLES = ('med_refbook_element', 'med_refbook_version')
+
+
+@pytest.fixture
+def seeded_database(db):
+    """Несколько справочников с версиями на десятки тысяч элементов"""
+    refbooks = []
+    for refbook_number in range(4):
+        refbook = Refbook.objects.create(code=f'R{refbook_number}',
+                                         name=f'Справочник {refbook_number}')
+        for year in (2020, 2021, 2022):
+            version = Version.objects.create(refbook=refbook,
+                                             version=f'v{year}',
+                                             date_start=date(year, 1, 1))
+            Element.objects.bulk_create(
+                Element(version=version, code=f'C{number:05d}',
+                        value=f'Значение {number}')
+                for number in range(2000))
+        refbooks.append(refbook)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    return refbooks
+
+
+def table_scans(sql, tables=LARGE_TABLES):
+    """Полные просмотры таблиц в плане выполнения запроса"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('EXPLAIN ' + sql)
+            return [row[0] for row in cursor.fetchall()
+                    if any(f'Seq Scan on {table}' in row[0]
+                           for table in tables)]
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        return [row[-1] for row in cursor.fetchall()
+                if any(row[-1].startswith(f'SCAN {table}')
+                       for table in tables)]
+
+
+@pytest.mark.django_db
+def test_endpoints_avoid_table_scans(api_client, seeded_database):
+    """Запросы всех эндпоинтов используют индексы больших таблиц"""
+    refbook = seeded_database[1]
+    element = {'code': 'C01999', 'value': 'Значение 1999'}
+    requests = [
+        ('element-list', {'id': refbook.id}, 'get', {}),
+        ('element-list', {'id': refbook.id}, 'get', {'version': 'v2021'}),
+        ('element-list', {'id': refbook.id}, 'get',
+         {'limit': 100, 'cursor': 'QzAxMDAw'}),
+        ('check-element', {'id': refbook.id}, 'get', element),
+        ('check-element', {'id': refbook.id}, 'get',
+         {**element, 'version': 'v2020'}),
+        ('version-diff', {'id': refbook.id}, 'get',
+         {'from': 'v2020', 'to': 'v2021'}),
+    ]
+    offenders = []
+    for name, kwargs, method, params in requests:
+        element_index.clear()
+        current_version_resolver.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(api_client, method)(
+                reverse(name, kwargs=kwargs), params)
+        assert response.status_code == status.HTTP_200_OK
+        for query in context.captured_queries:
+            offenders += [(name, query['sql'], scan)
+                          for scan in table_scans(query['sql'])]
+    with CaptureQueriesContext(connection) as context:
+        api_client.post(reverse('check-elements', kwargs={'id': refbook.id}),
+                        [element, {**element, 'version': 'v2020'}],
+                        format='json')
+    for query in context.captured_queries:
+        offenders += [('check-elements', query['sql'], scan)
+                      for scan in table_scans(query['sql'])]
+    # Список справочников перебирает весь каталог версий, поэтому для него
+    # недопустим только просмотр таблицы элементов
+    with CaptureQueriesContext(connection) as context:
+        api_client.get(reverse('refbook-list'), {'date': '2021-06-01'})
+    for query in context.captured_queries:
+        offenders += [('refbook-list', query['sql'], scan) for scan in
+                      table_scans(query['sql'], ('med_refbook_element',))]
+    assert not offenders
+
+
+def stored_fingerprint(version):
+    version.refresh_from_db()
+    return version.fingerprint
+
+
+@pytest.mark.django_db
+def test_version_fingerprint_maintained_on_write(setup_refbooks):
+    """Отпечаток версии обновляется при изменении элементов"""
+    refbook1, _, version_1_1, version_1_2, _ = setup_refbooks
+    assert stored_fingerprint(version_1_1) == fingerprints.compute(
+        [('J00', 'Test Value 1.0')])
+    element = Element.objects.create(version=version_1_1, code='J05',
+                                     value='Five')
+    element.value = 'Пять'
+    element.save()
+    assert stored_fingerprint(version_1_1) == fingerprints.compute(
+        [('J00', 'Test Value 1.0'), ('J05', 'Пять')])
+    element.version = version_1_2
+    element.save()
+    assert stored_fingerprint(version_1_1) == fingerprints.compute(
+        [('J00', 'Test Value 1.0')])
+    assert stored_fingerprint(version_1_2) == fingerprints.compute(
+        [('J01', 'Test Value 2.0'), ('J05', 'Пять')])
+    element.delete()
+    assert stored_fingerprint(version_1_2) == fingerprints.compute(
+        [('J01', 'Test Value 2.0')])
+
+
+@pytest.mark.django_db
+def test_version_fingerprint_maintained_on_bulk_writes(api_client,
+                                                       setup_refbooks):
+    """Пакетные изменения элементов (update, bulk_create, bulk_update) тоже
+    обновляют отпечатки версий и сбрасывают кэши"""
+    refbook1, _, version_1_1, version_1_2, _ = setup_refbooks
+    url = reverse('check-element', kwargs={'id': refbook1.id})
+    params = {'code': 'J00', 'value': 'Test Value 1.0', 'version': 'v1'}
+    assert api_client.get(url, params).json() == {'exists': True}
+    assert Element.objects.filter(version=version_1_1, code='J00').update(
+        value='Changed') == 1
+    assert stored_fingerprint(version_1_1) == fingerprints.compute(
+        [('J00', 'Changed')])
+    assert api_client.get(url, params).json() == {'exists': False}
+    five, six = Element.objects.bulk_create([
+        Element(version=version_1_1, code='J05', value='Five'),
+        Element(version=version_1_1, code='J06', value='Six')])
+    assert stored_fingerprint(version_1_1) == fingerprints.compute(
+        [('J00', 'Changed'), ('J05', 'Five'), ('J06', 'Six')])
+    five.value = 'Пять'
+    six.version = version_1_2
+    Element.objects.bulk_update([five, six], ['version', 'value'])
+    assert stored_fingerprint(version_1_1) == fingerprints.compute(
+        [('J00', 'Changed'), ('J05', 'Пять')])
+    assert stored_fingerprint(version_1_2) == fingerprints.compute(
+        [('J01', 'Test Value 2.0'), ('J06', 'Six')])
+    Element.objects.filter(code='J06').update(version=version_1_1)
+    assert stored_fingerprint(version_1_2) == fingerprints.compute(
+        [('J01', 'Test Value 2.0')])
+    with pytest.raises(NotSupportedError):
+        Element.objects.filter(code='J06').update(code=Concat('code',
+                                                              Value('x')))
+    Element.objects.untracked().filter(code='J06').update(value='Шесть')
+    assert stored_fingerprint(version_1_1) == fingerprints.compute(
+        [('J00', 'Changed'), ('J05', 'Пять'), ('J06', 'Six')])
+
+
+@pytest.mark.django_db
+def test_import_refbook_sets_fingerprint(tmp_path):
+    """Импорт без сигналов модели всё равно заполняет отпечаток"""
+    path = tmp_path / 'release.csv'
+    path.write_text('code,value\nA1,Грипп\nA2,Насморк\n', encoding='utf-8')
+    call_command('import_refbook', str(path), refbook='NEW', name='Новый',
+                 refbook_version='1.0', date_start='2024-01-01',
+                 batch_size=1, stdout=io.StringIO())
+    version = Version.objects.get(refbook__code='NEW')
+    assert version.fingerprint == fingerprints.compute(
+        [('A1', 'Грипп'), ('A2', 'Насморк')])
+
+
+@pytest.mark.django_db
+def test_get_elements_conditional(api_client, setup_refbooks,
+                                  django_assert_num_queries):
+    """Повторный запрос с If-None-Match получает 304 без запросов к БД"""
+    refbook1, _, version_1_1, _, _ = setup_refbooks
+    url = reverse('element-list', kwargs={'id': refbook1.id})
+    response = api_client.get(url)
+    etag = response['ETag']
+    assert response['Cache-Control'] == 'public, max-age=300'
+    with django_assert_num_queries(0):
+        response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response['ETag'] == etag
+    Element.objects.create(version=version_1_1, code='J05', value='Five')
+    response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_200_OK
+    assert response['ETag'] != etag
+
+
+@pytest.mark.django_db
+def test_get_elements_historical_version_is_immutable(api_client,
+                                                      setup_refbooks):
+    """Устаревшая версия отдаётся с неизменяемым Cache-Control"""
+    _, refbook2, *_ = setup_refbooks
+    url = reverse('element-list', kwargs={'id': refbook2.id})
+    response = api_client.get(url, {'version': 'v1'})
+    assert response['Cache-Control'] == (
+        'public, max-age=31536000, immutable')
+
+
+@pytest.mark.django_db
+def test_get_refbooks_conditional(api_client, setup_refbooks):
+    """ETag списка справочников меняется при изменении каталога"""
+    refbook1, *_ = setup_refbooks
+    url = reverse('refbook-list')
+    etag = api_client.get(url)['ETag']
+    response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    refbook1.name = 'Новое имя'
+    refbook1.save()
+    response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+def test_get_refbooks_active_on_date(api_client, setup_refbooks,
+                                     django_assert_num_queries):
+    """Только справочники с действующей на дату версией, одним запросом, с
+    действующей версией по запросу и без запросов к БД из кэша"""
+    url = reverse('refbook-list')
+    # Ревизия каталога (справочники и версии) и сам список
+    with django_assert_num_queries(3):
+        response = api_client.get(url, {'date': '2022-09-15'})
+    assert [refbook['id'] for refbook in response.json()['refbooks']] == [1]
+    with django_assert_num_queries(0):
+        assert api_client.get(url, {'date': '2022-09-15'}).json() == \
+            response.json()
+    response = api_client.get(url, {'date': '2023-06-01',
+                                    'include_current': 'true'})
+    assert response.json()['refbooks'] == [
+        {'id': 1, 'code': 'MS1', 'name': ' ', 'current_version': 'v1',
+         'current_version_date_start': '2022-09-01'},
+        {'id': 2, 'code': 'ICD-10', 'name': '-10', 'current_version': 'v2',
+         'current_version_date_start': '2023-01-01'}]
+    assert api_client.get(url, {'date': '2022-01-01'}).json() == {
+        'refbooks': []}
+    Version.objects.create(refbook_id=2, version='v0',
+                           date_start=date(2021, 1, 1))
+    assert [refbook['id'] for refbook in api_client.get(
+        url, {'date': '2022-09-15'}).json()['refbooks']] == [1, 2]
+    assert api_client.get(url, {'include_current': 'x'}).status_code == \
+        status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_refbook_list_sees_changes_made_past_signals(
+        api_client, setup_refbooks):
+    """Список справочников из кэша меняется с ревизией каталога в БД, в том
+    числе после изменений другим процессом (сигналы этого процесса не
+    срабатывают); кэш процесса хранит список недолго"""
+    from django.utils import timezone
+    if django_settings.MED_REFBOOK_CACHE_URL.startswith('locmem:'):
+        assert django_settings.MED_REFBOOK_REFBOOKS_CACHE_TIMEOUT == 300
+    url = reverse('refbook-list')
+    params = {'date': '2023-06-01', 'include_current': 'true'}
+    before = api_client.get(url, params).json()['refbooks']
+    assert [refbook['name'] for refbook in before] == [' ', '-10']
+    Refbook.objects.filter(pk=1).update(name='Другое',
+                                        updated_at=timezone.now())
+    Version.objects.filter(refbook_id=2, version='v2').update(
+        date_start=date(2024, 1, 1), updated_at=timezone.now())
+    # В пределах MED_REFBOOK_REVALIDATE_INTERVAL - прежняя ревизия
+    assert api_client.get(url, params).json()['refbooks'] == before
+    refbook_revisions.clear()
+    assert api_client.get(url, params).json()['refbooks'] == [
+        {'id': 1, 'code': 'MS1', 'name': 'Другое', 'current_version': 'v1',
+         'current_version_date_start': '2022-09-01'},
+        {'id': 2, 'code': 'ICD-10', 'name': '-10', 'current_version': 'v1',
+         'current_version_date_start': '2022-10-01'}]
+
+
+@pytest.fixture
+def two_versions(setup_refbooks):
+    """Две версии справочника с добавленными, удалёнными и изменёнными
+    элементами"""
+    _, refbook2, _, version_1_2, version_2_1 = setup_refbooks
+    Element.objects.create(version=version_1_2, code='J02', value='Old')
+    Element.objects.create(version=version_1_2, code='J03', value='Same')
+    Element.objects.create(version=version_2_1, code='J02', value='New')
+    Element.objects.create(version=version_2_1, code='J03', value='Same')
+    Element.objects.create(version=version_2_1, code='J04', value='Added')
+    return refbook2
+
+
+@pytest.mark.django_db
+def test_version_diff(api_client, two_versions, django_assert_num_queries):
+    """Отличия между версиями считаются на сервере и кэшируются"""
+    url = reverse('version-diff', kwargs={'id': two_versions.id})
+    params = {'from': 'v1', 'to': 'v2'}
+    response = api_client.get(url, params)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {
+        'added': [{'code': 'J04', 'value': 'Added'}],
+        'removed': [{'code': 'J01', 'value': 'Test Value 2.0'}],
+        'changed': [{'code': 'J02', 'value': 'New',
+                     'previous_value': 'Old'}],
+    }
+    with django_assert_num_queries(2):
+        cached = api_client.get(url, params)
+    assert cached.json() == response.json()
+    reverse_diff = api_client.get(url, {'from': 'v2', 'to': 'v1'}).json()
+    assert reverse_diff['added'] == [
+        {'code': 'J01', 'value': 'Test Value 2.0'}]
+
+
+@pytest.mark.django_db
+def test_version_diff_stream(api_client, two_versions):
+    """Потоковая выдача изменений в порядке кодов"""
+    url = reverse('version-diff', kwargs={'id': two_versions.id})
+    response = api_client.get(url, {'from': 'v1', 'to': 'v2',
+                                    'stream': 'ndjson'})
+    lines = b''.join(response.streaming_content).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'change': 'removed', 'code': 'J01', 'value': 'Test Value 2.0'},
+        {'change': 'changed', 'code': 'J02', 'value': 'New',
+         'previous_value': 'Old'},
+        {'change': 'added', 'code': 'J04', 'value': 'Added'},
+    ]
+
+
+@pytest.mark.django_db
+def test_version_diff_errors(api_client, two_versions):
+    """Обязательные параметры и несуществующие версии"""
+    url = reverse('version-diff', kwargs={'id': two_versions.id})
+    response = api_client.get(url, {'from': 'v1'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = api_client.get(url, {'from': 'v1', 'to': 'v9'})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def materialized_content(version):
+    return set(Element.objects.materialized(version).values_list('code',
+                                                                 'value'))
+
+
+@pytest.mark.django_db
+def test_convert_version_to_delta_and_back(api_client, two_versions):
+    """Перевод версии в хранение изменений не меняет её содержимое"""
+    version = Version.objects.get(refbook=two_versions, version='v2')
+    url = reverse('element-list', kwargs={'id': two_versions.id})
+    before = api_client.get(url, {'version': 'v2', 'stream': 'json'})
+    before = json.loads(b''.join(before.streaming_content))
+    fingerprint = version.fingerprint
+    call_command('convert_refbook_versions', refbook=two_versions.code,
+                 to='delta', max_change_ratio=1, stdout=io.StringIO())
+    version.refresh_from_db()
+    assert version.base.version == 'v1'
+    assert version.fingerprint == fingerprint
+    assert set(version.elements.values_list('code', 'value', 'removed')) == {
+        ('J01', 'Test Value 2.0', True), ('J02', 'New', False),
+        ('J04', 'Added', False)}
+    after = api_client.get(url, {'version': 'v2', 'stream': 'json'})
+    assert json.loads(b''.join(after.streaming_content)) == before
+    check_url = reverse('check-element', kwargs={'id': two_versions.id})
+    assert api_client.get(check_url, {'code': 'J03', 'value': 'Same'}).json(
+    ) == {'exists': True}
+    assert api_client.get(check_url, {
+        'code': 'J01', 'value': 'Test Value 2.0'}).json() == {'exists': False}
+    for code, value, exists in (('J03', 'SAME', True), ('J02', 'new', True),
+                                ('J01', 'test value 2.0', False)):
+        assert api_client.get(check_url, {
+            'code': code, 'value': value, 'match': 'normalized'}).json() == {
+            'exists': exists}
+    call_command('convert_refbook_versions', refbook=two_versions.code,
+                 refbook_version='v2', to='full', stdout=io.StringIO())
+    version.refresh_from_db()
+    assert version.base is None
+    assert set(version.elements.values_list('code', 'value', 'removed')) == {
+        ('J02', 'New', False), ('J03', 'Same', False),
+        ('J04', 'Added', False)}
+    assert api_client.get(check_url, {
+        'code': 'J03', 'value': 'same', 'match': 'normalized'}).json() == {
+        'exists': True}
+
+
+@pytest.mark.django_db
+def test_convert_version_respects_change_ratio(two_versions):
+    """Версия с большим числом изменений остаётся полной"""
+    out = io.StringIO()
+    call_command('convert_refbook_versions', refbook=two_versions.code,
+                 to='delta', stdout=out)
+    assert 'пропущена' in out.getvalue()
+    assert not Version.objects.filter(base__isnull=False).exists()
+
+
+@pytest.mark.django_db
+def test_delta_version_follows_base_changes(api_client, two_versions):
+    """Изменения базовой версии и отметки удаления учитываются в отпечатке
+    и содержимом версии, хранящей изменения"""
+    call_command('convert_refbook_versions', refbook=two_versions.code,
+                 to='delta', max_change_ratio=1, stdout=io.StringIO())
+    base = Version.objects.get(refbook=two_versions, version='v1')
+    delta = Version.objects.get(refbook=two_versions, version='v2')
+    check_url = reverse('check-element', kwargs={'id': two_versions.id})
+    params = {'code': 'J03', 'value': 'Same', 'version': 'v2'}
+    assert api_client.get(check_url, params).json() == {'exists': True}
+    element = Element.objects.get(version=base, code='J03')
+    element.value = 'Changed'
+    element.save()
+    Element.objects.create(version=base, code='J05', value='Five')
+    Element.objects.create(version=delta, code='J05', value='Removed',
+                           removed=True)
+    Element.objects.get(version=delta, code='J01').delete()
+    assert api_client.get(check_url, params).json() == {'exists': False}
+    delta.refresh_from_db()
+    assert materialized_content(delta) == {
+        ('J01', 'Test Value 2.0'), ('J02', 'New'), ('J03', 'Changed'),
+        ('J04', 'Added')}
+    assert delta.fingerprint == fingerprints.compute(
+        materialized_content(delta))
+
+
+@pytest.mark.django_db
+def test_delta_version_pages(api_client, two_versions):
+    """Постраничная выдача версии, хранящей изменения, объединяет её
+    элементы с элементами базовой версии в порядке кодов"""
+    call_command('convert_refbook_versions', refbook=two_versions.code,
+                 to='delta', max_change_ratio=1, stdout=io.StringIO())
+    url = reverse('element-list', kwargs={'id': two_versions.id})
+    first = api_client.get(url, {'version': 'v2', 'limit': 2}).json()
+    second = api_client.get(url, {'version': 'v2', 'limit': 2,
+                                  'cursor': first['next']}).json()
+    assert first['elements'] + second['elements'] == [
+        {'code': 'J02', 'value': 'New'}, {'code': 'J03', 'value': 'Same'},
+        {'code': 'J04', 'value': 'Added'}]
+    assert second['next'] is None
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_fast_renderer_matches_drf(monkeypatch, use_orjson):
+    """Быстрый рендерер выдаёт те же байты, что и JSONRenderer DRF"""
+    from decimal import Decimal
+    from django.utils.translation import gettext_lazy
+    from rest_framework.renderers import JSONRenderer
+    if not use_orjson:
+        monkeypatch.setattr(renderers, 'orjson', None)
+    data = {
+        'elements': [{'code': 'J01', 'value': 'Грипп "A"\n\u2028\u2029'}],
+        'date': date(2024, 1, 1), 'price': Decimal('1.50'), 1: None,
+        'detail': gettext_lazy('Not found.'), 'big': 2 ** 70,
+    }
+    for media_type in ('application/json',
+                       'application/json; indent=2', None):
+        assert renderers.FastJSONRenderer().render(data, media_type) == \
+            JSONRenderer().render(data, media_type)
+    assert renderers.FastJSONRenderer().render(None) == b''
+
+
+@pytest.mark.django_db
+def test_element_list_fast_path_matches_serializer(api_client,
+                                                   setup_refbooks):
+    """Ответ без ElementSerializer совпадает с прежним побайтово"""
+    from rest_framework.renderers import JSONRenderer
+    version = Version.objects.get(refbook_id=1, version='v1')
+    Element.objects.create(version=version, code='J03',
+                           value='Строка\u2028с разделителем')
+    url = reverse('element-list', kwargs={'id': 1})
+    response = api_client.get(url, {'version': 'v1'})
+    elements = Element.objects.materialized(version)
+    expected = JSONRenderer().render(
+        {'elements': ElementSerializer(elements, many=True).data})
+    assert response.content == expected
+
+
+async def fetch(client, url, params, **headers):
+    response = await client.get(url, params, **headers)
+    if response.streaming:
+        content = b''.join([chunk async for chunk in
+                            response.streaming_content])
+    else:
+        content = response.content
+    return response.status_code, content
+
+
+@pytest.mark.django_db
+def test_async_endpoints_match_sync(api_client, two_versions):
+    """Асинхронные эндпоинты отвечают так же, как синхронные, с пустыми и
+    заполненными кэшами"""
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncClient
+    first_page = api_client.get(
+        reverse('element-list', kwargs={'id': two_versions.id}),
+        {'version': 'v2', 'limit': 1}).json()
+    requests = [
+        ('refbook-list', {}, {}),
+        ('refbook-list', {}, {'date': '2022-10-01'}),
+        ('refbook-list', {}, {'date': 'вчера'}),
+        ('refbook-list', {}, {'include_current': 'true'}),
+        ('refbook-list', {}, {'include_current': 'да'}),
+    ]
+    for kwargs in ({'id': two_versions.id}, {'id': 999}):
+        requests += [('element-list', kwargs, params) for params in (
+            {}, {'version': 'v1'}, {'version': 'v9'}, {'limit': 2},
+            {'version': 'v2', 'limit': 1, 'cursor': first_page['next']},
+            {'limit': 0}, {'cursor': '%%%'}, {'stream': 'ndjson'},
+            {'version': 'v1', 'stream': 'json'}, {'stream': 'xml'})]
+        requests += [('check-element', kwargs, params) for params in (
+            {'code': 'J02', 'value': 'New'}, {'code': 'J02', 'value': 'Old'},
+            {'code': 'J02', 'value': 'Old', 'version': 'v1'},
+            {'code': 'J02', 'value': 'Old', 'version': 'v9'},
+            {'code': 'J02', 'value': ' NEW ', 'match': 'normalized'},
+            {'code': 'J02', 'value': 'old', 'version': 'v1',
+             'match': 'normalized'},
+            {'code': 'J02', 'value': 'New', 'match': 'fuzzy'},
+            {'code': 'J02'})]
+    expected = []
+    for name, kwargs, params in requests:
+        response = api_client.get(reverse(name, kwargs=kwargs), params)
+        content = b''.join(response.streaming_content) if (
+            response.streaming) else response.content
+        expected.append((response.status_code, content))
+    client = AsyncClient()
+    for _ in ('пустые кэши', 'заполненные кэши'):
+        for (name, kwargs, params), result in zip(requests, expected):
+            url = reverse(f'async-{name}', kwargs=kwargs)
+            assert async_to_sync(fetch)(client, url, params) == result, (
+                name, params)
+        element_index.clear()
+        current_version_resolver.clear()
+    url = reverse('element-list', kwargs={'id': two_versions.id})
+    etag = api_client.get(url)['ETag']
+    url = reverse('async-element-list', kwargs={'id': two_versions.id})
+    status_code, _ = async_to_sync(fetch)(client, url, {},
+                                          headers={'if-none-match': etag})
+    assert status_code == status.HTTP_304_NOT_MODIFIED
+
+
+@pytest.mark.django_db
+def test_async_elements_precompressed(api_client, two_versions,
+                                      compressed_dir):
+    """Асинхронный эндпоинт отдаёт те же сжатые ответы"""
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncClient
+    params = {'version': 'v1'}
+    expected = api_client.get(
+        reverse('element-list', kwargs={'id': two_versions.id}), params,
+        HTTP_ACCEPT_ENCODING='gzip').content
+    url = reverse('async-element-list', kwargs={'id': two_versions.id})
+    assert async_to_sync(fetch)(AsyncClient(), url, params,
+                                headers={'accept-encoding': 'gzip'}) == (
+        status.HTTP_200_OK, expected)
+
+
+def asgi_get(path, query='', host='testserver', application=None):
+    """GET-запрос к ASGI-приложению проекта (``core.asgi``) со всеми его
+    обработчиками; возвращает код, заголовки и тело ответа"""
+    from asgiref.sync import async_to_sync
+    from django.core import signals
+    from django.db import close_old_connections
+    if application is None:
+        from core.asgi import application
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'server': (host, 80),
+        'client': ('127.0.0.1', 0), 'root_path': '', 'path': path,
+        'raw_path': path.encode(), 'query_string': query.encode(),
+        'headers': [(b'host', host.encode())],
+    }
+    # Как тестовый клиент Django: соединение с БД остаётся открытым до
+    # конца теста
+    signals.request_started.disconnect(close_old_connections)
+    signals.request_finished.disconnect(close_old_connections)
+    try:
+        async_to_sync(application)(scope, receive, send)
+    finally:
+        signals.request_started.connect(close_old_connections)
+        signals.request_finished.connect(close_old_connections)
+    start, *body = messages
+    headers = {name.decode().lower(): value.decode()
+               for name, value in start['headers']}
+    return start['status'], headers, b''.join(
+        message.get('body', b'') for message in body)
+
+
+@pytest.mark.django_db
+def test_async_api_runs_project_middleware(api_client, two_versions):
+    """Асинхронные эндпоинты под ASGI проходят промежуточные слои проекта,
+    кроме слоёв сессий, CSRF, аутентификации и сообщений"""
+    from urllib.parse import urlencode
+    from core.asgi import SESSION_MIDDLEWARE, api_middleware
+    assert api_middleware() == [path for path in django_settings.MIDDLEWARE
+                                if path not in SESSION_MIDDLEWARE]
+    query = urlencode({'code': 'J02', 'value': 'New'})
+    sync_status, sync_headers, sync_body = asgi_get(
+        reverse('check-element', kwargs={'id': two_versions.id}), query)
+    status_code, headers, body = asgi_get(
+        reverse('async-check-element', kwargs={'id': two_versions.id}),
+        query)
+    assert (status_code, body) == (sync_status, sync_body) == (
+        status.HTTP_200_OK, b'{"exists":true}')
+    # SecurityMiddleware и XFrameOptionsMiddleware
+    for name in ('x-frame-options', 'x-content-type-options',
+                 'referrer-policy', 'cross-origin-opener-policy'):
+        assert headers[name] == sync_headers[name], name
+    assert 'set-cookie' not in headers
+    assert 'Cookie' not in headers.get('vary', '')
+    # CommonMiddleware: ALLOWED_HOSTS и APPEND_SLASH
+    assert asgi_get(reverse('async-refbook-list'), host='evil.example')[
+        0] == status.HTTP_400_BAD_REQUEST
+    status_code, headers, _ = asgi_get(reverse('async-refbook-list')[:-1])
+    assert status_code == status.HTTP_301_MOVED_PERMANENTLY
+    assert headers['location'] == reverse('async-refbook-list')
+
+
+@pytest.mark.django_db
+def test_async_api_failures(two_versions, monkeypatch):
+    """Асинхронный эндпоинт видит изменения после сверки с БД, а ошибка БД
+    на холодном пути даёт ответ 500, а не обрыв соединения"""
+    from urllib.parse import urlencode
+    from django.db import DatabaseError
+    url = reverse('async-check-element', kwargs={'id': two_versions.id})
+    query = urlencode({'code': 'J02', 'value': 'New'})
+    assert asgi_get(url, query)[2] == b'{"exists":true}'
+    version = Version.objects.get(refbook=two_versions, version='v2')
+    Element.objects.create(version=version, code='J05', value='Added')
+    added = urlencode({'code': 'J05', 'value': 'Added'})
+    assert asgi_get(url, added)[2] == b'{"exists":true}'
+    # Изменение другим процессом: сигналы этого процесса не срабатывают
+    Element.objects.untracked().filter(version=version, code='J05').update(
+        value='Changed')
+    Version.objects.filter(pk=version.pk).update(
+        fingerprint=fingerprints.compute(Element.objects.filter(
+            version=version).values_list('code', 'value')))
+    refbook_revisions.clear()  # истёк MED_REFBOOK_REVALIDATE_INTERVAL
+    assert asgi_get(url, added)[2] == b'{"exists":false}'
+
+    async def broken(*args, **kwargs):
+        raise DatabaseError('соединение потеряно')
+
+    current_version_resolver.clear()
+    refbook_revisions.clear()
+    monkeypatch.setattr(refbook_revisions, 'aget', broken)
+    status_code, _, _ = asgi_get(url, query)
+    assert status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def test_version_search_ranking():
+    """Код целиком, префикс кода, затем значения по словам без учёта
+    регистра и «ё», короткие значения выше"""
+    index = VersionSearch([
+        ('J10', 'Грипп, вызванный идентифицированным вирусом'),
+        ('J11', 'Грипп, вирус не идентифицирован'),
+        ('J1', 'Грипп'),
+        ('A00', 'Холера'),
+        ('B01', 'Ветряная оспа [varicella]'),
+        ('R50', 'Лихорадка неясного происхождения'),
+        ('E00', 'Синдром врождённой йодной недостаточности'),
+    ])
+    assert index.search('J1', 10) == [
+        ('J1', 'Грипп'), ('J10', 'Грипп, вызванный идентифицированным вирусом'),
+        ('J11', 'Грипп, вирус не идентифицирован')]
+    assert [code for code, _ in index.search('ГРИП', 10)] == [
+        'J1', 'J11', 'J10']
+    assert [code for code, _ in index.search('грипп вир идент', 10)] == [
+        'J11', 'J10']
+    assert index.search('врожденной', 10) == [
+        ('E00', 'Синдром врождённой йодной недостаточности')]
+    assert index.search('VARIC', 10) == [('B01', 'Ветряная оспа [varicella]')]
+    assert index.search('грипп', 2) == [
+        ('J1', 'Грипп'), ('J11', 'Грипп, вирус не идентифицирован')]
+    assert index.search('чума', 10) == []
+    assert len(index) == 7
+
+
+@pytest.mark.django_db
+def test_element_search(api_client, setup_refbooks):
+    """Поиск по версиям справочника с проверкой параметров и сбросом индекса
+    при изменении элементов"""
+    _, _, version_1_1, _, _ = setup_refbooks
+    url = reverse('element-search', kwargs={'id': 1})
+    response = api_client.get(url, {'q': 'test val'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {
+        'elements': [{'code': 'J00', 'value': 'Test Value 1.0'}]}
+    Element.objects.create(version=version_1_1, code='J05', value='Тест')
+    assert api_client.get(url, {'q': 'j0', 'limit': 1}).json() == {
+        'elements': [{'code': 'J00', 'value': 'Test Value 1.0'}]}
+    assert api_client.get(url, {'q': 'тес', 'version': 'v1'}).json() == {
+        'elements': [{'code': 'J05', 'value': 'Тест'}]}
+    for params in ({}, {'q': ' '}, {'q': 'j', 'limit': 0},
+                   {'q': 'j', 'limit': 'x'}):
+        assert api_client.get(url, params).status_code == \
+            status.HTTP_400_BAD_REQUEST
+    assert api_client.get(url, {'q': 'j', 'version': 'v9'}).status_code == \
+        status.HTTP_404_NOT_FOUND
+    assert api_client.get(reverse('element-search', kwargs={'id': 99}), {
+        'q': 'j'}).status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, settings):
+    settings.MED_REFBOOK_SNAPSHOT_DIR = str(tmp_path / 'snapshots')
+    return tmp_path / 'snapshots'
+
+
+@pytest.mark.django_db
+def test_snapshot_roundtrip(snapshot_dir, two_versions):
+    """Снимок содержит всю версию и читается двоичным поиском"""
+    version = Version.objects.get(refbook=two_versions, version='v2')
+    Element.objects.create(version=version, code='Ж10', value='Грипп\n"А"')
+    path = snapshots.ensure_snapshot(version)
+    version.refresh_from_db()
+    assert path.name == f'{version.pk}-{version.fingerprint}.mrbs'
+    assert snapshots.ensure_snapshot(version) == path
+    with snapshots.SnapshotReader(path) as reader:
+        assert len(reader) == 4
+        assert reader.version_id == version.pk
+        assert reader.fingerprint == version.fingerprint
+        assert reader.meta == {'refbook_id': two_versions.pk,
+                               'version': 'v2', 'date_start': '2023-01-01'}
+        assert list(reader) == [('J02', 'New'), ('J03', 'Same'),
+                                ('J04', 'Added'), ('Ж10', 'Грипп\n"А"')]
+        assert reader.get('Ж10') == 'Грипп\n"А"'
+        assert reader.get('J04') == 'Added'
+        assert reader.get('J01') is None and 'J00' not in reader
+        assert 'J02' in reader
+    Element.objects.get(version=version, code='J04').delete()
+    version.refresh_from_db()
+    new_path = snapshots.ensure_snapshot(version)
+    assert new_path != path and not path.exists()
+    path.write_bytes(b'not a snapshot' * 4)
+    with pytest.raises(snapshots.SnapshotFormatError):
+        snapshots.SnapshotReader(path)
+
+
+@pytest.mark.django_db
+def test_snapshot_streams_elements(snapshot_dir, two_versions, monkeypatch):
+    """Элементы читаются из БД курсором частями, а индекс снимка
+    упорядочен по байтам кода и при другом порядке строк в СУБД"""
+    version = Version.objects.get(refbook=two_versions, version='v2')
+    Element.objects.bulk_create([
+        Element(version=version, code=f'Ж{number:03}',
+                value=f'Значение {number}') for number in range(50)] + [
+        Element(version=version, code='a01', value='Строчные')])
+    version.refresh_from_db()
+    ordered_pairs = Element.objects.ordered_pairs
+    chunks = []
+
+    def reversed_pairs(version, after=None):
+        # Как СУБД с правилом сравнения, не совпадающим с порядком байтов
+        queryset = ordered_pairs(version, after).order_by('-code')
+        iterator = queryset.iterator
+
+        def tracked(chunk_size):
+            chunks.append(chunk_size)
+            return iterator(chunk_size=chunk_size)
+
+        queryset.iterator = tracked
+        return queryset
+
+    monkeypatch.setattr(snapshots, 'CHUNK_SIZE', 7)
+    monkeypatch.setattr(Element.objects, 'ordered_pairs', reversed_pairs)
+    path = snapshots.ensure_snapshot(version)
+    assert chunks == [7]
+    expected = sorted(Element.objects.filter(version=version).values_list(
+        'code', 'value'), key=lambda pair: pair[0].encode())
+    with snapshots.SnapshotReader(path) as reader:
+        assert reader.fingerprint == version.fingerprint
+        assert list(reader) == expected
+        for code, value in expected:
+            assert reader.get(code) == value
+        assert reader.get('Ж050') is None
+
+
+@pytest.mark.django_db
+def test_snapshot_endpoint_ranges(api_client, snapshot_dir, two_versions):
+    """Снимок отдаётся целиком, по частям и с условными запросами"""
+    url = reverse('version-snapshot', kwargs={'id': two_versions.id})
+    response = api_client.get(url, {'version': 'v1'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response['Accept-Ranges'] == 'bytes'
+    assert 'immutable' in response['Cache-Control']
+    content = b''.join(response.streaming_content)
+    assert int(response['Content-Length']) == len(content)
+    etag = response['ETag']
+    version = Version.objects.get(refbook=two_versions, version='v1')
+    assert content == snapshots.snapshot_path(version).read_bytes()
+    for header, expected in (('bytes=0-7', content[:8]),
+                             ('bytes=10-', content[10:]),
+                             ('bytes=-5', content[-5:]),
+                             ('bytes=5-100000', content[5:])):
+        response = api_client.get(url, {'version': 'v1'}, HTTP_RANGE=header)
+        assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+        assert b''.join(response.streaming_content) == expected
+    response = api_client.get(url, {'version': 'v1'},
+                              HTTP_RANGE=f'bytes={len(content)}-')
+    assert response.status_code == \
+        status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+    assert response['Content-Range'] == f'bytes */{len(content)}'
+    response = api_client.get(url, {'version': 'v1'}, HTTP_RANGE='bytes=0-7',
+                              HTTP_IF_RANGE='"old"')
+    assert response.status_code == status.HTTP_200_OK
+    response = api_client.get(url, {'version': 'v1'},
+                              HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    current = api_client.get(url)
+    assert current.status_code == status.HTTP_200_OK
+    assert current['ETag'] != etag
+    assert api_client.get(url, {'version': 'v9'}).status_code == \
+        status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_snapshot_endpoint_file_removed(api_client, snapshot_dir,
+                                        two_versions, monkeypatch):
+    """Снимок, удалённый между созданием и открытием, создаётся заново;
+    если его удаляют снова - 404, а не ошибка сервера"""
+    url = reverse('version-snapshot', kwargs={'id': two_versions.id})
+    removed = []
+
+    def ensure_and_remove(version, times):
+        path = snapshots.ensure_snapshot(version)
+        if len(removed) < times:
+            path.unlink()
+            removed.append(path)
+        return path
+
+    monkeypatch.setattr(views, 'ensure_snapshot',
+                        lambda version: ensure_and_remove(version, 1))
+    response = api_client.get(url, {'version': 'v1'})
+    assert response.status_code == status.HTTP_200_OK
+    content = b''.join(response.streaming_content)
+    assert int(response['Content-Length']) == len(content)
+    assert content == removed[0].read_bytes()
+    removed.clear()
+    monkeypatch.setattr(views, 'ensure_snapshot',
+                        lambda version: ensure_and_remove(version, 2))
+    response = api_client.get(url, {'version': 'v1'})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_export_refbook_snapshot_command(tmp_path, two_versions):
+    output = tmp_path / 'v2.mrbs'
+    out = io.StringIO()
+    call_command('export_refbook_snapshot', refbook=two_versions.code,
+                 refbook_version='v2', output=str(output), stdout=out)
+    assert str(output) in out.getvalue()
+    with snapshots.SnapshotReader(output) as reader:
+        assert dict(reader) == {'J02': 'New', 'J03': 'Same', 'J04': 'Added'}
+    with pytest.raises(CommandError):
+        call_command('export_refbook_snapshot', refbook='UNKNOWN')
+
+
+def metric(text, name, endpoint, status=200, method='GET'):
+    prefix = (f'med_refbook_{name}{{endpoint="{endpoint}",method="{method}",'
+              f'status="{status}"}} ')
+    values = [line[len(prefix):] for line in text.splitlines()
+              if line.startswith(prefix)]
+    assert len(values) == 1, (name, endpoint)
+    return float(values[0])
+
+
+@pytest.mark.django_db
+def test_request_instrumentation(api_client, two_versions, monkeypatch):
+    """Измеренные запросы получают Server-Timing и попадают в метрики"""
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncClient
+    url = reverse('check-element', kwargs={'id': two_versions.id})
+    response = api_client.get(url, {'code': 'J02', 'value': 'New'})
+    assert 'Server-Timing' not in response
+    monkeypatch.setattr(instrumentation, 'SAMPLE_RATE', 1.0)
+    with CaptureQueriesContext(connection) as queries:
+        response = api_client.get(url, {'code': 'J02', 'value': 'New'})
+    assert response.json() == {'exists': True}
+    assert response['Server-Timing'].startswith('db;dur=')
+    assert f'desc="{len(queries)} queries"' in response['Server-Timing']
+    api_client.get(url, {'code': 'J02'})
+    elements_url = reverse('element-list', kwargs={'id': two_versions.id})
+    content = b''.join(api_client.get(
+        elements_url, {'stream': 'ndjson'}).streaming_content)
+    async_to_sync(fetch)(AsyncClient(), reverse(
+        'async-check-element', kwargs={'id': two_versions.id}),
+        {'code': 'J02', 'value': 'New'})
+    response = api_client.get(reverse('metrics'))
+    assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+    text = response.content.decode()
+    assert 'med_refbook_metrics_sample_rate 1.0' in text
+    assert metric(text, 'requests_total', 'check-element') == 1
+    assert metric(text, 'db_queries_total', 'check-element') == len(queries)
+    assert metric(text, 'requests_total', 'check-element', status=400) == 1
+    assert metric(text, 'response_bytes_total', 'element-list') == len(
+        content)
+    assert metric(text, 'db_queries_total', 'element-list') > 0
+    assert metric(text, 'requests_total', 'async-check-element') == 1
+    assert metric(text, 'request_duration_seconds_count',
+                  'check-element') == 1
+    assert 'endpoint="metrics"' not in text
+
+
+@pytest.mark.django_db
+def test_metrics_access(api_client, monkeypatch):
+    """/metrics доступен разрешённым адресам и по токену, остальным - 403"""
+    import ipaddress
+    url = reverse('metrics')
+    assert api_client.get(url).status_code == status.HTTP_200_OK
+    assert api_client.get(url, REMOTE_ADDR='10.1.2.3').status_code == \
+        status.HTTP_403_FORBIDDEN
+    assert api_client.get(url, REMOTE_ADDR='не адрес').status_code == \
+        status.HTTP_403_FORBIDDEN
+    monkeypatch.setattr(instrumentation, 'METRICS_ALLOWED_NETWORKS',
+                        [ipaddress.ip_network('10.0.0.0/8')])
+    assert api_client.get(url, REMOTE_ADDR='10.1.2.3').status_code == \
+        status.HTTP_200_OK
+    assert api_client.get(url).status_code == status.HTTP_403_FORBIDDEN
+    bearer = {'REMOTE_ADDR': '192.0.2.1', 'HTTP_AUTHORIZATION': 'Bearer s3'}
+    assert api_client.get(url, **bearer).status_code == \
+        status.HTTP_403_FORBIDDEN
+    monkeypatch.setattr(instrumentation, 'METRICS_TOKEN', 's3')
+    assert api_client.get(url, **bearer).status_code == status.HTTP_200_OK
+    for authorization in ('Bearer s4', 'Basic s3', 's3', 'Bearer '):
+        assert api_client.get(
+            url, REMOTE_ADDR='192.0.2.1',
+            HTTP_AUTHORIZATION=authorization).status_code == \
+            status.HTTP_403_FORBIDDEN, authorization
+
+
+@pytest.mark.django_db
+def test_metrics_under_async_handler(two_versions, monkeypatch):
+    """Запросы, обработанные асинхронным обработчиком ASGI, учитываются в
+    метриках с запросами к БД, кодами ответа и потоковыми телами"""
+    from urllib.parse import urlencode
+    monkeypatch.setattr(instrumentation, 'SAMPLE_RATE', 1.0)
+    check_url = reverse('async-check-element', kwargs={'id': two_versions.id})
+    status_code, headers, _ = asgi_get(
+        check_url, urlencode({'code': 'J02', 'value': 'New'}))
+    assert status_code == status.HTTP_200_OK
+    assert headers['server-timing'].startswith('db;dur=')
+    asgi_get(check_url, urlencode({'code': 'J02'}))
+    asgi_get(reverse('async-element-list', kwargs={'id': 999}))
+    _, _, content = asgi_get(
+        reverse('async-element-list', kwargs={'id': two_versions.id}),
+        'stream=ndjson')
+    status_code, _, body = asgi_get(reverse('metrics'))
+    assert status_code == status.HTTP_200_OK
+    text = body.decode()
+    assert metric(text, 'requests_total', 'async-check-element') == 1
+    assert metric(text, 'db_queries_total', 'async-check-element') > 0
+    assert metric(text, 'requests_total', 'async-check-element',
+                  status=400) == 1
+    assert metric(text, 'requests_total', 'async-element-list',
+                  status=404) == 1
+    assert metric(text, 'response_bytes_total', 'async-element-list') == len(
+        content)
+
+
+@pytest.mark.django_db
+def test_read_only_endpoints_read_from_replica(api_client, admin_client,
+                                               setup_refbooks, monkeypatch):
+    """Чтение эндпоинтов api направляется на реплику, запись и остальные
+    страницы - в основную БД"""
+    router = ReplicaRouter()
+    with replica_reads():
+        assert router.db_for_read(Element) is None
+    monkeypatch.setitem(django_settings.DATABASES, 'replica',
+                        dict(connection.settings_dict))
+    assert router.db_for_read(Element) is None
+    with replica_reads():
+        assert router.db_for_read(Element) == 'replica'
+        assert router.db_for_write(Element) is None
+    assert not router.allow_migrate('replica', 'med_refbook')
+    routed = []
+
+    def db_for_read(self, model, **hints):
+        # Запоминаем выбор маршрутизатора, но читаем из основной БД
+        routed.append((model.__name__, original(self, model, **hints)))
+
+    original = ReplicaRouter.db_for_read
+    monkeypatch.setattr(ReplicaRouter, 'db_for_read', db_for_read)
+    response = api_client.get(reverse('element-list', kwargs={'id': 1}))
+    assert response.status_code == status.HTTP_200_OK
+    # Ревизия справочника - из основной БД, элементы - из реплики
+    assert set(routed) == {('Version', None), ('Element', 'replica')}
+    routed.clear()
+    admin_client.get(reverse('admin:med_refbook_refbook_changelist'))
+    assert routed and 'replica' not in dict(routed).values()
+
+
+@pytest.mark.django_db
+def test_replica_routing_failures(api_client, two_versions, monkeypatch):
+    """Тела потоковых ответов читаются из реплики, кэши процесса
+    загружаются из основной БД, запросы к реплике учитываются в
+    измерениях"""
+    from asgiref.sync import async_to_sync
+    from django.db import connections
+    from django.test import AsyncClient
+    monkeypatch.setitem(django_settings.DATABASES, 'replica',
+                        dict(connection.settings_dict))
+    routed = []
+    original = ReplicaRouter.db_for_read
+
+    def db_for_read(self, model, **hints):
+        # Запоминаем выбор маршрутизатора, но читаем из основной БД
+        routed.append((model.__name__, original(self, model, **hints)))
+
+    monkeypatch.setattr(ReplicaRouter, 'db_for_read', db_for_read)
+    responses = [
+        api_client.get(reverse('element-list', kwargs={
+            'id': two_versions.id}), {'stream': 'ndjson'}),
+        api_client.get(reverse('version-diff', kwargs={
+            'id': two_versions.id}), {'from': 'v1', 'to': 'v2',
+                                      'stream': 'ndjson'}),
+    ]
+    for response in responses:
+        assert response.status_code == status.HTTP_200_OK
+        routed.clear()
+        assert b''.join(response.streaming_content)
+        # Тело закреплено за репликой в dispatch и не спрашивает
+        # маршрутизатор вне replica_reads()
+        assert routed == []
+
+    async def stream():
+        response = await AsyncClient().get(
+            reverse('async-element-list', kwargs={'id': two_versions.id}),
+            {'stream': 'ndjson'})
+        routed.clear()
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    assert async_to_sync(stream)().count(b'\n') == 3
+    assert routed == []
+    # Загрузка кэшей процесса - из основной БД даже внутри replica_reads()
+    element_index.clear()
+    refbook_revisions.clear()
+    routed.clear()
+    with replica_reads():
+        version = current_version_resolver.resolve(two_versions.id)
+        assert element_index.contains(version, 'J02', 'New')
+        assert api_client.get(reverse('refbook-list')).status_code == \
+            status.HTTP_200_OK
+    assert routed and {db for _, db in routed} == {None}
+    # Запросы соединений других БД (реплики) учитываются в выборке
+    replica = connections.create_connection('default')
+    try:
+        sample = instrumentation.RequestSample()
+        with instrumentation.measuring(sample):
+            replica.cursor().execute('SELECT 1')
+        assert sample.queries == 1
+    finally:
+        replica.close()
+
+
+def read_change_feed(client, since=0, limit=None, **params):
+    """Все события ленты изменений после ``since`` постранично."""
+    events = []
+    while True:
+        query = {'since': since, **params}
+        if limit:
+            query['limit'] = limit
+        response = client.get(reverse('change-feed'), query)
+        assert response.status_code == status.HTTP_200_OK
+        page = response.json()
+        assert len(page['changes']) <= (limit or len(page['changes']))
+        events += page['changes']
+        since = page['cursor']
+        if not page['has_more']:
+            return events, since
+
+
+def replay_changes(events):
+    """Состояние справочников, восстановленное по журналу изменений."""
+    refbooks, versions, elements = {}, {}, {}
+    for event in events:
+        if event['entity'] == 'refbook':
+            if event['action'] == 'deleted':
+                refbooks.pop(event['refbook_id'])
+            else:
+                refbooks[event['refbook_id']] = event['data']['code']
+        elif event['entity'] == 'version':
+            if event['action'] == 'deleted':
+                versions.pop(event['version_id'])
+                elements.pop(event['version_id'], None)
+            else:
+                versions[event['version_id']] = (
+                    event['refbook_id'], event['data']['version'])
+        else:
+            content = elements.setdefault(event['version_id'], {})
+            if event['action'] == 'deleted':
+                content.pop(event['code'])
+            else:
+                content[event['code']] = event['data']['value']
+    return refbooks, versions, {
+        version_id: set(content.items())
+        for version_id, content in elements.items() if content}
+
+
+def current_state():
+    return (
+        dict(Refbook.objects.values_list('id', 'code')),
+        {version.pk: (version.refbook_id, version.version)
+         for version in Version.objects.all()},
+        {version.pk: materialized_content(version)
+         for version in Version.objects.all()
+         if materialized_content(version)},
+    )
+
+
+@pytest.mark.django_db
+def test_change_feed_pagination(api_client, setup_refbooks):
+    """Лента изменений отдаётся постранично по возрастанию номеров"""
+    events, cursor = read_change_feed(api_client)
+    assert [(event['entity'], event['action']) for event in events] == [
+        ('refbook', 'created'), ('refbook', 'created'),
+        ('version', 'created'), ('version', 'created'),
+        ('version', 'created'), ('element', 'created'),
+        ('element', 'created')]
+    assert events[5]['code'] == 'J00'
+    assert events[5]['data'] == {'value': 'Test Value 1.0'}
+    paged, paged_cursor = read_change_feed(api_client, limit=2)
+    assert paged == events and paged_cursor == cursor
+    ids = [event['id'] for event in events]
+    assert ids == sorted(ids)
+    element = Element.objects.get(code='J00')
+    element.value = 'Changed'
+    element.save()
+    Version.objects.filter(version='v2').get().delete()
+    new_events, _ = read_change_feed(api_client, since=cursor)
+    assert [(event['entity'], event['action'], event['code'])
+            for event in new_events] == [
+        ('element', 'updated', 'J00'), ('version', 'deleted', '')]
+    by_refbook, _ = read_change_feed(api_client, refbook=2)
+    assert {event['refbook_id'] for event in by_refbook} == {2}
+    response = api_client.get(reverse('change-feed'), {'since': 'x'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = api_client.get(reverse('change-feed'), {'limit': 0})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+def test_change_feed_replay(api_client, two_versions, tmp_path):
+    """Повтор журнала восстанавливает содержимое справочников, включая
+    импорт, версии с изменениями относительно базовой и удаления"""
+    path = tmp_path / 'release.csv'
+    path.write_text('code,value\nA1,Грипп\nA2,Насморк\n', encoding='utf-8')
+    call_command('import_refbook', str(path), refbook='NEW', name='Новый',
+                 refbook_version='1.0', date_start='2024-01-01',
+                 batch_size=1, stdout=io.StringIO())
+    call_command('convert_refbook_versions', refbook=two_versions.code,
+                 to='delta', max_change_ratio=1, stdout=io.StringIO())
+    base = Version.objects.get(refbook=two_versions, version='v1')
+    element = Element.objects.get(version=base, code='J03')
+    element.value = 'Changed'
+    element.save()
+    Element.objects.get(version__refbook__code='NEW', code='A1').delete()
+    Refbook.objects.get(code='MS1').delete()
+    events, _ = read_change_feed(api_client, limit=3)
+    assert replay_changes(events) == current_state()
+
+
+@pytest.mark.django_db
+def test_change_feed_admin_changes(admin_client, api_client):
+    """Изменения через администрирование попадают в журнал"""
+    response = admin_client.post(
+        reverse('admin:med_refbook_refbook_add'),
+        {'code': 'ADM', 'name': 'Из админки', 'description': '',
+         'versions-TOTAL_FORMS': 1, 'versions-INITIAL_FORMS': 0,
+         'versions-MIN_NUM_FORMS': 0, 'versions-MAX_NUM_FORMS': 1000,
+         'versions-0-version': '1.0', 'versions-0-date_start': '2024-01-01'})
+    assert response.status_code == status.HTTP_302_FOUND
+    events, _ = read_change_feed(api_client)
+    assert [(event['entity'], event['action']) for event in events] == [
+        ('refbook', 'created'), ('version', 'created')]
+    assert events[1]['data'] == {'version': '1.0',
+                                 'date_start': '2024-01-01'}
+
+
+@pytest.mark.django_db
+def test_change_feed_bulk_writes(api_client, setup_refbooks):
+    """Пакетные изменения элементов через QuerySet попадают в журнал"""
+    _, _, version_1_1, _, _ = setup_refbooks
+    _, cursor = read_change_feed(api_client)
+    five, six = Element.objects.bulk_create([
+        Element(version=version_1_1, code='J05', value='Five'),
+        Element(version=version_1_1, code='J06', value='Six')])
+    Element.objects.filter(code='J00').update(value='Changed')
+    five.value = 'Пять'
+    Element.objects.bulk_update([five], ['value'])
+    with CaptureQueriesContext(connection) as queries:
+        Element.objects.filter(version=version_1_1,
+                               code__in=['J05', 'J06']).delete()
+    # Пакет обрабатывается один раз, а не сигналами каждого элемента
+    assert sum('UPDATE' in query['sql'] and 'fingerprint' in query['sql']
+               for query in queries.captured_queries) == 1
+    events, _ = read_change_feed(api_client, since=cursor)
+    assert [(event['entity'], event['action'], event['code'],
+             event['data'].get('value')) for event in events] == [
+        ('element', 'created', 'J05', 'Five'),
+        ('element', 'created', 'J06', 'Six'),
+        ('element', 'updated', 'J00', 'Changed'),
+        ('element', 'updated', 'J05', 'Пять'),
+        ('element', 'deleted', 'J05', 'Пять'),
+        ('element', 'deleted', 'J06', 'Six')]
+    assert stored_fingerprint(version_1_1) == fingerprints.compute(
+        [('J00', 'Changed')])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_change_event_rolls_back_with_write(api_client, setup_refbooks):
+    """Сбой после записи события откатывает и изменение, и событие"""
+    _, _, version_1_1, _, _ = setup_refbooks
+    _, cursor = read_change_feed(api_client)
+    element = Element.objects.get(version=version_1_1, code='J00')
+    fingerprint = stored_fingerprint(version_1_1)
+
+    def fail(sender, **kwargs):
+        raise RuntimeError('сбой')
+
+    post_save.connect(fail, sender=Element)
+    try:
+        element.value = 'Changed'
+        with pytest.raises(RuntimeError):
+            element.save()
+    finally:
+        post_save.disconnect(fail, sender=Element)
+    assert read_change_feed(api_client, since=cursor)[0] == []
+    assert Element.objects.get(pk=element.pk).value == 'Test Value 1.0'
+    assert stored_fingerprint(version_1_1) == fingerprint
+
+
+@pytest.fixture
+def hierarchy_version(tmp_path, db):
+    """Импортированная версия иерархического справочника"""
+    path = tmp_path / 'icd.csv'
+    path.write_text(
+        'code,value,parent\n'
+        'J00-J99,Болезни органов дыхания,\n'
+        'J00,Острый назофарингит,J00-J99\n'
+        'J00.0,Насморк,J00\n'
+        'J00.0.1,Насморк острый,J00.0\n'
+        'J01,Острый синусит,J00-J99\n'
+        'K00,Нарушения развития зубов,\n', encoding='utf-8')
+    call_command('import_refbook', str(path), refbook='ICD', name='МКБ',
+                 refbook_version='1', date_start='2020-01-01',
+                 stdout=io.StringIO())
+    return Version.objects.get(refbook__code='ICD')
+
+
+def test_closure_rows_break_cycles_and_missing_parents():
+    """Циклы и ссылки на отсутствующие коды обрываются"""
+    rows = set(hierarchy.closure_rows([
+        ('A', ''), ('B', 'A'), ('C', 'B'), ('X', 'Y'), ('Y', 'X'),
+        ('Z', 'MISSING')]))
+    assert rows == {('A', 'B', 1), ('B', 'C', 1), ('A', 'C', 2),
+                    ('Y', 'X', 1), ('X', 'Y', 1)}
+
+
+@pytest.mark.django_db
+def test_hierarchy_endpoints(api_client, hierarchy_version,
+                             django_assert_num_queries):
+    """Предки, потомки и вхождение в поддерево - один запрос к иерархии"""
+    id = hierarchy_version.refbook_id
+    params = {'version': '1'}
+    with django_assert_num_queries(2):
+        response = api_client.get(
+            reverse('element-ancestors', kwargs={'id': id}),
+            {**params, 'code': 'J00.0.1'})
+    assert [element['code'] for element in response.json()['elements']] == [
+        'J00-J99', 'J00', 'J00.0']
+    assert response.json()['elements'][0]['parent'] is None
+    url = reverse('element-descendants', kwargs={'id': id})
+    with django_assert_num_queries(2):
+        response = api_client.get(url, {**params, 'code': 'J00-J99'})
+    assert response.json() == {'elements': [
+        {'code': 'J00', 'value': 'Острый назофарингит', 'parent': 'J00-J99'},
+        {'code': 'J00.0', 'value': 'Насморк', 'parent': 'J00'},
+        {'code': 'J00.0.1', 'value': 'Насморк острый', 'parent': 'J00.0'},
+        {'code': 'J01', 'value': 'Острый синусит', 'parent': 'J00-J99'},
+    ], 'next': None}
+    first = api_client.get(url, {'code': 'J00-J99', 'limit': 3}).json()
+    assert len(first['elements']) == 3
+    second = api_client.get(url, {'code': 'J00-J99', 'limit': 3,
+                                  'cursor': first['next']}).json()
+    assert second == {'elements': [{'code': 'J01', 'value': 'Острый синусит',
+                                    'parent': 'J00-J99'}], 'next': None}
+    check_url = reverse('check-descendant', kwargs={'id': id})
+    with django_assert_num_queries(2):
+        response = api_client.get(check_url, {
+            **params, 'code': 'J00.0.1', 'ancestor': 'J00-J99'})
+    assert response.json() == {'is_descendant': True}
+    assert api_client.get(check_url, {
+        'code': 'K00', 'ancestor': 'J00-J99'}).json() == {
+        'is_descendant': False}
+    response = api_client.get(reverse('element-ancestors', kwargs={'id': id}),
+                              {'code': 'K00'})
+    assert response.json() == {'elements': []}
+    response = api_client.get(url, {'code': 'UNKNOWN'})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = api_client.get(check_url, {'code': 'J00'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def closure_links(version):
+    """Строки таблицы замыкания версии с их идентификаторами."""
+    return set(ElementClosure.objects.filter(version=version).values_list(
+        'pk', 'ancestor', 'descendant', 'depth'))
+
+
+def expected_closure(version):
+    return set(hierarchy.closure_rows(Element.objects.materialized(
+        version).values_list('code', 'parent_code')))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_hierarchy_updated_in_place(hierarchy_version):
+    """Изменение одного элемента обновляет только связи его поддерева"""
+    version = hierarchy_version
+
+    def tree():
+        return {link[1:] for link in closure_links(version)}
+
+    def kept(links):
+        return closure_links(version) & links
+
+    links = closure_links(version)
+    Element.objects.create(version=version, code='K00.1', value='Адентия',
+                           parent_code='K00')
+    assert tree() == expected_closure(version)
+    assert kept(links) == links
+    # Элемент, ссылавшийся на отсутствовавший код, входит в его поддерево
+    Element.objects.create(version=version, code='X00.1', value='Сирота',
+                           parent_code='X00')
+    Element.objects.create(version=version, code='X00', value='Родитель',
+                           parent_code='K00')
+    assert ('K00', 'X00.1', 2) in tree()
+    assert tree() == expected_closure(version)
+    links = closure_links(version)
+    element = Element.objects.get(version=version, code='J00')
+    element.parent_code = 'K00.1'
+    element.save()
+    assert ('K00', 'J00.0.1', 4) in tree()
+    assert tree() == expected_closure(version)
+    untouched = {link for link in links if link[1] == 'J00-J99'
+                 and link[2] == 'J01'}
+    assert kept(links) >= untouched | {
+        link for link in links if link[1:] == ('J00.0', 'J00.0.1', 1)}
+    Element.objects.get(version=version, code='J00').delete()
+    assert tree() == expected_closure(version)
+    # Цикл обновить на месте нельзя: версия перестраивается целиком после
+    # фиксации
+    with transaction.atomic():
+        element = Element.objects.get(version=version, code='J00.0')
+        element.parent_code = 'J00.0.1'
+        element.save()
+        assert hierarchy.pending(version.pk)
+    assert not hierarchy.pending(version.pk)
+    assert tree() == expected_closure(version)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_hierarchy_rebuild_dropped_on_rollback(hierarchy_version):
+    """Откат транзакции отменяет и отложенное перестроение иерархии"""
+    version = hierarchy_version
+    links = closure_links(version)
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            Element.objects.filter(version=version, code='J01').update(
+                parent_code='J00')
+            assert hierarchy.pending(version.pk)
+            raise RuntimeError
+    assert not hierarchy.pending(version.pk)
+    with transaction.atomic():
+        hierarchy.schedule_rebuild([0])
+    assert closure_links(version) == links
+
+
+@pytest.mark.django_db
+def test_hierarchy_follows_element_changes(hierarchy_version,
+                                           django_capture_on_commit_callbacks):
+    """Иерархия перестраивается после изменения элементов, но не после
+    изменения одних значений"""
+    version = hierarchy_version
+
+    def tree():
+        return set(ElementClosure.objects.filter(version=version).values_list(
+            'ancestor', 'descendant', 'depth'))
+
+    links = closure_links(version)
+    with django_capture_on_commit_callbacks(execute=True):
+        element = Element.objects.get(version=version, code='J01')
+        element.value = 'Синусит'
+        element.save()
+    assert closure_links(version) == links
+    with django_capture_on_commit_callbacks(execute=True):
+        element.parent_code = 'J00'
+        element.save()
+        Element.objects.create(version=version, code='K00.1', value='Адентия',
+                               parent_code='K00')
+    assert ('J00', 'J01', 1) in tree() and ('J00-J99', 'J01', 2) in tree()
+    assert ('K00', 'K00.1', 1) in tree()
+    with django_capture_on_commit_callbacks(execute=True):
+        Element.objects.get(version=version, code='J00').delete()
+    assert tree() == {('J00.0', 'J00.0.1', 1), ('K00', 'K00.1', 1)}
+    Element.objects.filter(version=version).update(parent_code='')
+    call_command('build_refbook_hierarchy', refbook='ICD',
+                 stdout=io.StringIO())
+    assert tree() == set()
+
+
+@pytest.fixture
+def compressed_dir(tmp_path, settings):
+    settings.MED_REFBOOK_COMPRESSED_DIR = str(tmp_path / 'compressed')
+    return tmp_path / 'compressed'
+
+
+def test_negotiate_encoding():
+    """Выбор кодирования по весам Accept-Encoding"""
+    assert precompressed.negotiate_encoding('gzip, deflate, br') == 'br'
+    assert precompressed.negotiate_encoding('br;q=0.5, gzip') == 'gzip'
+    assert precompressed.negotiate_encoding('*;q=0.1') == 'br'
+    assert precompressed.negotiate_encoding('gzip;q=0, br;q=0') is None
+    assert precompressed.negotiate_encoding('identity') is None
+    assert precompressed.negotiate_encoding('') is None
+
+
+@pytest.mark.django_db
+def test_elements_precompressed(api_client, two_versions, compressed_dir,
+                                django_assert_num_queries):
+    """Полный ответ версии сжимается один раз и отдаётся из файла"""
+    url = reverse('element-list', kwargs={'id': two_versions.id})
+    params = {'version': 'v1'}
+    plain = api_client.get(url, params)
+    assert 'Accept-Encoding' in plain.headers['Vary']
+    assert 'Content-Encoding' not in plain.headers
+    response = api_client.get(url, params, HTTP_ACCEPT_ENCODING='gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert response.headers['ETag'] != plain.headers['ETag']
+    assert gzip.decompress(response.content) == plain.content
+    with django_assert_num_queries(1):
+        response = api_client.get(url, params, HTTP_ACCEPT_ENCODING='br')
+    assert response.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(response.content) == plain.content
+    response = api_client.get(url, params, HTTP_ACCEPT_ENCODING='br',
+                              HTTP_IF_NONE_MATCH=response.headers['ETag'])
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    # Постраничная выдача не сжимается
+    response = api_client.get(url, {**params, 'limit': 1},
+                              HTTP_ACCEPT_ENCODING='gzip')
+    assert 'Content-Encoding' not in response.headers
+    # Новое содержимое версии - новые файлы, прежние удаляются
+    old_files = set(compressed_dir.iterdir())
+    Element.objects.create(version=Version.objects.get(
+        refbook=two_versions, version='v1'), code='J09', value='Новый')
+    response = api_client.get(url, params, HTTP_ACCEPT_ENCODING='gzip')
+    assert {'code': 'J09', 'value': 'Новый'} in json.loads(
+        gzip.decompress(response.content))['elements']
+    assert not old_files & set(compressed_dir.iterdir())
+    assert len(list(compressed_dir.iterdir())) == 2
+
+
+@pytest.mark.django_db
+def test_precompressed_follows_db_fingerprint(two_versions, compressed_dir,
+                                              django_assert_num_queries):
+    """Файл выбирается по отпечатку версии в БД, а не по отпечатку
+    переданного (возможно, прочитанного до изменения) объекта версии"""
+    stale = Version.objects.get(refbook=two_versions, version='v1')
+    first = precompressed.ensure_compressed(stale, precompressed.GZIP)
+    Element.objects.create(version=stale, code='J09', value='Новый')
+    response = precompressed.compressed_response(stale, precompressed.GZIP)
+    assert {'code': 'J09', 'value': 'Новый'} in json.loads(
+        gzip.decompress(response.content))['elements']
+    assert not first.exists()
+    # Файлы текущего содержимого отдаются прежнему объекту без чтения
+    # элементов и не пересоздаются
+    path = precompressed.compressed_path(
+        stale, precompressed.GZIP, stored_fingerprint(
+            Version.objects.get(pk=stale.pk)))
+    mtime = path.stat().st_mtime_ns
+    refbook_revisions.get(stale.refbook_id)
+    with django_assert_num_queries(0):
+        assert precompressed.ensure_compressed(
+            stale, precompressed.GZIP) == path
+    assert path.stat().st_mtime_ns == mtime
+    # Удаляются только файлы с отпечатками, отличными от отпечатка в БД
+    Version.objects.filter(pk=stale.pk).update(fingerprint='f' * 32)
+    refbook_revisions.clear()
+    other = compressed_dir / f'{stale.pk}-{"e" * 32}.json.gz'
+    other.write_bytes(b'')
+    written = precompressed.ensure_compressed(stale, precompressed.GZIP)
+    assert written == path and path.exists()
+    assert not other.exists()
+    Version.objects.filter(pk=stale.pk).delete()
+    refbook_revisions.clear()
+    assert precompressed.compressed_response(
+        stale, precompressed.GZIP) is None
+
+
+@pytest.mark.django_db
+def test_future_version_not_precompressed(api_client, two_versions,
+                                          compressed_dir):
+    """Версии, которые ещё не начали действовать, не сжимаются"""
+    Version.objects.filter(refbook=two_versions, version='v2').update(
+        date_start=date(2999, 1, 1))
+    url = reverse('element-list', kwargs={'id': two_versions.id})
+    response = api_client.get(url, {'version': 'v2'},
+                              HTTP_ACCEPT_ENCODING='gzip')
+    assert response.status_code == status.HTTP_200_OK
+    assert 'Content-Encoding' not in response.headers
+    assert not compressed_dir.exists()
+
+
+@pytest.fixture
+def schema_cache():
+    schema.clear()
+    yield
+    schema.clear()
+
+
+def test_schema_built_once(api_client, schema_cache, monkeypatch):
+    """Схема строится при первом запросе и отдаётся из памяти с ETag"""
+    response = api_client.get('/schema/')
+    assert response.status_code == status.HTTP_200_OK
+    assert b'/refbooks/' in response.content
+    etag = response.headers['ETag']
+    monkeypatch.setattr(schema, 'generate_schema', None)
+    again = api_client.get('/schema/')
+    assert again.content == response.content
+    assert again.headers['ETag'] == etag
+    response = api_client.get('/schema/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    response = api_client.get('/schema/', {'format': 'json'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['ETag'] != etag
+    assert json.loads(response.content)['paths']
+    assert api_client.get('/docs/').status_code == status.HTTP_200_OK
+
+
+def test_schema_from_build(api_client, schema_cache, tmp_path, monkeypatch):
+    """Схема, собранная build_api_schema, читается из файла"""
+    out = io.StringIO()
+    call_command('build_api_schema', output_dir=str(tmp_path),
+                 lang=['ru'], stdout=out)
+    path = tmp_path / 'schema.ru.json'
+    assert str(path) in out.getvalue()
+    built = json.loads(path.read_bytes())
+    built['info']['title'] = 'Собранная схема'
+    path.write_text(json.dumps(built))
+    monkeypatch.setattr(schema, 'SCHEMA_DIR', str(tmp_path))
+    monkeypatch.setattr(schema, 'generate_schema', None)
+    response = api_client.get('/schema/', {'format': 'json'})
+    assert json.loads(response.content)['info']['title'] == 'Собранная схема'
+    with pytest.raises(CommandError):
+        call_command('build_api_schema', output_dir=str(tmp_path),
+                     lang=['xx'])
+
+
+def test_normalize_value():
+    """Регистр, пробелы, «ё»/«е» и запись символов Unicode не различаются"""
+    for value in ('грипп ', 'ГРИПП', 'Грипп', '\u00a0грипп\t'):
+        assert normalize_value(value) == 'грипп'
+    assert normalize_value('Острый  ЁЖ') == normalize_value('острый еж')
+    assert normalize_value('е\u0308ж') == 'еж'
+    assert normalize_value('грипп') != normalize_value('грипп а')
+
+
+@pytest.mark.django_db
+def test_check_element_normalized_match(api_client, setup_refbooks,
+                                        django_assert_num_queries):
+    """match=normalized сравнивает нормализованные значения одним запросом по
+    индексу; по умолчанию сравнение точное"""
+    refbook1, refbook2, version_1_1, _, _ = setup_refbooks
+    element = Element.objects.create(version=version_1_1, code='J10',
+                                     value='Грипп  сезонный, ёмкий')
+    assert element.normalized_value == 'грипп сезонный, емкий'
+    url = reverse('check-element', kwargs={'id': refbook1.id})
+    params = {'code': 'J10', 'value': ' ГРИПП сезонный, емкий ',
+              'version': 'v1'}
+    assert api_client.get(url, params).json() == {'exists': False}
+    params['match'] = 'normalized'
+    assert api_client.get(url, params).json() == {'exists': True}
+    params['code'] = 'J00'
+    assert api_client.get(url, params).json() == {'exists': False}
+    # Текущая версия - по уже прочитанной ревизии справочника, элемент -
+    # одним запросом по индексу
+    del params['version']
+    with django_assert_num_queries(1):
+        assert api_client.get(url, {**params, 'code': 'J10'}).json() == {
+            'exists': True}
+    # Указанная версия, а не текущая
+    url2 = reverse('check-element', kwargs={'id': refbook2.id})
+    assert api_client.get(url2, {'code': 'J01', 'value': 'TEST VALUE 2.0',
+                                 'version': 'v1', 'match': 'normalized'}
+                          ).json() == {'exists': True}
+    response = api_client.get(url, {**params, 'match': 'fuzzy'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    # Нормализованное значение обновляется вместе со значением
+    element.value = 'Ангина'
+    element.save(update_fields=['value'])
+    element.refresh_from_db()
+    assert element.normalized_value == 'ангина'
+    Element.objects.bulk_create([Element(version=version_1_1, code='J11',
+                                         value='КОРЬ')])
+    assert api_client.get(url, {'code': 'J11', 'value': 'корь',
+                                'match': 'normalized'}).json() == {
+        'exists': True}
+
+
+@pytest.mark.django_db
+def test_normalized_value_maintained_on_bulk_writes(setup_refbooks):
+    """update и bulk_update пересчитывают нормализованные значения, в том
+    числе заданные выражением"""
+    _, _, version_1_1, _, _ = setup_refbooks
+
+    def normalized(code):
+        return Element.objects.get(version=version_1_1,
+                                   code=code).normalized_value
+
+    Element.objects.filter(version=version_1_1, code='J00').update(
+        value='Острый  ЁЖ')
+    assert normalized('J00') == 'острый еж'
+    Element.objects.filter(value='Острый  ЁЖ').update(
+        value=Concat('value', Value(' ВТОРОЙ')))
+    assert normalized('J00') == 'острый еж второй'
+    five, six = Element.objects.bulk_create([
+        Element(version=version_1_1, code='J05', value='Five'),
+        Element(version=version_1_1, code='J06', value='Six')])
+    five.value = 'ПЯТЬ  Ё'
+    six.value = Concat(Value('ШЕСТЬ'), Value(' Ё'))
+    Element.objects.bulk_update([five, six], ['value'])
+    assert normalized('J05') == 'пять е'
+    assert normalized('J06') == 'шесть е'
+    Element.objects.untracked().filter(code='J05').update(value='Пять')
+    assert normalized('J05') == 'пять'
+    assert Element.objects.normalized_match(version_1_1, 'J06',
+                                            ' шесть ё').exists()
@@ -1,10 +1,39 @@
 from django.urls import path
-from .views import CheckElement, ElementList, RefbookList
+from .async_views import AsyncCheckElement, AsyncElementList, AsyncRefbookList
+from .instrumentation import METRICS_VIEW_NAME, metrics_view
+from .views import (ChangeFeed, CheckDescendant, CheckElement, CheckElements,
+                    CheckElementsOnDates, ElementAncestors,
+                    ElementDescendants, ElementList, ElementSearch,
+                    RefbookList, VersionDiff, VersionSnapshot)
 
 urlpatterns = [
     path('refbooks/', RefbookList.as_view(), name='refbook-list'),
+    path('refbooks/check_elements', CheckElementsOnDates.as_view(),
+         name='check-elements-on-dates'),
     path('refbooks/<int:id>/elements', ElementList.as_view(),
          name='element-list'),
+    path('refbooks/<int:id>/elements/search', ElementSearch.as_view(),
+         name='element-search'),
     path('refbooks/<int:id>/check_element', CheckElement.as_view(),
          name='check-element'),
+    path('refbooks/<int:id>/check_elements', CheckElements.as_view(),
+         name='check-elements'),
+    path('refbooks/<int:id>/ancestors', ElementAncestors.as_view(),
+         name='element-ancestors'),
+    path('refbooks/<int:id>/descendants', ElementDescendants.as_view(),
+         name='element-descendants'),
+    path('refbooks/<int:id>/is_descendant', CheckDescendant.as_view(),
+         name='check-descendant'),
+    path('refbooks/<int:id>/diff', VersionDiff.as_view(), name='version-diff'),
+    path('refbooks/<int:id>/snapshot', VersionSnapshot.as_view(),
+         name='version-snapshot'),
+    # Асинхронные варианты эндпоинтов чтения для запуска под ASGI
+    path('async/refbooks/', AsyncRefbookList.as_view(),
+         name='async-refbook-list'),
+    path('async/refbooks/<int:id>/elements', AsyncElementList.as_view(),
+         name='async-element-list'),
+    path('async/refbooks/<int:id>/check_element', AsyncCheckElement.as_view(),
+         name='async-check-element'),
+    path('changes', ChangeFeed.as_view(), name='change-feed'),
+    path('metrics', metrics_view, name=METRICS_VIEW_NAME),
 ]
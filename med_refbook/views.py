@@ -1,15 +1,242 @@
 # from datetime import datetime
+import base64
+import binascii
 
-from django.db.models import Prefetch, Q
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
 from django.utils.dateparse import parse_date
+from django.utils.cache import patch_vary_headers
 from django.utils.timezone import now
+from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 from rest_framework.exceptions import ValidationError, NotFound
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .caching import get_or_load
+from .changes import changes_since
+from .diff import change_record, diff_document, version_changes
+from .hierarchy import ancestors, descendants, is_descendant
+from .http_cache import (file_response, is_historical, make_etag,
+                         not_modified, set_cache_headers, version_etag)
+from .index import element_index
 from .models import Element, Refbook, Version
-from .serializers import ElementSerializer, RefbookSerializer
+from .precompressed import compressed_response, requested_encoding
+from .resolvers import current_version_resolver, versions_on_dates
+from .revisions import refbook_revisions
+from .routers import pinned, primary_reads, replica_reads
+from .search import search_index
+from .snapshots import SUFFIX, ensure_snapshot
+from .serializers import (ChangeFeedSerializer, CheckElementItemSerializer,
+                          CheckElementResultSerializer,
+                          DatedCheckElementItemSerializer,
+                          DatedCheckElementResultSerializer, ElementSerializer,
+                          HierarchyElementSerializer, RefbookSerializer,
+                          VersionDiffSerializer)
+from .streaming import STREAM_FORMATS, streaming_response
+
+CHECK_ELEMENTS_MAX_BATCH = getattr(settings, 'MED_REFBOOK_CHECK_BATCH_MAX',
+                                   1000)
+ELEMENTS_PAGE_MAX = getattr(settings, 'MED_REFBOOK_ELEMENTS_PAGE_MAX', 10000)
+CHANGES_PAGE_MAX = getattr(settings, 'MED_REFBOOK_CHANGES_PAGE_MAX', 1000)
+DIFF_CACHE_TIMEOUT = getattr(settings, 'MED_REFBOOK_DIFF_CACHE_TIMEOUT',
+                             86400)
+REFBOOKS_CACHE_TIMEOUT = getattr(settings,
+                                 'MED_REFBOOK_REFBOOKS_CACHE_TIMEOUT', 86400)
+
+SEARCH_LIMIT_MAX = getattr(settings, 'MED_REFBOOK_SEARCH_LIMIT_MAX', 100)
+SEARCH_LIMIT = min(20, SEARCH_LIMIT_MAX)
+
+NO_ELEMENTS = {'detail': 'Элементы не найдены для указанной версии'}
+NO_VALID_VERSION = 'Не найдено валидной версии справочника.'
+
+FLAG_VALUES = {'true': True, '1': True, 'false': False, '0': False}
+
+# Способы сравнения значения в check_element (параметр match)
+MATCH_EXACT = 'exact'
+MATCH_NORMALIZED = 'normalized'
+MATCH_MODES = [MATCH_EXACT, MATCH_NORMALIZED]
+BAD_MATCH = {"detail": "Параметр 'match' должен быть exact или normalized."}
+
+
+def validate_stream_format(stream_format):
+    if stream_format not in STREAM_FORMATS:
+        raise ValidationError({
+            'detail': 'Параметр stream принимает значения: '
+                      + ', '.join(STREAM_FORMATS) + '.'})
+
+
+def parse_filter_date(query_date):
+    """Дата из параметра ``date``; без параметра - сегодняшняя."""
+    filter_date = parse_date(query_date) if query_date else now().date()
+    if not filter_date:
+        raise ValidationError({
+            'detail': 'Неверный формат даты. Ожидается ГГГГ-ММ-ДД.'})
+    return filter_date
+
+
+def parse_flag(query_params, name):
+    value = query_params.get(name, 'false').lower()
+    if value not in FLAG_VALUES:
+        raise ValidationError({
+            'detail': f'Параметр {name} принимает значения true или false.'})
+    return FLAG_VALUES[value]
+
+
+def refbooks_on(filter_date, include_current=False):
+    """Справочники, у которых есть версия, действующая на дату, одним
+    запросом; с ``include_current`` - вместе с этой версией и датой её
+    начала."""
+    versions = Version.objects.filter(
+        refbook=OuterRef('pk'), date_start__lte=filter_date
+    ).order_by('-date_start')
+    refbooks = Refbook.objects.order_by('id')
+    fields = ['id', 'code', 'name']
+    if not include_current:
+        return refbooks.filter(Exists(versions)).values(*fields)
+    return refbooks.with_version_on(filter_date).filter(
+        current_version__isnull=False).values(
+        *fields, 'current_version', 'current_version_date_start')
+
+
+def validate_batch(items):
+    if not isinstance(items, list):
+        raise ValidationError(
+            {"detail": "Ожидается массив элементов."})
+    if len(items) > CHECK_ELEMENTS_MAX_BATCH:
+        raise ValidationError({
+            "detail": "Превышен максимальный размер пакета: "
+                      f"{CHECK_ELEMENTS_MAX_BATCH}."})
+
+
+def find_pairs(version, codes):
+    """Пары код/значение версии: из индекса, если версия уже загружена,
+    иначе одним запросом по кодам пакета."""
+    elements = element_index.peek(version)
+    if elements is not None:
+        return elements
+    return set(Element.objects.materialized(version).filter(
+        code__in=codes).values_list('code', 'value'))
+
+
+def refbooks_cache_key(revision, filter_date, include_current):
+    """Ключ кэша списка справочников; ревизия каталога в ключе заменяет
+    явный сброс при изменении справочников и версий."""
+    return (f'med_refbook:refbooks:{revision}:{filter_date.isoformat()}:'
+            f'{int(include_current)}')
+
+
+def refbook_list_document(revision, filter_date, include_current=False):
+    """Ответ списка справочников из общего кэша или основной БД (ревизия
+    каталога в ключе прочитана из неё)."""
+    def load():
+        with primary_reads():
+            return {'refbooks': list(refbooks_on(filter_date,
+                                                 include_current))}
+
+    return get_or_load(
+        refbooks_cache_key(revision, filter_date, include_current), load,
+        REFBOOKS_CACHE_TIMEOUT)
+
+
+def requested_version(refbook_id, version_param):
+    """Указанная версия справочника или, без параметра, текущая."""
+    if version_param:
+        version = Version.objects.filter(refbook_id=refbook_id,
+                                         version=version_param).first()
+    else:
+        version = current_version_resolver.resolve(refbook_id)
+    if not version:
+        raise version_not_found(
+            Refbook.objects.filter(pk=refbook_id).exists(), version_param)
+    return version
+
+
+async def arequested_version(refbook_id, version_param):
+    """Асинхронный ``requested_version``."""
+    if version_param:
+        version = await Version.objects.filter(
+            refbook_id=refbook_id, version=version_param).afirst()
+    else:
+        version = await current_version_resolver.aresolve(refbook_id)
+    if not version:
+        raise version_not_found(
+            await Refbook.objects.filter(pk=refbook_id).aexists(),
+            version_param)
+    return version
+
+
+def version_not_found(refbook_exists, version_param):
+    if not refbook_exists:
+        return NotFound({'detail': 'Справочник не найден'})
+    if version_param:
+        return NotFound({'detail': 'Указанная версия не найдена'})
+    return NotFound({'detail': 'Текущая версия не найдена'})
+
+
+def page_limit(query_params):
+    try:
+        limit = int(query_params.get('limit', ELEMENTS_PAGE_MAX))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= ELEMENTS_PAGE_MAX:
+        raise ValidationError({
+            'detail': 'Параметр limit должен быть целым числом от 1 до '
+                      f'{ELEMENTS_PAGE_MAX}.'})
+    return limit
+
+
+def page_document(rows, limit, cursor):
+    """Страница элементов из ``limit + 1`` прочитанных строк."""
+    if not rows and not cursor:
+        raise NotFound(NO_ELEMENTS)
+    next_cursor = encode_cursor(rows[limit - 1][0]) if len(
+        rows) > limit else None
+    return {
+        'elements': [{'code': code, 'value': value}
+                     for code, value in rows[:limit]],
+        'next': next_cursor,
+    }
+
+
+def hierarchy_element(code, value, parent_code):
+    return {'code': code, 'value': value, 'parent': parent_code or None}
+
+
+def required_code(query_params, *names):
+    """Значения обязательных параметров с кодами элементов."""
+    values = [query_params.get(name) for name in names]
+    if not all(values):
+        raise ValidationError({'detail': 'Параметры ' + ', '.join(
+            f"'{name}'" for name in names) + ' обязательны.'})
+    return values
+
+
+def ensure_element(version, code):
+    if not Element.objects.materialized(version).filter(code=code).exists():
+        raise NotFound({'detail': 'Элемент не найден в версии справочника'})
+
+
+def encode_cursor(code):
+    return base64.urlsafe_b64encode(code.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.b64decode(cursor.encode(), altchars=b'-_',
+                                validate=True).decode()
+    except (binascii.Error, UnicodeError):
+        raise ValidationError({'detail': 'Некорректный курсор.'})
+
+
+class ReadOnlyAPIView(APIView):
+    """Эндпоинт, который только читает данные: чтение идёт из реплики БД,
+    если она настроена."""
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads():
+            return super().dispatch(request, *args, **kwargs)
 
 
 @extend_schema(
@@ -18,14 +245,20 @@ from .serializers import ElementSerializer, RefbookSerializer
         OpenApiParameter(name='date',
                          description='Дата в формате ГГГГ-ММ-ДД для фильтрации '
                                      'актуальных справочников.',
-                         required=False, type=str)
+                         required=False, type=str),
+        OpenApiParameter(name='include_current',
+                         description='Добавить к справочникам версию, '
+                                     'действующую на дату, и дату её начала',
+                         required=False, type=bool),
     ],
     responses={200: RefbookSerializer(many=True)},
 )
-class RefbookList(APIView):
-    """Получение списка справочников (+ актуальных на указанную дату). \n
+class RefbookList(ReadOnlyAPIView):
+    """Получение списка справочников, у которых есть версия, действующая на
+    указанную дату (по умолчанию - на сегодня). \n
     Пример запроса:
-    ` http://127.0.0.1:8000/refbooks/?date=2022-10-01 ` \n
+    ` http://127.0.0.1:8000/refbooks/?date=2022-10-01&include_current=true `
+    \n
     Пример ответа:
     ```
     {
@@ -33,23 +266,27 @@ class RefbookList(APIView):
             {
                 "id": 1,
                 "code": "S001",
-                "name": "Мед.справ."
+                "name": "Мед.справ.",
+                "current_version": "v1.0",
+                "current_version_date_start": "2022-09-01"
             }
         ]
     }
-    ```"""
+    ```
+    Поля `current_version` и `current_version_date_start` добавляются только
+    при `include_current=true`. Список кэшируется для каждой даты до
+    изменения справочников или версий."""
     def get(self, request, *args, **kwargs):
-        query_date = request.query_params.get('date')
-        filter_date = parse_date(query_date) if query_date else now().date()
-        if not filter_date:
-            raise ValidationError({
-                'detail': 'Неверный формат даты. Ожидается ГГГГ-ММ-ДД.'})
-        filtered_versions = Version.objects.filter(date_start__lte=filter_date)
-        refbooks = Refbook.objects.prefetch_related(
-            Prefetch('versions', queryset=filtered_versions)
-        ).distinct()
-        serializer = RefbookSerializer(refbooks, many=True)
-        return Response({'refbooks': serializer.data})
+        filter_date = parse_filter_date(request.query_params.get('date'))
+        include_current = parse_flag(request.query_params, 'include_current')
+        revision, last_modified = refbook_revisions.catalog()
+        etag = make_etag(revision, filter_date, include_current,
+                         request.accepted_renderer.format)
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = Response(refbook_list_document(
+                revision, filter_date, include_current))
+        return set_cache_headers(response, etag, last_modified)
 
 
 @extend_schema(
@@ -60,11 +297,23 @@ class RefbookList(APIView):
                          required=True, type=int),
         OpenApiParameter(name='version',
                          description='Версия справочника',
-                         required=False, type=str)
+                         required=False, type=str),
+        OpenApiParameter(name='limit',
+                         description='Размер страницы (постраничная выдача '
+                                     'в порядке кодов элементов)',
+                         required=False, type=int),
+        OpenApiParameter(name='cursor',
+                         description='Курсор следующей страницы из поля '
+                                     '"next" предыдущего ответа',
+                         required=False, type=str),
+        OpenApiParameter(name='stream',
+                         description='Потоковая выдача всех элементов '
+                                     'версии: ndjson или json',
+                         required=False, type=str, enum=STREAM_FORMATS),
     ],
     responses={200: ElementSerializer(many=True)},
 )
-class ElementList(APIView):
+class ElementList(ReadOnlyAPIView):
     """Получение элементов заданного справочника. \n
     Пример запроса:
     `http://127.0.0.1:8000/refbooks/1/elements?version=v2.0` \n
@@ -83,28 +332,134 @@ class ElementList(APIView):
         ]
     }
     ```
+    Для больших версий доступна постраничная выдача по курсору
+    (`?limit=1000`, далее `?limit=1000&cursor=<next>`; в ответе добавляется
+    поле `next`, равное `null` на последней странице) и потоковая выдача
+    всех элементов (`?stream=ndjson` или `?stream=json`). В обоих режимах
+    элементы упорядочены по коду. \n
+    Полный ответ для версии, которая уже начала действовать, сжимается
+    (brotli или gzip по `Accept-Encoding`) один раз и затем отдаётся
+    из файла без обращения к элементам версии.
     """
     def get(self, request, id, *args, **kwargs):
         version_param = request.query_params.get('version')
-        if not Refbook.objects.filter(pk=id).exists():
-            raise NotFound({'detail': 'Справочник не найден'})
-        if version_param:
-            version = Version.objects.filter(refbook_id=id,
-                                             version=version_param).first()
-            if not version:
-                raise NotFound({'detail': 'Указанная версия не найдена'})
-        else:
-            version = Version.objects.filter(
-                refbook_id=id, date_start__lte=now().date()).order_by(
-                '-date_start').first()
-            if not version:
-                raise NotFound({'detail': 'Текущая версия не найдена'})
-        elements = Element.objects.filter(version=version)
-        if not elements:
-            raise NotFound({
-                'detail': 'Элементы не найдены для указанной версии'})
-        serializer = ElementSerializer(elements, many=True)
-        return Response({'elements': serializer.data})
+        version = requested_version(id, version_param)
+        encoding = requested_encoding(request, version,
+                                      request.accepted_renderer.format)
+        etag = version_etag(version, request.accepted_renderer.format,
+                            *filter(None, [encoding]))
+        last_modified = version.updated_at.timestamp()
+        historical = bool(version_param) and is_historical(
+            version, current_version_resolver.resolve(id))
+        response = not_modified(request, etag, last_modified)
+        if response is None and encoding:
+            response = compressed_response(version, encoding)
+        if response is None:
+            response = self._elements(request, version)
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return set_cache_headers(response, etag, last_modified, historical)
+
+    def _elements(self, request, version):
+        elements = Element.objects.materialized(version)
+        stream_format = request.query_params.get('stream')
+        if stream_format:
+            return self._stream(version, elements, stream_format)
+        if ('limit' in request.query_params
+                or 'cursor' in request.query_params):
+            return self._page(request, version)
+        # Ответ строится из кортежей без ElementSerializer: на больших
+        # версиях сериализатор занимает основную часть времени запроса
+        rows = elements.values_list('code', 'value')
+        if not rows:
+            raise NotFound(NO_ELEMENTS)
+        return Response({'elements': [{'code': code, 'value': value}
+                                      for code, value in rows]})
+
+    @staticmethod
+    def _stream(version, elements, stream_format):
+        validate_stream_format(stream_format)
+        if not elements.exists():
+            raise NotFound(NO_ELEMENTS)
+        # Тело читается после выхода из dispatch: БД выбирается сейчас
+        rows = pinned(Element.objects.ordered_pairs(version)).iterator(
+            chunk_size=2000)
+        return streaming_response(
+            stream_format, 'elements',
+            ({'code': code, 'value': value} for code, value in rows))
+
+    @staticmethod
+    def _page(request, version):
+        """Страница элементов по курсору (коду последнего элемента)."""
+        limit = page_limit(request.query_params)
+        cursor = request.query_params.get('cursor')
+        rows = list(Element.objects.ordered_pairs(
+            version, decode_cursor(cursor) if cursor else None)[:limit + 1])
+        return Response(page_document(rows, limit, cursor))
+
+
+@extend_schema(
+    summary='Поиск элементов справочника по коду и значению',
+    parameters=[
+        OpenApiParameter(name='id', location=OpenApiParameter.PATH,
+                         description='Идентификатор справочника',
+                         required=True, type=int),
+        OpenApiParameter(name='q',
+                         description='Начало кода или слова значения '
+                                     '(регистр не учитывается)',
+                         required=True, type=str),
+        OpenApiParameter(name='version',
+                         description='Версия справочника',
+                         required=False, type=str),
+        OpenApiParameter(name='limit',
+                         description='Максимальное число результатов '
+                                     f'(по умолчанию {SEARCH_LIMIT})',
+                         required=False, type=int),
+    ],
+    responses={200: ElementSerializer(many=True)},
+)
+class ElementSearch(ReadOnlyAPIView):
+    """Поиск элементов версии справочника для подсказок при вводе. \n
+    Пример запроса:
+    `http://127.0.0.1:8000/refbooks/1/elements/search?q=грип` \n
+    Пример ответа:
+    ```
+    {
+        "elements": [
+            {
+                "code": "J11",
+                "value": "Грипп, вирус не идентифицирован"
+            }
+        ]
+    }
+    ```
+    Сначала идут элементы с кодом, начинающимся с `q`, затем элементы,
+    в значении которых каждое слово запроса совпадает с началом какого-либо
+    слова (более короткие значения выше)."""
+    def get(self, request, id, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'detail': "Параметр 'q' обязателен."})
+        try:
+            limit = int(request.query_params.get('limit', SEARCH_LIMIT))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= SEARCH_LIMIT_MAX:
+            raise ValidationError({
+                'detail': 'Параметр limit должен быть целым числом от 1 до '
+                          f'{SEARCH_LIMIT_MAX}.'})
+        version_param = request.query_params.get('version')
+        version = requested_version(id, version_param)
+        etag = version_etag(version, request.accepted_renderer.format,
+                            'search', query, limit)
+        last_modified = version.updated_at.timestamp()
+        historical = bool(version_param) and is_historical(
+            version, current_version_resolver.resolve(id))
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            rows = search_index.search(version, query, limit)
+            response = Response({'elements': [
+                {'code': code, 'value': value} for code, value in rows]})
+        return set_cache_headers(response, etag, last_modified, historical)
 
 
 @extend_schema(
@@ -122,15 +477,23 @@ class ElementList(APIView):
         OpenApiParameter(name='version',
                          description='Версия справочника',
                          required=False, type=str),
+        OpenApiParameter(name='match',
+                         description='Сравнение значения: exact - точное '
+                                     '(по умолчанию), normalized - без '
+                                     'учёта регистра, пробелов и «ё»/«е»',
+                         required=False, type=str,
+                         enum=MATCH_MODES),
     ],
     responses={200: OpenApiParameter(name='exists', type=bool)},
 )
-class CheckElement(APIView):
+class CheckElement(ReadOnlyAPIView):
     """ Проверка наличия элемента с данным кодом и значением в указанной версии
     справочника. \n
     Пример запроса:
     `http://127.0.0.1:8000/refbooks/1/check_element?code=234&value=Насморк&
     version=v1.0` \n
+    С `match=normalized` значение сравнивается без учёта регистра, лишних
+    пробелов и различия «ё»/«е». \n
     Пример ответа:
     ```
     {
@@ -141,21 +504,577 @@ class CheckElement(APIView):
         code = request.query_params.get('code')
         value = request.query_params.get('value')
         version_name = request.query_params.get('version')
+        match = request.query_params.get('match', MATCH_EXACT)
         if not code or not value:
             return Response(
                 {"detail": "Параметры 'code' и 'value' обязательны."},
                 status=400)
-        refbook = Refbook.objects.filter(pk=id).first()
-        if not refbook:
-            raise NotFound({"detail": "Справочник не найден."})
-        version_filter = Q(refbook=refbook,
-                           version=version_name) if version_name else Q(
-            refbook=refbook, date_start__lte=now().date())
-        latest_version = Version.objects.filter(version_filter).order_by(
-            '-date_start').first()
+        if match not in MATCH_MODES:
+            return Response(BAD_MATCH, status=400)
+        if version_name:
+            elements = element_index.lookup(id, version_name) if (
+                match == MATCH_EXACT) else None
+            if elements is not None:
+                return Response({"exists": (code, value) in elements})
+            latest_version = None
+        else:
+            latest_version = current_version_resolver.resolve(id)
+        if not latest_version:
+            refbook = Refbook.objects.filter(pk=id).first()
+            if not refbook:
+                raise NotFound({"detail": "Справочник не найден."})
+            if version_name:
+                latest_version = Version.objects.filter(
+                    refbook=refbook, version=version_name).first()
         if not latest_version:
             raise NotFound(
                 {"detail": "Не найдено валидной версии справочника."})
-        element_exists = Element.objects.filter(version=latest_version,
-                                                code=code, value=value).exists()
+        if match == MATCH_NORMALIZED:
+            element_exists = Element.objects.normalized_match(
+                latest_version, code, value).exists()
+        else:
+            element_exists = element_index.contains(latest_version, code,
+                                                    value)
         return Response({"exists": element_exists})
+
+
+@extend_schema(
+    summary="Пакетная проверка наличия элементов в справочнике",
+    parameters=[
+        OpenApiParameter(name='id', location=OpenApiParameter.PATH,
+                         description='Идентификатор справочника',
+                         required=True, type=int),
+        OpenApiParameter(name='version',
+                         description='Версия справочника для элементов, '
+                                     'у которых версия не указана',
+                         required=False, type=str),
+    ],
+    request=CheckElementItemSerializer(many=True),
+    responses={200: CheckElementResultSerializer(many=True)},
+)
+class CheckElements(ReadOnlyAPIView):
+    """Пакетная проверка наличия элементов в справочнике. \n
+    Принимает массив пар код/значение (не более
+    `MED_REFBOOK_CHECK_BATCH_MAX`, по умолчанию 1000) и возвращает результаты
+    в порядке следования элементов запроса. Элементы без версии проверяются
+    в версии из параметра `version`, а если он не указан, в текущей версии
+    справочника. \n
+    Пример запроса:
+    `POST http://127.0.0.1:8000/refbooks/1/check_elements`
+    ```
+    [
+        {"code": "234", "value": "Насморк"},
+        {"code": "123", "value": "Грипп", "version": "v1.0"}
+    ]
+    ```
+    Пример ответа:
+    ```
+    {
+        "results": [
+            {"code": "234", "value": "Насморк", "exists": true},
+            {"code": "123", "value": "Грипп", "exists": false}
+        ]
+    }
+    ```"""
+    def post(self, request, id, *args, **kwargs):
+        items = request.data
+        validate_batch(items)
+        default_version = request.query_params.get('version')
+        for number, item in enumerate(items):
+            if (not isinstance(item, dict)
+                    or not item.get('code') or not item.get('value')
+                    or not isinstance(item['code'], str)
+                    or not isinstance(item['value'], str)
+                    or not isinstance(item.get('version') or '', str)):
+                raise ValidationError({
+                    "detail": "Параметры 'code' и 'value' обязательны "
+                              f"(элемент {number})."})
+        if not Refbook.objects.filter(pk=id).exists():
+            raise NotFound({"detail": "Справочник не найден."})
+        versions = self._resolve_versions(
+            id, {item.get('version') or default_version for item in items})
+        codes = {}
+        for item in items:
+            version = versions[item.get('version') or default_version]
+            if version is not None:
+                codes.setdefault(version, set()).add(item['code'])
+        found = {version: find_pairs(version, version_codes)
+                 for version, version_codes in codes.items()}
+        results = []
+        for item in items:
+            version = versions[item.get('version') or default_version]
+            result = {"code": item['code'], "value": item['value']}
+            if version is None:
+                result["exists"] = False
+                result["detail"] = NO_VALID_VERSION
+            else:
+                result["exists"] = (item['code'],
+                                    item['value']) in found[version]
+            results.append(result)
+        return Response({"results": results})
+
+    @staticmethod
+    def _resolve_versions(refbook_id, names):
+        """Версии справочника по именам одним запросом; ``None`` - текущая."""
+        versions = dict.fromkeys(names)
+        explicit = names - {None}
+        if explicit:
+            for version in Version.objects.filter(refbook_id=refbook_id,
+                                                  version__in=explicit):
+                versions[version.version] = version
+        if None in names:
+            versions[None] = current_version_resolver.resolve(refbook_id)
+        return versions
+
+
+@extend_schema(
+    summary="Пакетная проверка элементов разных справочников на даты",
+    request=DatedCheckElementItemSerializer(many=True),
+    responses={200: DatedCheckElementResultSerializer(many=True)},
+)
+class CheckElementsOnDates(ReadOnlyAPIView):
+    """Пакетная проверка наличия элементов в версиях разных справочников,
+    действующих на указанные даты. \n
+    Справочник задаётся кодом (строкой) или идентификатором (числом); без
+    даты элемент проверяется на сегодня. Версии для всех пар справочник/дата
+    определяются одним запросом, элементы проверяются одним запросом на
+    версию. Размер пакета ограничен `MED_REFBOOK_CHECK_BATCH_MAX`. \n
+    Пример запроса:
+    `POST http://127.0.0.1:8000/refbooks/check_elements`
+    ```
+    [
+        {"refbook": "ICD-10", "code": "J11", "value": "Грипп",
+         "date": "2021-03-15"},
+        {"refbook": 2, "code": "A16.20", "value": "Пломбирование зуба",
+         "date": "2023-11-01"}
+    ]
+    ```
+    Пример ответа:
+    ```
+    {
+        "results": [
+            {"refbook": "ICD-10", "code": "J11", "value": "Грипп",
+             "date": "2021-03-15", "version": "2021", "exists": true},
+            {"refbook": 2, "code": "A16.20", "value": "Пломбирование зуба",
+             "date": "2023-11-01", "version": null, "exists": false,
+             "detail": "Не найдено валидной версии справочника."}
+        ]
+    }
+    ```"""
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        validate_batch(items)
+        today = now().date()
+        dates = []
+        for number, item in enumerate(items):
+            if (not isinstance(item, dict)
+                    or not item.get('code') or not item.get('value')
+                    or not isinstance(item['code'], str)
+                    or not isinstance(item['value'], str)):
+                raise ValidationError({
+                    "detail": "Параметры 'code' и 'value' обязательны "
+                              f"(элемент {number})."})
+            refbook = item.get('refbook')
+            if isinstance(refbook, bool) or not refbook or not isinstance(
+                    refbook, (int, str)):
+                raise ValidationError({
+                    "detail": "Параметр 'refbook' - код или идентификатор "
+                              f"справочника (элемент {number})."})
+            dates.append(self._date(item.get('date'), today, number))
+        refbook_ids = self._refbook_ids({item['refbook'] for item in items})
+        versions = versions_on_dates(
+            (refbook_ids[item['refbook']], day)
+            for item, day in zip(items, dates)
+            if item['refbook'] in refbook_ids)
+        codes = {}
+        for item, day in zip(items, dates):
+            version = versions.get((refbook_ids.get(item['refbook']), day))
+            if version is not None:
+                codes.setdefault(version, set()).add(item['code'])
+        found = {version: find_pairs(version, version_codes)
+                 for version, version_codes in codes.items()}
+        results = []
+        for item, day in zip(items, dates):
+            version = versions.get((refbook_ids.get(item['refbook']), day))
+            result = {"refbook": item['refbook'], "code": item['code'],
+                      "value": item['value'], "date": day,
+                      "version": version.version if version else None}
+            if item['refbook'] not in refbook_ids:
+                result["exists"] = False
+                result["detail"] = "Справочник не найден."
+            elif version is None:
+                result["exists"] = False
+                result["detail"] = NO_VALID_VERSION
+            else:
+                result["exists"] = (item['code'],
+                                    item['value']) in found[version]
+            results.append(result)
+        return Response({"results": results})
+
+    @staticmethod
+    def _date(value, today, number):
+        if value is None:
+            return today
+        try:
+            day = parse_date(value) if isinstance(value, str) else None
+        except ValueError:
+            day = None
+        if not day:
+            raise ValidationError({
+                "detail": "Неверный формат даты. Ожидается ГГГГ-ММ-ДД "
+                          f"(элемент {number})."})
+        return day
+
+    @staticmethod
+    def _refbook_ids(references):
+        """Идентификаторы справочников по кодам и идентификаторам из
+        пакета одним запросом."""
+        ids = {reference for reference in references
+               if isinstance(reference, int)}
+        codes = references - ids
+        refbook_ids = {}
+        for pk, code in Refbook.objects.filter(
+                Q(pk__in=ids) | Q(code__in=codes)).values_list('pk', 'code'):
+            if pk in ids:
+                refbook_ids[pk] = pk
+            if code in codes:
+                refbook_ids[code] = pk
+        return refbook_ids
+
+
+@extend_schema(
+    summary="Отличия между двумя версиями справочника",
+    parameters=[
+        OpenApiParameter(name='id', location=OpenApiParameter.PATH,
+                         description='Идентификатор справочника',
+                         required=True, type=int),
+        OpenApiParameter(name='from',
+                         description='Исходная версия справочника',
+                         required=True, type=str),
+        OpenApiParameter(name='to',
+                         description='Новая версия справочника',
+                         required=True, type=str),
+        OpenApiParameter(name='stream',
+                         description='Потоковая выдача изменений: ndjson '
+                                     'или json',
+                         required=False, type=str, enum=STREAM_FORMATS),
+    ],
+    responses={200: VersionDiffSerializer},
+)
+class VersionDiff(ReadOnlyAPIView):
+    """Добавленные, удалённые и изменённые элементы версии `to` относительно
+    версии `from`. Результат кэшируется по отпечаткам содержимого версий.
+    При `?stream=ndjson` (или `json`) изменения выдаются потоково по одному,
+    в порядке кодов, с полем `change`. \n
+    Пример запроса:
+    `http://127.0.0.1:8000/refbooks/1/diff?from=v1.0&to=v2.0` \n
+    Пример ответа:
+    ```
+    {
+        "added": [{"code": "345", "value": "Ангина"}],
+        "removed": [{"code": "321", "value": "Плоскостопие"}],
+        "changed": [
+            {"code": "123", "value": "Грипп А", "previous_value": "Грипп"}
+        ]
+    }
+    ```"""
+    def get(self, request, id, *args, **kwargs):
+        old_name = request.query_params.get('from')
+        new_name = request.query_params.get('to')
+        if not old_name or not new_name:
+            raise ValidationError(
+                {"detail": "Параметры 'from' и 'to' обязательны."})
+        stream_format = request.query_params.get('stream')
+        if stream_format:
+            validate_stream_format(stream_format)
+        if not Refbook.objects.filter(pk=id).exists():
+            raise NotFound({'detail': 'Справочник не найден'})
+        versions = {version.version: version for version in
+                    Version.objects.filter(refbook_id=id,
+                                           version__in=[old_name, new_name])}
+        if old_name not in versions or new_name not in versions:
+            raise NotFound({'detail': 'Указанная версия не найдена'})
+        old, new = versions[old_name], versions[new_name]
+        etag = make_etag('diff', old.pk, old.fingerprint, new.pk,
+                         new.fingerprint, request.accepted_renderer.format,
+                         stream_format)
+        last_modified = max(old.updated_at, new.updated_at).timestamp()
+        current = current_version_resolver.resolve(id)
+        historical = is_historical(old, current) and is_historical(
+            new, current)
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = self._diff(old, new, stream_format)
+        return set_cache_headers(response, etag, last_modified, historical)
+
+    @staticmethod
+    def _diff(old, new, stream_format):
+        key = (f'med_refbook:diff:{old.pk}:{old.fingerprint}:'
+               f'{new.pk}:{new.fingerprint}')
+        changes = cache.get(key)
+        if stream_format:
+            if changes is None:
+                changes = pinned(version_changes(old, new)).iterator(
+                    chunk_size=2000)
+            return streaming_response(
+                stream_format, 'changes',
+                (change_record(*change) for change in changes))
+        if changes is None:
+            changes = get_or_load(
+                key, lambda: list(version_changes(old, new)),
+                DIFF_CACHE_TIMEOUT)
+        return Response(diff_document(changes))
+
+
+@extend_schema(
+    summary='Двоичный снимок версии справочника',
+    parameters=[
+        OpenApiParameter(name='id', location=OpenApiParameter.PATH,
+                         description='Идентификатор справочника',
+                         required=True, type=int),
+        OpenApiParameter(name='version',
+                         description='Версия справочника (по умолчанию '
+                                     'текущая)',
+                         required=False, type=str),
+    ],
+    responses={(200, 'application/octet-stream'): OpenApiTypes.BINARY},
+)
+class VersionSnapshot(ReadOnlyAPIView):
+    """Полное содержимое версии справочника в двоичном формате снимка
+    (описание формата и средство чтения - в `med_refbook/snapshots.py`). \n
+    Пример запроса:
+    `http://127.0.0.1:8000/refbooks/1/snapshot?version=v2.0` \n
+    Снимок создаётся при первом запросе и хранится на диске до изменения
+    версии. Поддерживаются условные запросы и загрузка по частям
+    (`Range: bytes=...`)."""
+    def get(self, request, id, *args, **kwargs):
+        version_param = request.query_params.get('version')
+        version = requested_version(id, version_param)
+        etag = version_etag(version, 'snapshot')
+        last_modified = version.updated_at.timestamp()
+        historical = bool(version_param) and is_historical(
+            version, current_version_resolver.resolve(id))
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = self._file(request, id, version, etag)
+        return set_cache_headers(response, etag, last_modified, historical)
+
+    @staticmethod
+    def _file(request, id, version, etag):
+        # Снимок могут удалить между созданием и открытием (его заменил
+        # снимок нового содержимого): создаём его ещё раз
+        for _ in range(2):
+            try:
+                return file_response(
+                    request, ensure_snapshot(version),
+                    'application/octet-stream',
+                    f'refbook-{id}-{version.version}{SUFFIX}', etag)
+            except FileNotFoundError:
+                pass
+        raise NotFound({'detail': 'Снимок версии удалён, повторите запрос'})
+
+
+@extend_schema(
+    summary='Лента изменений справочников',
+    parameters=[
+        OpenApiParameter(name='since',
+                         description='Номер последнего полученного события '
+                                     '(поле "cursor" предыдущего ответа; по '
+                                     'умолчанию 0 - с начала журнала)',
+                         required=False, type=int),
+        OpenApiParameter(name='limit',
+                         description='Размер страницы (по умолчанию '
+                                     f'{CHANGES_PAGE_MAX})',
+                         required=False, type=int),
+        OpenApiParameter(name='refbook',
+                         description='Идентификатор справочника: только его '
+                                     'изменения',
+                         required=False, type=int),
+    ],
+    responses={200: ChangeFeedSerializer},
+)
+class ChangeFeed(ReadOnlyAPIView):
+    """События создания, изменения и удаления справочников, версий и
+    элементов с номером больше `since` в порядке возрастания номеров. \n
+    Пример запроса:
+    `http://127.0.0.1:8000/changes?since=41&limit=2` \n
+    Пример ответа:
+    ```
+    {
+        "changes": [
+            {
+                "id": 42,
+                "created_at": "2022-10-01T09:00:00Z",
+                "entity": "version",
+                "action": "created",
+                "refbook_id": 1,
+                "version_id": 3,
+                "code": "",
+                "data": {"version": "v3.0", "date_start": "2022-10-01"}
+            },
+            {
+                "id": 43,
+                "created_at": "2022-10-01T09:00:00Z",
+                "entity": "element",
+                "action": "created",
+                "refbook_id": 1,
+                "version_id": 3,
+                "code": "345",
+                "data": {"value": "Ангина"}
+            }
+        ],
+        "cursor": 43,
+        "has_more": true
+    }
+    ```
+    Для синхронизации запрашивайте ленту с `since=<cursor>` предыдущего
+    ответа, пока `has_more` не станет `false`. События элементов описывают
+    содержимое версии (с учётом базовой версии); при удалении версии или
+    справочника отдельных событий для их элементов нет. Повтор ленты с
+    `since=0` восстанавливает текущее состояние справочников."""
+    def get(self, request, *args, **kwargs):
+        since = self._int_param(request, 'since', 0)
+        limit = self._int_param(request, 'limit', CHANGES_PAGE_MAX)
+        if since < 0 or not 0 < limit <= CHANGES_PAGE_MAX:
+            raise ValidationError({
+                'detail': 'Параметр since должен быть неотрицательным, '
+                          f'limit - от 1 до {CHANGES_PAGE_MAX}.'})
+        refbook_id = None
+        if 'refbook' in request.query_params:
+            refbook_id = self._int_param(request, 'refbook', 0)
+        events = list(changes_since(since, limit + 1, refbook_id))
+        has_more = len(events) > limit
+        events = events[:limit]
+        return Response({
+            'changes': events,
+            'cursor': events[-1]['id'] if events else since,
+            'has_more': has_more,
+        })
+
+    @staticmethod
+    def _int_param(request, name, default):
+        try:
+            return int(request.query_params.get(name, default))
+        except ValueError:
+            raise ValidationError(
+                {'detail': f'Параметр {name} должен быть целым числом.'})
+
+
+HIERARCHY_PARAMETERS = [
+    OpenApiParameter(name='id', location=OpenApiParameter.PATH,
+                     description='Идентификатор справочника',
+                     required=True, type=int),
+    OpenApiParameter(name='code', description='Код элемента',
+                     required=True, type=str),
+    OpenApiParameter(name='version', description='Версия справочника',
+                     required=False, type=str),
+]
+
+
+@extend_schema(
+    summary='Предки элемента иерархического справочника',
+    parameters=HIERARCHY_PARAMETERS,
+    responses={200: HierarchyElementSerializer(many=True)},
+)
+class ElementAncestors(ReadOnlyAPIView):
+    """Цепочка предков элемента от верхнего уровня до родителя, одним
+    запросом по таблице иерархии версии при любой глубине дерева. \n
+    Пример запроса:
+    `http://127.0.0.1:8000/refbooks/2/ancestors?code=J00.0` \n
+    Пример ответа:
+    ```
+    {
+        "elements": [
+            {"code": "J00-J99", "value": "Болезни органов дыхания",
+             "parent": null},
+            {"code": "J00", "value": "Острый назофарингит",
+             "parent": "J00-J99"}
+        ]
+    }
+    ```"""
+    def get(self, request, id, *args, **kwargs):
+        code, = required_code(request.query_params, 'code')
+        version = requested_version(id, request.query_params.get('version'))
+        rows = list(ancestors(version, code))
+        if not rows:
+            ensure_element(version, code)
+        return Response({'elements': [hierarchy_element(*row)
+                                      for row in rows]})
+
+
+@extend_schema(
+    summary='Потомки элемента иерархического справочника',
+    parameters=HIERARCHY_PARAMETERS + [
+        OpenApiParameter(name='limit',
+                         description='Размер страницы (по умолчанию и не '
+                                     f'более {ELEMENTS_PAGE_MAX})',
+                         required=False, type=int),
+        OpenApiParameter(name='cursor',
+                         description='Курсор следующей страницы из поля '
+                                     '"next" предыдущего ответа',
+                         required=False, type=str),
+    ],
+    responses={200: HierarchyElementSerializer(many=True)},
+)
+class ElementDescendants(ReadOnlyAPIView):
+    """Все потомки элемента (всё поддерево) в порядке кодов, постранично
+    по курсору. Поле `parent` позволяет восстановить структуру
+    поддерева. \n
+    Пример запроса:
+    `http://127.0.0.1:8000/refbooks/2/descendants?code=J00-J99&limit=100` \n
+    Пример ответа:
+    ```
+    {
+        "elements": [
+            {"code": "J00", "value": "Острый назофарингит",
+             "parent": "J00-J99"},
+            {"code": "J00.0", "value": "Насморк", "parent": "J00"}
+        ],
+        "next": null
+    }
+    ```"""
+    def get(self, request, id, *args, **kwargs):
+        code, = required_code(request.query_params, 'code')
+        limit = page_limit(request.query_params)
+        cursor = request.query_params.get('cursor')
+        version = requested_version(id, request.query_params.get('version'))
+        rows = list(descendants(
+            version, code, decode_cursor(cursor) if cursor else None)[
+            :limit + 1])
+        if not rows and not cursor:
+            ensure_element(version, code)
+        return Response({
+            'elements': [hierarchy_element(*row) for row in rows[:limit]],
+            'next': encode_cursor(rows[limit - 1][0]) if len(
+                rows) > limit else None,
+        })
+
+
+@extend_schema(
+    summary='Проверка вхождения элемента в поддерево',
+    parameters=HIERARCHY_PARAMETERS + [
+        OpenApiParameter(name='ancestor',
+                         description='Код предполагаемого предка',
+                         required=True, type=str),
+    ],
+    responses={200: OpenApiParameter(name='is_descendant', type=bool)},
+)
+class CheckDescendant(ReadOnlyAPIView):
+    """Является ли элемент `code` потомком элемента `ancestor` (на любой
+    глубине) в указанной версии справочника; один запрос по индексу таблицы
+    иерархии. \n
+    Пример запроса:
+    `http://127.0.0.1:8000/refbooks/2/is_descendant?code=J00.0&ancestor=J00-J99`
+    \n
+    Пример ответа:
+    ```
+    {
+        "is_descendant": true
+    }
+    ```"""
+    def get(self, request, id, *args, **kwargs):
+        code, ancestor = required_code(request.query_params, 'code',
+                                       'ancestor')
+        version = requested_version(id, request.query_params.get('version'))
+        return Response(
+            {'is_descendant': is_descendant(version, code, ancestor)})